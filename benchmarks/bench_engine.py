@@ -0,0 +1,135 @@
+"""
+Engine benchmarks on synthetic archives: background build, LCI solves, fragment construction and publication.
+
+Classes follow the asv conventions (params / setup / time_*); benchmarks that need ForegroundFragment are skipped
+when it cannot be imported.  The module can also be run directly:
+
+    python benchmarks/bench_engine.py [n_processes ...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from lcamatrix.background import BackgroundEngine
+from lcamatrix.synthetic import synthetic_archive, deep_call, SyntheticFlowDb
+
+
+SIZES = [1000, 10000]
+
+
+def build_engine(archive):
+    engine = BackgroundEngine(archive)
+    engine.add_all_ref_products()
+    return engine
+
+
+def _fragment_class():
+    try:
+        from lcamatrix.foreground import ForegroundFragment
+    except ImportError:
+        raise NotImplementedError('ForegroundFragment is not available')
+    return ForegroundFragment
+
+
+class BuildEngine(object):
+    params = SIZES
+    param_names = ['n_processes']
+    timeout = 600
+
+    def setup(self, n_processes):
+        self.archive = synthetic_archive(n_processes)
+
+    def time_add_all_ref_products(self, n_processes):
+        deep_call(build_engine, self.archive)
+
+
+class ComputeLci(object):
+    params = SIZES
+    param_names = ['n_processes']
+    timeout = 600
+
+    def setup(self, n_processes):
+        self.engine = deep_call(build_engine, synthetic_archive(n_processes))
+        self.pf = next(self.engine.foreground_flows())
+        self.ad, _ = self.engine.lci_demand(self.pf)
+
+    def time_compute_lci(self, n_processes):
+        self.engine.compute_lci(self.pf)
+
+    def time_factorize(self, n_processes):
+        self.engine._lu = None
+        self.engine.factorize()
+
+    def time_solve_bg_lci(self, n_processes):
+        self.engine.solve_bg_lci(self.ad)
+
+
+class Fragments(object):
+    params = SIZES
+    param_names = ['n_processes']
+    timeout = 600
+
+    def setup(self, n_processes):
+        self.fragment_class = _fragment_class()
+        self.archive = synthetic_archive(n_processes)
+        self.engine = deep_call(build_engine, self.archive)
+        self.db = SyntheticFlowDb()
+        self.flows = list(self.engine.foreground_flows(outputs=True))
+        self.engine.factorize()
+
+    def time_fragments(self, n_processes):
+        for pf in self.flows:
+            self.fragment_class(self.engine, self.db, pf)
+
+    def time_whole_foreground_lcia(self, n_processes):
+        whole = self.fragment_class(self.engine, self.db, None)
+        whole.characterize(self.archive.lcia)
+        whole.lcia_all()
+
+
+class Publication(object):
+    params = SIZES
+    param_names = ['n_processes']
+    timeout = 600
+
+    def setup(self, n_processes):
+        from lcamatrix.foreground_publication import publish_fragments
+        self.publish_fragments = publish_fragments
+        fragment_class = _fragment_class()
+        archive = synthetic_archive(n_processes)
+        engine = deep_call(build_engine, archive)
+        db = SyntheticFlowDb()
+        self.fragments = []
+        for pf in list(engine.foreground_flows(outputs=True))[:20]:
+            fragment = fragment_class(engine, db, pf)
+            fragment.characterize(archive.lcia)
+            self.fragments.append(fragment)
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self, n_processes):
+        shutil.rmtree(self.dir)
+
+    def time_publish(self, n_processes):
+        filenames = [os.path.join(self.dir, 'fragment%d' % k) for k in range(len(self.fragments))]
+        self.publish_fragments(self.fragments, filenames, fmt='csv')
+
+
+if __name__ == '__main__':
+    sizes = [int(k) for k in sys.argv[1:]] or SIZES
+    print('%-40s %10s %10s' % ('benchmark', 'processes', 'seconds'))
+    for _cls in (BuildEngine, ComputeLci, Fragments, Publication):
+        for _n in sizes:
+            _bench = _cls()
+            try:
+                _bench.setup(_n)
+            except NotImplementedError as e:
+                print('%-40s %10d %10s' % (_cls.__name__, _n, 'skipped'))
+                continue
+            for _name in sorted(k for k in dir(_bench) if k.startswith('time_')):
+                _start = time.time()
+                getattr(_bench, _name)(_n)
+                print('%-40s %10d %10.3f' % ('%s.%s' % (_cls.__name__, _name), _n, time.time() - _start))
+            if hasattr(_bench, 'teardown'):
+                _bench.teardown(_n)
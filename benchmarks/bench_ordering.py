@@ -0,0 +1,71 @@
+"""
+Background ordering benchmark: A* bandwidth, SpMV and factorization time with and without reordering.
+
+The same synthetic archive is traversed twice, once with the default background numbering (order of joining the
+background) and once with BackgroundEngine(..., ordering='rcm').  Classes follow the asv conventions; the module can
+also be run directly:
+
+    python benchmarks/bench_ordering.py [n_processes ...]
+"""
+import sys
+import time
+
+import numpy as np
+
+from lcamatrix.background import BackgroundEngine
+from lcamatrix.synthetic import synthetic_archive, deep_call
+
+
+ORDERINGS = [None, 'rcm']
+
+
+def build_engine(archive, ordering=None):
+    engine = BackgroundEngine(archive, ordering=ordering)
+    engine.add_all_ref_products()
+    return engine
+
+
+def bandwidth(a):
+    a = a.tocoo()
+    if a.nnz == 0:
+        return 0
+    return int(np.abs(a.row.astype(np.int64) - a.col).max())
+
+
+class BackgroundOrdering(object):
+    params = ([1000, 10000], ORDERINGS)
+    param_names = ['n_processes', 'ordering']
+    timeout = 600
+
+    def setup(self, n_processes, ordering):
+        self.engine = deep_call(build_engine, synthetic_archive(n_processes), ordering=ordering)
+        self.x = np.random.RandomState(0).rand(self.engine.tstack.ndim)
+
+    def time_spmv(self, n_processes, ordering):
+        a = self.engine._a_matrix
+        x = self.x
+        for _ in range(20):
+            a.dot(x)
+
+    def time_factorize(self, n_processes, ordering):
+        self.engine._lu = None
+        self.engine.factorize()
+
+    def track_bandwidth(self, n_processes, ordering):
+        return bandwidth(self.engine._a_matrix)
+
+
+if __name__ == '__main__':
+    sizes = [int(k) for k in sys.argv[1:]] or BackgroundOrdering.params[0]
+    print('%10s %10s %10s %12s %12s' % ('processes', 'ordering', 'bandwidth', 'spmv x20 s', 'factorize s'))
+    for _n in sizes:
+        for _ordering in ORDERINGS:
+            _bench = BackgroundOrdering()
+            _bench.setup(_n, _ordering)
+            _start = time.time()
+            _bench.time_spmv(_n, _ordering)
+            _spmv = time.time() - _start
+            _start = time.time()
+            _bench.time_factorize(_n, _ordering)
+            _lu = time.time() - _start
+            print('%10d %10s %10d %12.4f %12.3f' % (_n, _ordering, _bench.track_bandwidth(_n, _ordering), _spmv, _lu))
@@ -0,0 +1,119 @@
+"""
+Publication benchmark: time ForegroundPublication.publish against fragment size, in sparse and full matrix modes.
+
+The fragment is a stand-in implementing the interface documented in ForegroundPublication, filled with random sparse
+matrices, so the benchmark measures only the writing path.  Output goes to a CSV directory (no spreadsheet library
+required).  Classes follow the asv conventions (params / setup / time_*); the module can also be run directly:
+
+    python benchmarks/bench_publication.py
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from scipy.sparse import random as sparse_random, csr_matrix
+
+from lcamatrix.foreground_publication import ForegroundPublication
+
+
+class _Entity(object):
+    origin = 'benchmark'
+
+    def __init__(self, name):
+        self.external_ref = name
+        self._name = name
+
+    def __getitem__(self, item):
+        return self._name
+
+    def get_external_ref(self):
+        return self.external_ref
+
+    def unit(self):
+        return 'kg'
+
+    def __str__(self):
+        return self._name
+
+
+class _Node(object):
+    direction = 'Output'
+
+    def __init__(self, name):
+        self.flow = _Entity('flow %s' % name)
+        self.process = _Entity('process %s' % name)
+        self.compartment = ('air', name)
+
+
+class StubFragment(object):
+    """
+    Random fragment with p foreground nodes, n background flows, m emissions and t LCIA methods
+    """
+    uuid = 'benchmark-fragment'
+
+    def __init__(self, p, n, m, t=10, density=0.05, seed=0):
+        rng = np.random.RandomState(seed)
+        self.pdim, self.ndim, self.mdim, self.tdim = p, n, m, t
+        self.Af = csr_matrix(np.triu(rng.rand(p, p) * (rng.rand(p, p) < 0.2), 1))
+        self.Ad = sparse_random(n, p, density=density, random_state=rng, format='csr')
+        self.Bf = sparse_random(m, p, density=density, random_state=rng, format='csr')
+        self.E = sparse_random(t, m, density=0.5, random_state=rng, format='csr')
+        self.lcia_methods = [_Entity('method %d' % k) for k in range(t)]
+        self.foreground = [_Node('fg %d' % k) for k in range(p)]
+        self._bg = [_Node('bg %d' % k) for k in range(n)]
+        self._em = [_Node('em %d' % k) for k in range(m)]
+        self.is_elem = np.ones(m, dtype=bool)
+        self._x = np.matrix(np.linalg.inv(np.eye(p) - self.Af.toarray())[:, [0]])
+        self._unit = rng.rand(t, n)
+
+    @property
+    def bg_flows(self):
+        return iter(self._bg)
+
+    @property
+    def emissions(self):
+        return iter(self._em)
+
+    def x_tilde(self, node=0):
+        return self._x
+
+    def fg_lcia(self):
+        return self.E * (self.Bf * self._x)
+
+    def bg_lcia(self):
+        return csr_matrix(self._unit.dot(self.Ad * self._x))
+
+    def bg_unit_scores(self):
+        return self._unit
+
+
+class PublishFragment(object):
+    params = ([10, 100, 1000], [False, True])
+    param_names = ['scale', 'full']
+
+    def setup(self, scale, full):
+        self.fragment = StubFragment(p=max(5, scale // 10), n=20 * scale, m=5 * scale)
+        self.publication = ForegroundPublication(self.fragment)
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self, scale, full):
+        shutil.rmtree(self.dir)
+
+    def time_publish(self, scale, full):
+        self.publication.publish(os.path.join(self.dir, 'out'), full=full, fmt='csv')
+
+
+if __name__ == '__main__':
+    bench = PublishFragment()
+    print('%8s %6s %6s %6s %10s' % ('scale', 'p', 'n', 'm', 'seconds'))
+    for _scale in PublishFragment.params[0]:
+        for _full in PublishFragment.params[1]:
+            bench.setup(_scale, _full)
+            _start = time.time()
+            bench.time_publish(_scale, _full)
+            _elapsed = time.time() - _start
+            f = bench.fragment
+            print('%8d %6d %6d %6d %10.3f %s' % (_scale, f.pdim, f.ndim, f.mdim, _elapsed, 'full' if _full else ''))
+            bench.teardown(_scale, _full)
@@ -0,0 +1,68 @@
+"""
+Traversal benchmark: time and peak memory of BackgroundEngine.add_all_ref_products on synthetic archives.
+
+Tarjan's algorithm recurses once per product flow along each depth-first path, and the background of a synthetic
+archive is a single large SCC, so large archives need a deep stack; the traversal is run through synthetic.deep_call.
+Classes follow the asv conventions; the module can also be run directly:
+
+    python benchmarks/bench_traversal.py [n_processes ...]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+
+from lcamatrix.background import BackgroundEngine
+from lcamatrix.synthetic import synthetic_archive, deep_call
+
+
+def build_engine(archive):
+    engine = BackgroundEngine(archive)
+    engine.add_all_ref_products()
+    return engine
+
+
+class TraverseArchive(object):
+    params = [1000, 10000, 50000]
+    param_names = ['n_processes']
+    timeout = 600
+
+    def setup(self, n_processes):
+        self.archive = synthetic_archive(n_processes)
+
+    def time_traverse(self, n_processes):
+        deep_call(build_engine, self.archive)
+
+    def peakmem_traverse(self, n_processes):
+        deep_call(build_engine, self.archive)
+
+
+def _measure(n_processes, queue):
+    archive = synthetic_archive(n_processes)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    engine = deep_call(build_engine, archive)
+    elapsed = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((engine.tstack.ndim, engine.tstack.pdim, elapsed, (after - before) / 1024.))
+
+
+def measure(n_processes):
+    """
+    Traverse a fresh archive in a child process, so that the peak resident memory of the traversal (beyond the
+    archive itself) can be read from the child's rusage.
+    :return: ndim, pdim, seconds, peak MB
+    """
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_measure, args=(n_processes, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+if __name__ == '__main__':
+    sizes = [int(k) for k in sys.argv[1:]] or TraverseArchive.params
+    print('%10s %8s %8s %10s %12s' % ('processes', 'ndim', 'pdim', 'seconds', 'peak MB'))
+    for _n in sizes:
+        print('%10d %8d %8d %10.2f %12.1f' % ((_n, ) + measure(_n)))
@@ -6,20 +6,33 @@ So for the time being we are safe.
 may need to use threading to go higher (see http://stackoverflow.com/questions/2917210/)
 Validate recursion depth on a given system using PYTHONROOT/Tools/scripts/find_recursionlimit.py
 """
+import copy
 import sys  # for recursion limit
+from array import array
+from collections import namedtuple
 import re  # for product_flows search
 
 import numpy as np
-import scipy as sp
-from scipy.sparse import csc_matrix, csr_matrix
+from scipy.sparse import coo_matrix, csc_matrix, csr_matrix, identity, issparse
+# scipy.sparse.linalg, scipy.sparse.csgraph and the analysis modules (sensitivity, monte_carlo, path_analysis) are
+# imported where they are first used, to keep `import lcamatrix.background` fast
 
 from lcamatrix.tarjan_stack import TarjanStack
 from lcamatrix.product_flow import ProductFlow
 from lcamatrix.emission import Emission
+from lcamatrix.interner import Interner, pair_key
+from lcamatrix.lci_cache import LciCache, DEFAULT_MAX_BYTES
+from lcamatrix.contribution import Contributions, as_vector, scale_columns, top_k as contrib_top_k
 
 
 MAX_SAFE_RECURSION_LIMIT = 18000  # this should be validated using
 
+ORDERINGS = ('rcm', )  # background orderings supported by reorder_background
+
+
+# x and bx from a screening computation, with a bound on the 1-norm of the error in each
+ScreeningLci = namedtuple('ScreeningLci', ('x', 'bx', 'error_bound', 'iterations'))
+
 
 class RepeatAdjustment(Exception):
     pass
@@ -30,11 +43,16 @@ class MatrixProto(object):
     # Exchanges: parent = column; term = row;
     Value is modified to encode exchange direction: outputs must be negated at creation, inputs entered directly
     """
-    def __init__(self, parent, value):
+    def __init__(self, parent, value, adjusted=False):
+        """
+        :param parent:
+        :param value:
+        :param adjusted: [False] True if value is already normalized to the parent's reference output
+        """
         assert isinstance(parent, ProductFlow)
         self._parent = parent
         self._value = value
-        self._adjusted = False
+        self._adjusted = adjusted
 
     @property
     def parent(self):
@@ -53,9 +71,9 @@ class MatrixProto(object):
 
 
 class MatrixEntry(MatrixProto):
-    def __init__(self, parent, term, value):
+    def __init__(self, parent, term, value, adjusted=False):
         assert isinstance(term, ProductFlow)
-        super(MatrixEntry, self).__init__(parent, value)
+        super(MatrixEntry, self).__init__(parent, value, adjusted=adjusted)
         self._term = term
 
     @property
@@ -67,9 +85,9 @@ class CutoffEntry(MatrixProto):
     """
     # Cutoffs: parent = column; emission = row of B includes direction information; value is entered unmodified
     """
-    def __init__(self, parent, emission, value):
+    def __init__(self, parent, emission, value, adjusted=False):
         assert isinstance(emission, Emission)
-        super(CutoffEntry, self).__init__(parent, value)
+        super(CutoffEntry, self).__init__(parent, value, adjusted=adjusted)
         self._term = emission
 
     @property
@@ -107,11 +125,18 @@ class BackgroundEngine(object):
     """
     Class for converting a collection of linked processes into a coherent technology matrix.
     """
-    def __init__(self, foreground):
+    def __init__(self, foreground, ordering=None):
         """
+        :param foreground: an archive to traverse, or None for an engine built with from_matrices
+        :param ordering: [None] if given, reorder the background (see reorder_background) each time A* is built;
+         otherwise background columns are numbered in the order they join the background
         """
+        if ordering is not None and ordering not in ORDERINGS:
+            raise ValueError('Unknown ordering %s' % ordering)
         self.fg = foreground
-        self._lowlinks = dict()  # dict mapping product_flow key to lowlink -- which is a key into TarjanStack.sccs
+        self._ordering = ordering
+        self._ids = Interner()  # flow, process uuids (and emission directions) -> dense ints
+        self._lowlinks = array('l')  # maps product_flow index to lowlink -- which is a key into TarjanStack.sccs
 
         self.tstack = TarjanStack()  # ordering of sccs
 
@@ -125,18 +150,105 @@ class BackgroundEngine(object):
         self._bg_emission = []  # CutoffEntries whose parent is background - B*
         self._cutoff = []  # CutoffEntries whose parent is foreground - Bf
 
-        self._product_flows = dict()  # maps product_flow.key to index-- being position in _pf_index
+        self._product_flows = dict()  # maps interned product_flow.key to index-- being position in _pf_index
         self._pf_index = []  # maps index to product_flow in order added
 
         self._a_matrix = None  # includes only interior exchanges -- dependencies in _interior
         self._b_matrix = None  # SciPy.csc_matrix for bg only
-
-        self._rec_limit = len(self.fg.processes())
+        self._lu = None  # cached factorization of (I - A*)
+        self._a_csc = None  # cached column-major copies of A* and B*
+        self._b_csc = None
+        self._fg_matrices = None  # cached whole-foreground Af, Ad, Bf
+        self._version = 0  # incremented when A* or B* is rebuilt
+        self._lci_cache = None  # optional LciCache of compute_lci results
+        self._screening = None  # (version, weights, contraction) for screen_bg_lci error bounds
+        self._terminations = dict()  # interned (flow uuid, direction) -> list of terminating processes
+
+        self._rec_limit = 0 if foreground is None else len(self.fg.processes())
         if self.required_recursion_limit > MAX_SAFE_RECURSION_LIMIT:
             raise EnvironmentError('This database may require too high a recursion limit-- time to learn lisp.')
 
-        self._emissions = dict()  # maps emission key to index
+        self._emissions = dict()  # maps interned emission key to index
         self._ef_index = []  # maps index to emission
+        self._elementary = dict()  # id(compartment manager) -> (manager, boolean mask over _ef_index)
+
+    @classmethod
+    def from_matrices(cls, a, b, product_flows, emissions, foreground=None, ordering=None):
+        """
+        Build an engine from an already-linked technology and intervention matrix, without traversing an archive.
+        Strongly connected components are found with scipy.sparse.csgraph, and the background / foreground split and
+        indices are populated directly, so construction time scales with the number of nonzeros.
+
+        Self-dependencies (diagonal entries of a) are folded into the reference output, as in the traversal: column j
+        is divided by (1 - a[j, j]) and the engine's ProductFlow's inbound_ev is adjusted.  Such ProductFlows are
+        copied before adjustment, so the caller's objects are never modified and can be reused for another engine.
+        :param a: N x N sparse matrix of interior exchanges, normalized per unit reference output of each column,
+         with inputs positive (the same convention as A*)
+        :param b: M x N sparse matrix of exterior exchanges (emissions and cutoffs) per unit reference output
+        :param product_flows: N ProductFlows, with product_flows[i].index == i
+        :param emissions: M Emissions, with emissions[k].index == k
+        :param foreground: [None] archive for subsequent traversal with add_ref_product, if any
+        :param ordering: [None] background ordering, as for the constructor
+        :return: a BackgroundEngine
+        """
+        from scipy.sparse.csgraph import connected_components
+        a = coo_matrix(a)
+        b = coo_matrix(b)
+        ndim = len(product_flows)
+        mdim = len(emissions)
+        if a.shape != (ndim, ndim) or b.shape != (mdim, ndim):
+            raise ValueError('Matrix shapes %s, %s do not match %d product flows and %d emissions' % (
+                a.shape, b.shape, ndim, mdim))
+        if any(pf.index != i for i, pf in enumerate(product_flows)) or \
+                any(em.index != k for k, em in enumerate(emissions)):
+            raise ValueError('Product flow and emission indices must match their positions')
+
+        a.sum_duplicates()
+        b.sum_duplicates()
+        diag = a.row == a.col
+        scale = np.ones(ndim)
+        product_flows = list(product_flows)
+        for k in np.flatnonzero(diag):
+            pf = copy.copy(product_flows[a.col[k]])  # the caller's ProductFlow is left unadjusted
+            ev = pf.inbound_ev
+            pf.adjust_ev(a.data[k] * ev)
+            scale[pf.index] = ev / pf.inbound_ev
+            product_flows[pf.index] = pf
+
+        engine = cls(foreground, ordering=ordering)
+        for pf in product_flows:
+            engine._product_flows[engine._key(*pf.key)] = pf.index
+            engine._pf_index.append(pf)
+        for em in emissions:
+            engine._emissions[engine._key(*em.key)] = em.index
+            engine._ef_index.append(em)
+
+        keep = ~diag & (a.data != 0)
+        rows, cols = a.row[keep], a.col[keep]
+        data = a.data[keep] * scale[cols]
+
+        # SCC IDs are the lowest product flow index in each component, as in the traversal
+        pattern = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(ndim, ndim))
+        ncomp, labels = connected_components(pattern, directed=True, connection='strong')
+        lowest = np.full(ncomp, ndim)
+        np.minimum.at(lowest, labels, np.arange(ndim))
+        scc_ids = lowest[labels].tolist()
+        engine._lowlinks = array('l', scc_ids)  # a completed traversal leaves each lowlink at its SCC ID
+        engine.tstack.set_components(product_flows, scc_ids, lowest[labels[rows]].tolist(),
+                                     lowest[labels[cols]].tolist())
+
+        engine._interior = [MatrixEntry(product_flows[j], product_flows[i], v, adjusted=True)
+                            for i, j, v in zip(rows.tolist(), cols.tolist(), data.tolist())]
+        engine._bg_emission = [CutoffEntry(product_flows[j], emissions[i], v, adjusted=True)
+                               for i, j, v in zip(b.row.tolist(), b.col.tolist(), (b.data * scale[b.col]).tolist())]
+        engine._sort_entries()
+        if engine.tstack.background is not None:
+            engine._construct_a_matrix()
+            engine._construct_b_matrix()
+            engine._version += 1
+            if ordering is not None:
+                engine.reorder_background(ordering)
+        return engine
 
     @property
     def required_recursion_limit(self):
@@ -150,18 +262,52 @@ class BackgroundEngine(object):
     def emissions(self):
         return self._ef_index
 
+    def elementary_mask(self, compartments):
+        """
+        Boolean array indicating which emissions are elementary, according to the given compartment manager.  The
+        mask is cached per compartment manager; emissions added since the last call are looked up incrementally.
+        :param compartments: object with an is_elementary(flow) method
+        :return: m-array of bool (do not modify)
+        """
+        _, mask = self._elementary.get(id(compartments), (None, np.zeros(0, dtype=bool)))
+        if len(mask) < self.mdim:
+            new = [compartments.is_elementary(em.flow) for em in self._ef_index[len(mask):]]
+            mask = np.concatenate((mask, np.array(new, dtype=bool)))
+            self._elementary[id(compartments)] = (compartments, mask)
+        return mask
+
+    def _key(self, a, b):
+        """
+        Interned form of a product flow or emission key
+        :param a: flow uuid
+        :param b: process uuid or direction
+        :return: int
+        """
+        return pair_key(self._ids.intern(a), self._ids.intern(b))
+
+    def _find_key(self, a, b):
+        """
+        Interned form of a key, without interning new identifiers
+        :return: int, or None if either identifier is unknown (in which case nothing is stored under the key)
+        """
+        i = self._ids.get(a)
+        j = self._ids.get(b)
+        if i is None or j is None:
+            return None
+        return pair_key(i, j)
+
     def index(self, product_flow):
-        return self._product_flows[product_flow.key]
+        return self._product_flows[self._find_key(*product_flow.key)]
 
     def product_flow(self, index):
         return self._pf_index[index]
 
     def _lowlink(self, product_flow):
-        return self._lowlinks[product_flow.key]
+        return self._lowlinks[product_flow.index]
 
     def _add_product_flow(self, pf):
-        self._product_flows[pf.key] = pf.index
-        self._set_lowlink(pf, pf.index)
+        self._product_flows[self._key(*pf.key)] = pf.index
+        self._lowlinks.append(pf.index)
         self._pf_index.append(pf)
         self.tstack.add_to_stack(pf)
 
@@ -172,10 +318,8 @@ class BackgroundEngine(object):
         :param lowlink:
         :return:
         """
-        if pf.key in self._lowlinks:
-            self._lowlinks[pf.key] = min(self._lowlink(pf), lowlink)
-        else:
-            self._lowlinks[pf.key] = lowlink
+        if lowlink < self._lowlinks[pf.index]:
+            self._lowlinks[pf.index] = lowlink
 
     def check_product_flow(self, flow, termination):
         """
@@ -186,7 +330,7 @@ class BackgroundEngine(object):
         """
         if termination is None:
             raise ValueError('Must supply a termination')
-        k = (flow.uuid, termination.uuid)
+        k = self._find_key(flow.uuid, termination.uuid)
         if k in self._product_flows:
             return self.product_flow(self._product_flows[k])
         else:
@@ -199,20 +343,21 @@ class BackgroundEngine(object):
         return pf
 
     def _add_emission(self, flow, direction):
-        key = (flow.uuid, direction)
+        key = self._key(flow.uuid, direction)
         if key in self._emissions:
             return self._ef_index[self._emissions[key]]
         else:
             index = len(self._ef_index)
             ef = Emission(index, flow, direction)
-            self._emissions[ef.key] = index
+            self._emissions[key] = index
             self._ef_index.append(ef)
             return ef
 
     def terminate(self, exch, strategy):
         """
         Find the ProductFlow that terminates a given exchange.  If an exchange has an explicit termination, use it.
-        Otherwise, consult a local cache; and ask the archive [slow] if the cache is not populated.
+        Otherwise, consult a local cache of terminations by flow and direction; and ask the archive [slow] if the
+        cache is not populated.
         :param exch:
         :param strategy:
         :return:
@@ -220,7 +365,10 @@ class BackgroundEngine(object):
         if exch.termination is not None:
             return self.fg[exch.termination]
         else:
-            terms = [t for t in self.fg.terminate(exch.flow, direction=exch.direction)]
+            key = self._key(exch.flow.uuid, exch.direction)
+            if key not in self._terminations:
+                self._terminations[key] = [t for t in self.fg.terminate(exch.flow, direction=exch.direction)]
+            terms = self._terminations[key]
             if len(terms) == 0:
                 return None
             elif len(terms) == 1:
@@ -238,11 +386,54 @@ class BackgroundEngine(object):
                     raise KeyError('Unknown multi-termination strategy %s' % strategy)
             return self.fg[term.external_ref]  # required to get full exchange list
 
+    @staticmethod
+    def triplets(entries, row, col, value, nnz=None):
+        """
+        Typed coordinate arrays for a sparse matrix, filled directly from a sequence of entries without building
+        intermediate lists.
+        :param entries: sequence of matrix entries (e.g. MatrixEntries)
+        :param row: function mapping an entry to its row index
+        :param col: function mapping an entry to its column index
+        :param value: function mapping an entry to its data value
+        :param nnz: [len(entries)] number of entries
+        :return: rows (int32 array), cols (int32 array), data (float64 array)
+        """
+        if nnz is None:
+            nnz = len(entries)
+        rows = np.fromiter((row(e) for e in entries), dtype=np.int32, count=nnz)
+        cols = np.fromiter((col(e) for e in entries), dtype=np.int32, count=nnz)
+        data = np.fromiter((value(e) for e in entries), dtype=np.float64, count=nnz)
+        return rows, cols, data
+
+    @staticmethod
+    def construct_typed(rows, cols, data, nrows, ncols, fmt='csr', duplicates='sum'):
+        """
+        Builds a sparse matrix from typed coordinate arrays.
+        :param rows: int array of row indices
+        :param cols: int array of column indices
+        :param data: float array of values
+        :param nrows:
+        :param ncols:
+        :param fmt: ['csr'] or 'csc'
+        :param duplicates: ['sum'] entries sharing a row and column are added together; 'error' raises ValueError
+        :return: csr_matrix or csc_matrix
+        """
+        if duplicates not in ('sum', 'error'):
+            raise ValueError('Unknown duplicate policy %s' % duplicates)
+        mat = coo_matrix((data, (rows, cols)), shape=(nrows, ncols))
+        nnz = mat.nnz
+        mat.sum_duplicates()
+        if duplicates == 'error' and mat.nnz < nnz:
+            raise ValueError('%d duplicate matrix entries' % (nnz - mat.nnz))
+        if fmt == 'csc':
+            return mat.tocsc()
+        return mat.tocsr()
+
     @staticmethod
     def construct_sparse(nums, nrows, ncols):
         """
 
-        :param nums:
+        :param nums: array of [row index, column index, data] entries
         :param nrows:
         :param ncols:
         :return:
@@ -251,33 +442,158 @@ class BackgroundEngine(object):
             return csr_matrix((nrows, ncols))
         else:
             try:
-                return csr_matrix((nums[:, 2], (nums[:, 0], nums[:, 1])), shape=(nrows, ncols))
-            except IndexError:
+                return BackgroundEngine.construct_typed(nums[:, 0].astype(np.int32), nums[:, 1].astype(np.int32),
+                                                        nums[:, 2], nrows, ncols)
+            except (IndexError, ValueError):
                 print('nrows: %s  ncols: %s' % (nrows, ncols))
                 print(nums)
                 raise
 
-    def compute_lci(self, product_flow, **kwargs):
+    def lci_demand(self, product_flow):
+        """
+        Reduces a product flow to a demand on the background plus its direct foreground emissions.
+        :param product_flow:
+        :return: ad_tilde, bf_tilde: n x 1 background demand; m x 1 foreground emissions (None for background flows)
+        """
         if self.is_background(product_flow):
-            num_ad = sp.array([[self.tstack.bg_dict(product_flow.index), 0, 1.0]])
-            ad = self.construct_sparse(num_ad, self.tstack.ndim, 1)
-            x, bx = self.compute_bg_lci(ad, **kwargs)
-            return bx
-        else:
-            af, ad, bf = self.make_foreground(product_flow)
-            x_tilde = np.linalg.inv(np.eye(af.shape[0]) - af.todense())[:, 0]
-            ad_tilde = ad * x_tilde
-            x, bx = self.compute_bg_lci(ad_tilde, **kwargs)
-            bf_tilde = csc_matrix(bf * x_tilde)
-        return bx + bf_tilde
+            ad = self.construct_typed([self.tstack.bg_dict(product_flow.index)], [0], [1.0], self.tstack.ndim, 1)
+            return ad, None
+        af, ad, bf = self.make_foreground(product_flow)
+        x_tilde = np.linalg.inv(np.eye(af.shape[0]) - af.todense())[:, 0]
+        ad_tilde = ad * x_tilde
+        bf_tilde = csc_matrix(bf * x_tilde)
+        return ad_tilde, bf_tilde
 
-    def compute_bg_lci(self, ad, threshold=1e-8, count=100):
+    def compute_lci(self, product_flow, **kwargs):
         """
-        Computes background LCI via iterative matrix multiplication.
-        :param ad: a vector of background activity levels
-        :param threshold: [1e-8] size of the increment (1-norm) relative to the total LCI to finish early
-        :param count: [100] maximum number of iterations to perform
-        :return:
+        Computes the LCI of a unit of product_flow.  If an LCI cache is enabled, results are looked up and stored there
+        by product flow index and solver settings; a cached result is shared and must not be modified in place.
+        :param product_flow:
+        :param kwargs: passed to compute_bg_lci (threshold, count)
+        :return: m x 1 sparse LCI
+        """
+        cache = self._lci_cache
+        if cache is not None:
+            key = cache.key(product_flow.index, **kwargs)
+            lci = cache.get(key, self._version)
+            if lci is not None:
+                return lci
+        ad, bf_tilde = self.lci_demand(product_flow)
+        x, lci = self.compute_bg_lci(ad, **kwargs)
+        if bf_tilde is not None:
+            lci = lci + bf_tilde
+        if cache is not None:
+            cache.put(key, lci, self._version)
+        return lci
+
+    def enable_lci_cache(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Cache compute_lci results in an LRU cache bounded by max_bytes.  The cache is emptied automatically whenever
+        A* or B* is rebuilt.
+        :param max_bytes: [256 MiB]
+        :return: the LciCache, for inspecting hit statistics
+        """
+        self._lci_cache = LciCache(max_bytes=max_bytes)
+        return self._lci_cache
+
+    def disable_lci_cache(self):
+        self._lci_cache = None
+
+    @property
+    def lci_cache(self):
+        """
+        The LciCache in use, or None
+        """
+        return self._lci_cache
+
+    def factorize(self):
+        """
+        Computes (once) and returns a sparse LU factorization of (I - A*), for direct solves against the background.
+        :return: a scipy SuperLU object
+        """
+        if self._lu is None:
+            from scipy.sparse.linalg import splu
+            if self._a_matrix is None:
+                raise ValueError('Background matrix has not been constructed')
+            self._lu = splu(csc_matrix(identity(self.tstack.ndim, format='csc') - self._a_matrix))
+        return self._lu
+
+    def solve_bg_lci(self, ad):
+        """
+        Computes background LCI by direct solution against the cached factorization; counterpart to compute_bg_lci.
+        :param ad: n x k background demand (sparse or dense)
+        :return: x, bx as sparse matrices
+        """
+        if issparse(ad):
+            ad = ad.toarray()
+        x = self.factorize().solve(np.asarray(ad, dtype=float))
+        total = csr_matrix(x.reshape(self.tstack.ndim, -1))
+        return total, self._b_matrix * total
+
+    def bg_unit_scores(self, e):
+        """
+        Computes the LCIA scores of a unit output of every background product flow with one adjoint solve:
+        S = E B* (I - A*)^-1.  Column j is equivalent to E * compute_lci(pf) for the pf in A* column j.
+        :param e: t x m characterization matrix
+        :return: t x n dense array
+        """
+        eb = (csr_matrix(e) * self._b_matrix).toarray()
+        return self.factorize().solve(eb.T, trans='T').T
+
+    def compute_bg_contributions(self, ad, e, top_k=None, **kwargs):
+        """
+        Breaks the background LCIA result for a demand down by background process and by emission, from a single LCI
+        computation.
+        :param ad: n x 1 background demand
+        :param e: t x m characterization matrix
+        :param top_k: [None] keep only the k largest-magnitude contributions per score
+        :param kwargs: passed to compute_bg_lci
+        :return: Contributions(scores, processes (t x n), emissions (t x m))
+        """
+        e = csr_matrix(e)
+        x, bx = self.compute_bg_lci(ad, **kwargs)
+        processes = scale_columns(e * self._b_matrix, x)
+        emissions = scale_columns(e, bx)
+        scores = as_vector(e * bx)
+        return Contributions(scores, contrib_top_k(processes, top_k), contrib_top_k(emissions, top_k))
+
+    def structural_paths(self, product_flow, e, **kwargs):
+        """
+        Dominant supply-chain paths behind the LCIA score of a product flow.
+        :param product_flow:
+        :param e: 1 x m characterization vector
+        :param kwargs: passed to StructuralPathAnalysis.paths (cutoff, max_paths, max_expansions, max_depth)
+        :return: list of SupplyPaths
+        """
+        from lcamatrix.path_analysis import StructuralPathAnalysis
+        return StructuralPathAnalysis(self, e).paths(product_flow, **kwargs)
+
+    def perturbation(self):
+        """
+        Create an overlay for what-if changes to A* and B* entries, solved by low-rank updates to the cached
+        factorization rather than by rebuilding the matrices.
+        :return: a BackgroundPerturbation
+        """
+        from lcamatrix.sensitivity import BackgroundPerturbation
+        return BackgroundPerturbation(self)
+
+    def monte_carlo(self, **kwargs):
+        """
+        Create a Monte Carlo sampler over the background matrices.
+        :param kwargs: passed to MonteCarlo (a_spread, b_spread, distribution, tol)
+        :return: a MonteCarlo
+        """
+        from lcamatrix.monte_carlo import MonteCarlo
+        return MonteCarlo(self, **kwargs)
+
+    def _iterate_bg_lci(self, ad, threshold, count, truncate=None):
+        """
+        Power series (I + A* + A*^2 + ...) ad, summed until the increment is small or count is reached.
+        :param ad:
+        :param threshold:
+        :param count:
+        :param truncate: [None] function (x, total) -> x applied to each new iterate before it is summed
+        :return: total, the first iterate not included in total, the number of iterations summed
         """
         x = csr_matrix(ad)  # tested this with ecoinvent: convert to sparse: 280 ms; keep full: 4.5 sec
         total = self.construct_sparse([], *x.shape)
@@ -287,19 +603,105 @@ class BackgroundEngine(object):
         while mycount < count:
             total += x
             x = self._a_matrix.dot(x)
+            if truncate is not None:
+                x = truncate(x, total)
             inc = sum(abs(x).data)
             if inc == 0:
-                print('exact result')
+                print('exact result' if truncate is None else 'iterate truncated to zero')
                 break
             sumtotal += inc
             if inc / sumtotal < threshold:
                 break
             mycount += 1
         print('completed %d iterations' % mycount)
+        return total, x, mycount
 
+    def compute_bg_lci(self, ad, threshold=1e-8, count=100):
+        """
+        Computes background LCI via iterative matrix multiplication.
+        :param ad: a vector of background activity levels
+        :param threshold: [1e-8] size of the increment (1-norm) relative to the total LCI to finish early
+        :param count: [100] maximum number of iterations to perform
+        :return:
+        """
+        total, _, _ = self._iterate_bg_lci(ad, threshold, count)
         b = self._b_matrix * total
         return total, b
 
+    def screening_weights(self):
+        """
+        Weights for the error bound of screen_bg_lci, computed once per version of the background by one adjoint
+        solve: w = (I - |A*|)^-T (1 + |B*|^T 1).  In the norm |v|_w = w.|v|, multiplication by A* contracts by
+        gamma = max_j (|A*|^T w)_j / w_j, which is less than 1 whenever the series for |A*| converges; and since
+        w >= 1 + |B*|^T 1, |v|_w bounds both |v|_1 and |B* v|_1.
+        :return: weights (n-vector), gamma (inf if no valid bound exists)
+        """
+        if self._screening is None or self._screening[0] != self._version:
+            from scipy.sparse.linalg import splu
+            if self._a_matrix is None:
+                raise ValueError('Background matrix has not been constructed')
+            a = abs(self._a_matrix)
+            w0 = 1.0 + np.asarray(abs(self._b_matrix).sum(axis=0)).ravel()
+            if self._a_matrix.nnz == 0 or self._a_matrix.data.min() >= 0:
+                lu = self.factorize()
+            else:
+                lu = splu(csc_matrix(identity(self.tstack.ndim, format='csc') - a))
+            w = lu.solve(w0, trans='T')
+            if np.all(np.isfinite(w)) and np.all(w > 0):
+                w = np.maximum(w, w0)  # any positive w gives a valid gamma; this keeps |v|_w >= |v|_1 + |B* v|_1
+                gamma = (a.T.dot(w) / w).max() if len(w) > 0 else 0.0
+            else:
+                gamma = np.inf  # |A*| is not convergent
+            self._screening = (self._version, w, gamma)
+        return self._screening[1], self._screening[2]
+
+    def screen_bg_lci(self, ad, drop=1e-6, threshold=1e-8, count=100):
+        """
+        Approximate background LCI for screening.  Works like compute_bg_lci, but on each iteration activity entries
+        smaller than drop times the largest entry of the running total are discarded, so the iterate stays confined
+        to the significant part of the supply chain.  The activity neglected, both by dropping and by stopping the
+        series, is tracked and converted into a rigorous bound on the error (see screening_weights).
+        :param ad: a vector of background activity levels
+        :param drop: [1e-6] relative size below which activity entries are discarded
+        :param threshold: [1e-8] as compute_bg_lci
+        :param count: [100] as compute_bg_lci
+        :return: ScreeningLci(x, bx, error_bound, iterations).  error_bound bounds the 1-norm of the error in x and
+         in bx, summed over columns of ad; it is inf if no bound can be established.
+        """
+        w, gamma = self.screening_weights()
+        neglected = [0.0]  # weighted norm of dropped activity
+
+        def _truncate(x, total):
+            x = csc_matrix(x)
+            small = abs(x.data) < drop * abs(total).max()
+            if small.any():
+                neglected[0] += w[x.indices[small]].dot(abs(x.data[small]))
+                x.data[small] = 0
+                x.eliminate_zeros()
+            return x
+
+        total, x, mycount = self._iterate_bg_lci(ad, threshold, count, truncate=_truncate)
+        x = csc_matrix(x)
+        neglected[0] += w[x.indices].dot(abs(x.data))
+        if gamma < 1:
+            bound = neglected[0] / (1.0 - gamma)
+        else:
+            bound = np.inf
+        return ScreeningLci(total, self._b_matrix * total, bound, mycount)
+
+    def screen_lci(self, product_flow, **kwargs):
+        """
+        Screening counterpart to compute_lci: the background portion is computed with screen_bg_lci.
+        :param product_flow:
+        :param kwargs: passed to screen_bg_lci (drop, threshold, count)
+        :return: m x 1 sparse LCI, bound on the 1-norm of its error
+        """
+        ad, bf_tilde = self.lci_demand(product_flow)
+        result = self.screen_bg_lci(ad, **kwargs)
+        if bf_tilde is None:
+            return result.bx, result.error_bound
+        return result.bx + bf_tilde, result.error_bound
+
     def _construct_b_matrix(self):
         """
         b matrix only includes emissions from background + downstream processes.
@@ -308,15 +710,20 @@ class BackgroundEngine(object):
         """
         if self._b_matrix is not None:
             raise ValueError('B matrix already specified!')
-        num_bg = sp.array([[co.emission.index, self.tstack.bg_dict(co.parent.index), co.value]
-                           for co in self._bg_emission])
-        self._b_matrix = self.construct_sparse(num_bg, self.mdim, self.tstack.ndim)
+        bg_dict = self.tstack.bg_dict
+        rows, cols, data = self.triplets(self._bg_emission, lambda co: co.emission.index,
+                                         lambda co: bg_dict(co.parent.index), lambda co: co.value)
+        self._b_matrix = self.construct_typed(rows, cols, data, self.mdim, self.tstack.ndim)
+        self._b_csc = None
 
     def _construct_a_matrix(self):
         ndim = self.tstack.ndim
-        num_bg = sp.array([[self.tstack.bg_dict(i.term.index), self.tstack.bg_dict(i.parent.index), i.value]
-                           for i in self._interior])
-        self._a_matrix = self.construct_sparse(num_bg, ndim, ndim)
+        bg_dict = self.tstack.bg_dict
+        rows, cols, data = self.triplets(self._interior, lambda i: bg_dict(i.term.index),
+                                         lambda i: bg_dict(i.parent.index), lambda i: i.value)
+        self._a_matrix = self.construct_typed(rows, cols, data, ndim, ndim)
+        self._a_csc = None
+        self._lu = None
 
     def foreground_flows(self, search=None, outputs=True):
         for k in self.tstack.foreground_flows(outputs=outputs):
@@ -334,6 +741,38 @@ class BackgroundEngine(object):
                 if bool(re.search(search, str(k), flags=re.IGNORECASE)):
                     yield k
 
+    def background_flow(self, bg_index):
+        """
+        :param bg_index: row / column of A*, or column of B*
+        :return: ProductFlow
+        """
+        return self.tstack.bg_node(bg_index)
+
+    def all_flows(self):
+        """
+        Generator. Yields every product flow in the foreground, then every product flow in the background.
+        :return:
+        """
+        for k in self.foreground_flows(outputs=False):
+            yield k
+        for k in self.background_flows():
+            yield k
+
+    def generate_lci(self, flows=None, skip=None, **kwargs):
+        """
+        Generator. Computes LCIs one product flow at a time, so that only one result is held in memory.
+        :param flows: [None] iterable of ProductFlows; defaults to all_flows()
+        :param skip: [None] collection of ProductFlow keys to omit (e.g. results already stored)
+        :param kwargs: passed to compute_lci
+        :return: yields (ProductFlow, m x 1 sparse LCI)
+        """
+        if flows is None:
+            flows = self.all_flows()
+        for pf in flows:
+            if skip is not None and pf.key in skip:
+                continue
+            yield pf, self.compute_lci(pf, **kwargs)
+
     def foreground_dependencies(self, product_flow):
         for fg in self._foreground:
             if fg.parent.index == product_flow.index:
@@ -375,87 +814,174 @@ class BackgroundEngine(object):
         little archive Foregrounds.  A background database with cutoffs will properly situate the cutoffs in the B
         matrix, where they are treated equivalently.
         """
-        af_exch = []
-        ad_exch = []
-        fg_cutoff = []
         if product_flow is None:
-            pdim = self.tstack.pdim
-
-            def fg_dict(x):
-                return self.tstack.fg_dict(x)
-
-            bf_exch = self._cutoff
             if self.tstack.pdim == 0:
                 return None, None, None
+            return self._foreground_matrices()
+
+        if self.is_background(product_flow):
+            _af = self.construct_sparse([], 1, 1)
+            bg_index = self.tstack.bg_dict(product_flow.index)
+            _ad = self._a_columns()[:, [bg_index]]
+            _bf = self._b_columns()[:, [bg_index]]
+            return _af, _ad, _bf
+
+        cols = [self.tstack.fg_dict(pf.index) for pf in self.foreground(product_flow)]
+        af, ad, bf = self._foreground_matrices()
+        af_cols = af[:, cols]
+        _af = af_cols[cols, :]
+        if _af.nnz < af_cols.nnz:
+            # this should never happen
+            print('Losing %d FG Cutoffs' % (af_cols.nnz - _af.nnz))
+        return _af, ad[:, cols], bf[:, cols]
+
+    def _foreground_matrices(self):
+        """
+        Af, Ad, Bf for the entire foreground, with columns in tstack.fg_dict order.  Built once as csc_matrixes and
+        cached until the component graph changes, so that single fragments are sliced out by column in time
+        proportional to their own nonzeros.
+        :return: af, ad, bf
+        """
+        if self._fg_matrices is None:
+            af_exch = []
+            ad_exch = []
             for fg in self._foreground:
                 if self.is_background(fg.term.index):
                     ad_exch.append(fg)
                 else:
                     af_exch.append(fg)
-        else:
-            if self.is_background(product_flow):
-                _af = self.construct_sparse([], 1, 1)
-                bg_index = self.tstack.bg_dict(product_flow.index)
-                _ad = self._a_matrix[:, bg_index]
-                _bf = self._b_matrix[:, bg_index]
-                return _af, _ad, _bf
+            fg_dict = self.tstack.fg_dict
+            pdim = self.tstack.pdim
+            bg_dict = self.tstack.bg_dict
 
-            product_flows = self.foreground(product_flow)
-            pdim = len(product_flows)
-            bf_exch = []
-            _fg_dict = dict((pf.index, n) for n, pf in enumerate(product_flows))
+            def parent(x):
+                return fg_dict(x.parent.index)
 
-            def fg_dict(x):
-                return _fg_dict[x]
+            def value(x):
+                return x.value
 
-            for fg in self._foreground:
-                if fg.parent.index in _fg_dict:
-                    if self.is_background(fg.term.index):
-                        ad_exch.append(fg)
-                    elif fg.term.index in _fg_dict:
-                        af_exch.append(fg)
-                    else:
-                        fg_cutoff.append(fg)
-            for co in self._cutoff:
-                if co.parent.index in _fg_dict:
-                    bf_exch.append(co)
-
-        num_af = sp.array([[fg_dict(i.term.index), fg_dict(i.parent.index), i.value] for i in af_exch])
-        num_ad = sp.array([[self.tstack.bg_dict(i.term.index), fg_dict(i.parent.index), i.value] for i in ad_exch])
-        num_bf = sp.array([[co.emission.index, fg_dict(co.parent.index), co.value] for co in bf_exch])
-        ndim = self.tstack.ndim
-        _af = self.construct_sparse(num_af, pdim, pdim)
-        _ad = self.construct_sparse(num_ad, ndim, pdim)
-        _bf = self.construct_sparse(num_bf, self.mdim, pdim)
-        if len(fg_cutoff) > 0:
-            for co in fg_cutoff:
-                # this should never happen
-                print('Losing FG Cutoff %s' % co)
-        return _af, _ad, _bf
+            af = self.triplets(af_exch, lambda x: fg_dict(x.term.index), parent, value)
+            ad = self.triplets(ad_exch, lambda x: bg_dict(x.term.index), parent, value)
+            bf = self.triplets(self._cutoff, lambda x: x.emission.index, parent, value)
+            self._fg_matrices = (self.construct_typed(*af, nrows=pdim, ncols=pdim, fmt='csc'),
+                                 self.construct_typed(*ad, nrows=self.tstack.ndim, ncols=pdim, fmt='csc'),
+                                 self.construct_typed(*bf, nrows=self.mdim, ncols=pdim, fmt='csc'))
+        return self._fg_matrices
+
+    def _a_columns(self):
+        """
+        :return: A* as a (cached) csc_matrix, for column extraction
+        """
+        if self._a_csc is None:
+            self._a_csc = csc_matrix(self._a_matrix)
+        return self._a_csc
+
+    def _b_columns(self):
+        """
+        :return: B* as a (cached) csc_matrix, for column extraction
+        """
+        if self._b_csc is None:
+            self._b_csc = csc_matrix(self._b_matrix)
+        return self._b_csc
 
     def _update_component_graph(self):
+        bg_version = self.tstack.bg_version
         self.tstack.add_to_graph(self._interior_incoming)  # background should be brought up to date
+        self._fg_matrices = None
+        if self.tstack.bg_version != bg_version:
+            self._sort_entries()
+
+        new_interior = False
         while len(self._interior_incoming) > 0:
             k = self._interior_incoming.pop()
             k.adjust_val()
             if self.is_background(k.parent.index):
                 self._interior.append(k)
+                new_interior = True
             else:
                 self._foreground.append(k)
 
+        new_emission = False
         while len(self._cutoff_incoming) > 0:
             k = self._cutoff_incoming.pop()
             k.adjust_val()
             if self.is_background(k.parent.index):
                 self._bg_emission.append(k)
+                new_emission = True
             else:
                 self._cutoff.append(k)
 
-        if self._a_matrix is None and self.tstack.background is not None:
+        if self.tstack.background is None:
+            return
+        new_a = self._a_matrix is None or new_interior or self._a_matrix.shape[0] != self.tstack.ndim
+        if new_a:
             self._construct_a_matrix()
+            self._version += 1
+        if self._b_matrix is None or new_emission or self._b_matrix.shape != (self.mdim, self.tstack.ndim):
+            self._b_matrix = None
             self._construct_b_matrix()
+            self._version += 1
+        if new_a and self._ordering is not None:
+            self.reorder_background(self._ordering)
+
+    def reorder_background(self, method='rcm'):
+        """
+        Renumbers the background so that A* has a small bandwidth, for better memory locality in the matrix-vector
+        products of compute_bg_lci.  'rcm' is the reverse Cuthill-McKee ordering of the symmetrized pattern of A*.
+        (splu applies its own fill-reducing column ordering, so no separate ordering is offered for the direct solver.)
+
+        A* and B* are permuted in place and the new numbering is stored in the tstack's background index, so
+        bg_dict / background_flow stay consistent and APIs keyed by product flow are unaffected.  The version is
+        incremented: ForegroundFragments and other results holding background rows computed before the reordering
+        are stale.  Product flows that join the background later are appended after the reordered ones.
+        :param method: ['rcm']
+        :return: the permutation applied: new position i holds the former background position perm[i]
+        """
+        if method not in ORDERINGS:
+            raise ValueError('Unknown ordering %s' % method)
+        if self._a_matrix is None:
+            raise ValueError('Background matrix has not been constructed')
+        from scipy.sparse.csgraph import reverse_cuthill_mckee
+        pattern = csr_matrix(self._a_matrix, copy=True)
+        pattern.data[:] = 1
+        perm = reverse_cuthill_mckee(pattern, symmetric_mode=False)
+        self.tstack.permute_bg_index(perm.tolist())
+        self._a_matrix = csr_matrix(self._a_matrix[perm][:, perm])
+        self._b_matrix = csr_matrix(self._b_matrix[:, perm])
+        self._a_csc = None
+        self._b_csc = None
+        self._lu = None
+        self._fg_matrices = None
+        self._version += 1
+        return perm
+
+    def _sort_entries(self):
+        """
+        Re-partitions already-adjusted entries between background and foreground after the background has changed.
+        Matrices built from the old partition are discarded.
+        """
+        interior = self._interior + self._foreground
+        cutoff = self._bg_emission + self._cutoff
+        self._interior, self._foreground, self._bg_emission, self._cutoff = [], [], [], []
+        for k in interior:
+            if self.is_background(k.parent.index):
+                self._interior.append(k)
+            else:
+                self._foreground.append(k)
+        for k in cutoff:
+            if self.is_background(k.parent.index):
+                self._bg_emission.append(k)
+            else:
+                self._cutoff.append(k)
+        self._a_matrix = None
+        self._b_matrix = None
 
-        # self.make_foreground()
+    @property
+    def version(self):
+        """
+        Incremented every time A* or B* is rebuilt; results computed against an older version may be stale.
+        """
+        return self._version
 
     def add_all_ref_products(self, multi_term='first', default_allocation=None, net_coproducts=True):
         for p in self.fg.processes():
@@ -465,6 +991,28 @@ class BackgroundEngine(object):
                     self._add_ref_product(x.flow, p, multi_term, default_allocation, net_coproducts)
         self._update_component_graph()
 
+    def add_ref_products(self, refs, multi_term='first', default_allocation=None, net_coproducts=True):
+        """
+        Demand-driven construction: traverses only the product systems reachable from the given reference products,
+        and updates the component graph and matrices once at the end.  Product flows that have already been
+        traversed (including everything reachable from earlier requests) are not visited again, so the engine can be
+        extended one batch at a time instead of building the whole archive with add_all_ref_products.
+        :param refs: iterable of (flow, termination) pairs
+        :param multi_term: see add_ref_product
+        :param default_allocation: see add_ref_product
+        :param net_coproducts: see add_ref_product
+        :return: list of ProductFlows, in the order of refs
+        """
+        pfs = []
+        for flow, termination in refs:
+            j = self.check_product_flow(flow, termination)
+            if j is None:
+                j = self._add_ref_product(flow, self.fg[termination.external_ref], multi_term, default_allocation,
+                                          net_coproducts)
+            pfs.append(j)
+        self._update_component_graph()
+        return pfs
+
     def add_ref_product(self, flow, termination, multi_term='first', default_allocation=None, net_coproducts=True):
         """
         Here we are adding a reference product - column of the A + B matrix.  The termination must be supplied.
@@ -577,7 +1125,7 @@ class BackgroundEngine(object):
                 self._set_lowlink(parent, self._lowlink(i))
             elif self.tstack.check_stack(i):
                 # visited and currently on stack - carry back index if lower
-                self._set_lowlink(parent, self.index(i))
+                self._set_lowlink(parent, i.index)
             else:
                 # visited, not on stack- nothing to do
                 pass
@@ -585,8 +1133,8 @@ class BackgroundEngine(object):
             self.add_interior(parent, i, pval)
 
         # name an SCC if we've found one
-        if self._lowlink(parent) == self.index(parent):
-            self.tstack.label_scc(self.index(parent), parent.key)
+        if self._lowlink(parent) == parent.index:
+            self.tstack.label_scc(parent.index)
 
     def add_cutoff(self, parent, emission, val):
         """
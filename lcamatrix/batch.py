@@ -0,0 +1,197 @@
+"""
+Batch LCI computation over many product flows.
+
+The background matrices are read-only once the component graph is built, so a single BackgroundEngine can be shared
+among several workers.  SciPy releases the GIL during sparse matrix-vector products, so a thread pool gives real
+concurrency for background-heavy workloads.  The process pool variant relies on 'fork' so that the child processes
+share the parent's A* and B* pages (copy-on-write) instead of receiving pickled copies of the engine; fork_map
+provides the same arrangement to the other modules that fan work out to processes.  Where 'fork' is unavailable,
+work is done in the calling process instead.
+
+Results are always yielded in the same order as the input product flows, and no more than max_pending results are
+held in memory at any time.
+"""
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+_SHARED = None  # set only in forked worker processes, by _init_worker; see fork_map
+
+
+def _init_worker(shared):
+    global _SHARED
+    _SHARED = shared
+
+
+def _fork_call(args):
+    func, item = args
+    return func(_SHARED, item)
+
+
+def _compute_lci(bg, args):
+    index, kwargs = args
+    return bg.compute_lci(bg.product_flow(index), **kwargs)
+
+
+def ordered_map(func, iterable, executor, max_pending):
+    """
+    Generator. Submits func(item) to the executor for each item in iterable and yields the results in input order.
+    At most max_pending jobs are in flight (or finished but not yet yielded) at any time.
+    :param func:
+    :param iterable:
+    :param executor: a concurrent.futures Executor
+    :param max_pending: bound on the number of outstanding futures
+    :return:
+    """
+    if max_pending < 1:
+        raise ValueError('max_pending must be positive')
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def fork_context():
+    """
+    Returns a 'fork' multiprocessing context, or None if the platform does not support it.
+    :return:
+    """
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+
+def fork_map(func, shared, items, workers, max_pending=None):
+    """
+    Generator. Yields func(shared, item) for each item, in order.  With more than one worker, the calls are made in
+    forked worker processes, which inherit shared from the parent (copy-on-write) instead of receiving a pickled copy;
+    only the items and the results are pickled.  Each call gets its own pool, whose workers are handed shared by the
+    pool initializer, so several fork_map generators can be consumed in interleaved fashion.  If workers is 1 or the
+    platform does not support 'fork', the calls are made serially in this process.
+    :param func: module-level function of (shared, item)
+    :param shared: state needed by every call, e.g. a BackgroundEngine
+    :param items: iterable of picklable arguments
+    :param workers: number of worker processes
+    :param max_pending: [4 * workers] maximum number of results in flight
+    :return:
+    """
+    context = fork_context()
+    if workers <= 1 or context is None:
+        for item in items:
+            yield func(shared, item)
+        return
+    if max_pending is None:
+        max_pending = 4 * workers
+
+    # under 'fork', initargs reach the workers by inheritance rather than pickling
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(shared, )) as ex:
+        for result in ordered_map(_fork_call, ((func, item) for item in items), ex, max_pending):
+            yield result
+
+
+class BatchLci(object):
+    """
+    Fans BackgroundEngine.compute_lci out across a pool of workers.
+    """
+    def __init__(self, bg, workers=None, max_pending=None, processes=False):
+        """
+
+        :param bg: a BackgroundEngine whose component graph is complete
+        :param workers: [None] number of workers; defaults to the number of CPUs
+        :param max_pending: [None] maximum number of results in flight; defaults to 4 * workers
+        :param processes: [False] use forked worker processes instead of threads; threads are used if the platform
+         does not support 'fork'
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if max_pending is None:
+            max_pending = 4 * workers
+        if processes and fork_context() is None:
+            print('fork start method unavailable; using threads')
+            processes = False
+        self._bg = bg
+        self.workers = workers
+        self.max_pending = max_pending
+        self.processes = processes
+
+    def _serial(self, flows, **kwargs):
+        for pf in flows:
+            yield pf, self._bg.compute_lci(pf, **kwargs)
+
+    def _threaded(self, flows, **kwargs):
+        def _lci(pf):
+            return pf, self._bg.compute_lci(pf, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as ex:
+            for k in ordered_map(_lci, flows, ex, self.max_pending):
+                yield k
+
+    def _forked(self, flows, **kwargs):
+        queue = deque()  # product flows matching outstanding jobs, in order
+
+        def _args():
+            for pf in flows:
+                queue.append(pf)
+                yield pf.index, kwargs
+
+        for bx in fork_map(_compute_lci, self._bg, _args(), self.workers, max_pending=self.max_pending):
+            yield queue.popleft(), bx
+
+    def lci(self, flows, **kwargs):
+        """
+        Generator. Computes the LCI of each product flow in flows.
+        :param flows: iterable of ProductFlows known to the background
+        :param kwargs: passed to compute_lci
+        :return: yields (ProductFlow, sparse m x 1 LCI) in the order of flows
+        """
+        if self.workers == 1:
+            return self._serial(flows, **kwargs)
+        if self.processes:
+            return self._forked(flows, **kwargs)
+        return self._threaded(flows, **kwargs)
+
+    def foreground_lci(self, outputs=True, **kwargs):
+        return self.lci(self._bg.foreground_flows(outputs=outputs), **kwargs)
+
+    def background_lci(self, **kwargs):
+        return self.lci(self._bg.background_flows(), **kwargs)
+
+    def benchmark(self, flows, **kwargs):
+        """
+        Times the serial loop against the parallel driver on the same list of product flows.
+        :param flows: iterable of ProductFlows
+        :param kwargs: passed to compute_lci
+        :return: dict with elapsed seconds, throughput (flows per second) and speedup
+        """
+        flows = list(flows)
+        if len(flows) == 0:
+            raise ValueError('No flows to benchmark')
+
+        start = time.time()
+        for _ in self._serial(flows, **kwargs):
+            pass
+        serial = time.time() - start
+
+        start = time.time()
+        for _ in self.lci(flows, **kwargs):
+            pass
+        parallel = time.time() - start
+
+        result = {'flows': len(flows),
+                  'workers': self.workers,
+                  'serial': serial,
+                  'parallel': parallel,
+                  'serial_throughput': len(flows) / serial,
+                  'parallel_throughput': len(flows) / parallel,
+                  'speedup': serial / parallel}
+        print('%d flows: serial %.3f s (%.1f/s); %d workers %.3f s (%.1f/s); speedup %.2fx' % (
+            len(flows), serial, result['serial_throughput'], self.workers, parallel, result['parallel_throughput'],
+            result['speedup']))
+        return result
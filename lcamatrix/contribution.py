@@ -0,0 +1,64 @@
+"""
+Helpers for contribution analysis.  Given the activity vector x and characterization matrix E from a single LCI
+solve, the contribution of background process j to score q is (E B*)[q, j] * x[j], and the contribution of emission k
+is E[q, k] * (B* x)[k].  Both are formed as sparse column scalings of existing products, so no further solves are
+needed.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy.sparse import csr_matrix, diags, issparse
+
+
+Contributions = namedtuple('Contributions', ('scores', 'processes', 'emissions'))
+"""
+scores: t-array of total LCIA scores
+processes: t x n sparse matrix of process contributions (rows sum to scores)
+emissions: t x m sparse matrix of emission contributions (rows sum to scores)
+"""
+
+
+def as_vector(v):
+    """
+    Flatten a sparse or dense column vector to a 1-d array
+    :param v:
+    :return:
+    """
+    if issparse(v):
+        v = v.toarray()
+    return np.asarray(v, dtype=float).reshape(-1)
+
+
+def scale_columns(mat, v):
+    """
+    :param mat: sparse matrix
+    :param v: vector with one entry per column of mat
+    :return: mat * diag(v) as csr_matrix
+    """
+    return csr_matrix(mat * diags(as_vector(v)))
+
+
+def top_k(mat, k):
+    """
+    Retain only the k largest-magnitude entries in each row of a sparse matrix.
+    :param mat: sparse matrix
+    :param k: number of entries to keep per row; None to keep all
+    :return: csr_matrix
+    """
+    mat = csr_matrix(mat)
+    if k is None:
+        return mat
+    mat.eliminate_zeros()
+    rows = []
+    cols = []
+    data = []
+    for i in range(mat.shape[0]):
+        start, end = mat.indptr[i], mat.indptr[i + 1]
+        d = mat.data[start:end]
+        keep = np.argsort(-np.abs(d), kind='stable')[:k]
+        rows.append(np.full(len(keep), i))
+        cols.append(mat.indices[start:end][keep])
+        data.append(d[keep])
+    if len(rows) == 0:
+        return csr_matrix(mat.shape)
+    return csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape=mat.shape)
@@ -1,9 +1,10 @@
 import numpy as np
-from scipy.sparse import vstack
+from scipy.sparse import csc_matrix, identity, vstack
 import uuid
 
 # from lcatools.foreground.report import tex_sanitize
-from lcatools.lcia_results import LciaResult, LciaResults
+
+from lcamatrix.contribution import Contributions, as_vector, scale_columns, top_k as contrib_top_k
 
 
 class ForegroundFragment(object):
@@ -18,22 +19,31 @@ class ForegroundFragment(object):
      bg.mdim - number of emissions
      bg.is_background(pf)
      bg.foreground(pf) - returns an ordered list of indices (w.r.t. p) downstream of the named product flow (inclusive)
-     bg.make_foreground(pf) - returns Af, Ad, Bf (sparse) for product flow
+     bg.make_foreground(pf) - returns Af, Ad, Bf (sparse) for product flow (or for the whole foreground if None)
+     bg.foreground_flows() - generates ProductFlows in the foreground, in the column order of make_foreground(None)
 
      bg.background_flows() - generates ProductFlows in the background
+     bg.background_flow(i) - the ProductFlow in row i of A* (and Ad)
      bg.emissions - m-list of Emission objects
+     bg.elementary_mask(compartments) - m-array of bool, True for elementary emissions
      bg.construct_sparse(entries, nrows, ncols) - where entries is [[row index, colum index, data]..] - static
+     bg.construct_typed(rows, cols, data, nrows, ncols) - from int32 row/column and float64 data arrays - static
 
     for LCIA:
      bg.compute_bg_lci(ad) - iteratively calculate x, bx for n-dim input vector ad
      bg.compute_lci(pf) - calculate x, bx, bf_tilde for product flow pf
+     bg.solve_bg_lci(ad) - x, bx by direct solution for an n x k background demand
+     bg.bg_unit_scores(e) - t x n LCIA scores of unit background outputs (adjoint solve)
+     bg.compute_bg_contributions(ad, e) - process and emission contributions for n-dim input vector ad
     """
     def __init__(self, bg, flowdb, product_flow):
         """
         instantiates a foreground fragment
         :param bg: a background manager
         :param flowdb: required for compartments and for characterization
-        :param product_flow: a ProductFlow known to the background
+        :param product_flow: a ProductFlow known to the background, or None for the whole foreground, in which case
+         each foreground node (column of Af) is a possible reference and the *_all methods give results for all of
+         them at once
         """
 
         self._bg = bg
@@ -43,13 +53,22 @@ class ForegroundFragment(object):
         self._lcia = []  # array of sparse e vectors
         self._qs = []  # array quantities corresponding to rows in lcia
 
-        if bg.is_background(product_flow):
+        if product_flow is None:
+            self._foreground = [k for k in bg.foreground_flows(outputs=False)]
+            if len(self._foreground) == 0:
+                raise ValueError('Background has no foreground')
+        elif bg.is_background(product_flow):
             self._foreground = [product_flow]
         else:
             self._foreground = bg.foreground(product_flow)
         self._af, self._ad, self._bf = bg.make_foreground(product_flow)
+        self._lu = None  # cached factorization of (I - Af)
+        self._x_all = None  # cached (I - Af)^-1
+        self._bx_all = None  # cached background LCI for every foreground node
 
-        self._is_elem = np.array([self._db.compartments.is_elementary(f.flow) for f in self.emissions])
+        self._is_elem = bg.elementary_mask(self._db.compartments)
+        self._bf_elementary = None  # cached row slices of Bf
+        self._bf_cutoff = None
 
         self._bx = None  # cached background LCI
 
@@ -61,6 +80,13 @@ class ForegroundFragment(object):
     def uuid(self):
         return str(self._uuid)
 
+    @property
+    def bg_version(self):
+        """
+        Version of the background engine; results indexed by background position are stale once it changes
+        """
+        return self._bg.version
+
     @property
     def foreground(self):
         return self._foreground
@@ -87,6 +113,20 @@ class ForegroundFragment(object):
         for k in self._bg.emissions:
             yield k
 
+    def bg_flow(self, i):
+        """
+        :param i: row of Ad
+        :return: ProductFlow
+        """
+        return self._bg.background_flow(i)
+
+    def emission(self, i):
+        """
+        :param i: row of Bf
+        :return: Emission
+        """
+        return self._bg.emissions[i]
+
     @property
     def elementary(self):
         for i, k in enumerate(self._bg.emissions):
@@ -165,22 +205,57 @@ class ForegroundFragment(object):
 
     @property
     def Bf_cutoff(self):
-        return self._bf[~self._is_elem]
+        if self._bf_cutoff is None:
+            self._bf_cutoff = self._bf[~self._is_elem]
+        return self._bf_cutoff
 
     @property
     def Bf_elementary(self):
-        return self._bf[self._is_elem]
+        if self._bf_elementary is None:
+            self._bf_elementary = self._bf[self._is_elem]
+        return self._bf_elementary
+
+    def _factorize(self):
+        if self._lu is None:
+            from scipy.sparse.linalg import splu
+            self._lu = splu(csc_matrix(identity(self.pdim, format='csc') - self._af))
+        return self._lu
 
     def x_tilde(self, node=0):
         if self._foreground is None:
             return np.matrix([[1]])
-        return np.linalg.inv(np.eye(self._af.shape[0]) - self._af.todense())[:, node]
+        if self._x_all is not None:
+            return np.matrix(self._x_all[:, [node]])
+        unit = np.zeros((self.pdim, 1))
+        unit[node] = 1.0
+        return np.matrix(self._factorize().solve(unit))
+
+    def x_tilde_all(self):
+        """
+        Foreground activity levels for a unit output of every foreground node, from one factorization of (I - Af).
+        :return: p x p dense array; column j is x_tilde(j)
+        """
+        if self._x_all is None:
+            self._x_all = self._factorize().solve(np.eye(self.pdim))
+        return self._x_all
+
+    def ad_tilde_all(self):
+        """
+        :return: n x p dense array; column j is ad_tilde(j)
+        """
+        return np.asarray(self._ad * self.x_tilde_all())
+
+    def bf_tilde_all(self):
+        """
+        :return: m x p dense array; column j is bf_tilde(j)
+        """
+        return np.asarray(self._bf * self.x_tilde_all())
 
     def ad_tilde(self, node=0):
-        return self._ad.todense() * self.x_tilde(node)
+        return self._ad * self.x_tilde(node)
 
     def bf_tilde(self, node=0):
-        return self._bf.todense() * self.x_tilde(node)
+        return self._bf * self.x_tilde(node)
 
     @property
     def E(self):
@@ -200,16 +275,20 @@ class ForegroundFragment(object):
             return
         if quantity in self._qs:
             return
-        nums = []
+        cols = []
+        data = []
         for m, em in enumerate(self._bg.emissions):
             if em.flow.has_characterization(quantity):
-                nums.append((0, m, em.flow.cf(quantity)))
+                cols.append(m)
+                data.append(em.flow.cf(quantity))
             else:
                 cf = self._db.lookup_single_cf(em.flow, quantity)
                 if cf is not None:
                     em.flow.add_characterization(cf)
-                    nums.append((0, m, cf.value))
-        e = self._bg.construct_sparse(np.array(nums), 1, self.mdim)
+                    cols.append(m)
+                    data.append(cf.value)
+        e = self._bg.construct_typed(np.zeros(len(cols), dtype=np.int32), np.array(cols, dtype=np.int32),
+                                     np.array(data, dtype=np.float64), 1, self.mdim)
         self._lcia.append(e)
         self._qs.append(quantity)
 
@@ -224,6 +303,7 @@ class ForegroundFragment(object):
         :param kwargs:
         :return: LciaResults
         """
+        from lcatools.lcia_results import LciaResult, LciaResults
         if lci is None:
             lci = self._bg.lci(self.product_flow, **kwargs)
         l = LciaResults(self.product_flow)
@@ -248,6 +328,59 @@ class ForegroundFragment(object):
             self._bx = bx
         return self.compute_lcia(self._bx)
 
+    def bg_lci_all(self):
+        """
+        Background LCI for a unit output of every foreground node, pushing all ad_tilde columns through a single
+        multi-column solve against the background factorization.
+        :return: m x p sparse matrix; column j is the background LCI of node j
+        """
+        if self._bx_all is None:
+            _, self._bx_all = self._bg.solve_bg_lci(self.ad_tilde_all())
+        return self._bx_all
+
+    def fg_lcia_all(self):
+        """
+        :return: t x p array of foreground LCIA scores for a unit output of each foreground node
+        """
+        if self.tdim == 0:
+            return np.zeros((0, self.pdim))
+        return np.asarray(self.E * self.bf_tilde_all())
+
+    def bg_lcia_all(self):
+        """
+        :return: t x p array of background LCIA scores for a unit output of each foreground node
+        """
+        if self.tdim == 0:
+            return np.zeros((0, self.pdim))
+        return (self.E * self.bg_lci_all()).toarray()
+
+    def lcia_all(self):
+        return self.fg_lcia_all() + self.bg_lcia_all()
+
     def pf_lcia(self, pf):
         bx = self._bg.compute_lci(pf)
         return self.compute_lcia(bx)
+
+    def bg_unit_scores(self):
+        """
+        LCIA scores for a unit output of every background flow, from one adjoint solve.
+        :return: t x n dense array; column i corresponds to the ith entry in bg_flows
+        """
+        return self._bg.bg_unit_scores(self.E)
+
+    def contributions(self, top_k=None, node=0):
+        """
+        Contribution analysis for the fragment from a single background solve.
+        :param top_k: [None] keep only the k largest-magnitude contributions per LCIA method
+        :param node: [0] foreground node whose unit output is the functional unit
+        :return: fg, bg: Contributions for the foreground (processes are the p foreground nodes) and for the
+         background (processes are the n background flows).  Total scores are fg.scores + bg.scores.
+        """
+        e = self.E
+        x_tilde = self.x_tilde(node)
+        bf_tilde = self._bf * x_tilde
+        fg = Contributions(as_vector(e * bf_tilde),
+                           contrib_top_k(scale_columns(e * self._bf, x_tilde), top_k),
+                           contrib_top_k(scale_columns(e, bf_tilde), top_k))
+        bg = self._bg.compute_bg_contributions(self._ad * x_tilde, e, top_k=top_k)
+        return fg, bg
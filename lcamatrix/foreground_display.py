@@ -1,36 +1,84 @@
-import pandas as pd
+import numpy as np
+from scipy.sparse import csr_matrix
 
 from lcamatrix.foreground import ForegroundFragment
+from lcamatrix.contribution import as_vector
+
+
+def _pd():
+    """
+    pandas, imported on first use
+    """
+    import pandas
+    return pandas
+
 
 class DisplayFragment(ForegroundFragment):
     """
-    Uses Pandas for attractive display and functional manipulation of foreground matrices
+    Uses Pandas for attractive display and functional manipulation of foreground matrices.  Pandas is imported on
+    first display, so importing this module does not pull it in.
+
+    The Ad, Bf and E views show only nonzero rows.  These are selected from the sparse matrix before any DataFrame is
+    built, so neither the dense matrix nor the full list of row labels is ever materialized.  Pass sparse=True to get
+    a DataFrame with pandas sparse columns instead of dense ones.
     """
     @staticmethod
-    def _show_nonzero_rows(dataframe):
-        return dataframe.loc[~(dataframe == 0).all(axis=1)]
+    def _nonzero_rows(mat):
+        """
+        :param mat: sparse matrix
+        :return: csr_matrix, sorted array of indices of its rows that contain nonzero entries
+        """
+        mat = csr_matrix(mat)
+        mat.eliminate_zeros()
+        return mat, np.flatnonzero(np.diff(mat.indptr))
+
+    @classmethod
+    def _show_nonzero_rows(cls, mat, label, columns=None, sparse=False):
+        """
+        :param mat: sparse matrix
+        :param label: function mapping a row index to its row label
+        :param columns: column labels
+        :param sparse: [False] whether to return a DataFrame with sparse columns
+        :return: DataFrame of the nonzero rows of mat
+        """
+        pd = _pd()
+        mat, rows = cls._nonzero_rows(mat)
+        index = [label(i) for i in rows]
+        if sparse:
+            # built column by column with an explicit zero fill: DataFrame.sparse.from_spmatrix fills with NaN
+            # under some pandas versions
+            mat = mat[rows].tocsc()
+            frame = pd.DataFrame(dict((j, pd.arrays.SparseArray(mat[:, j].toarray().ravel(), fill_value=0.0))
+                                      for j in range(mat.shape[1])), index=index)
+            if columns is not None:
+                frame.columns = columns
+            return frame
+        return pd.DataFrame(mat[rows].toarray(), index=index, columns=columns)
+
+    @staticmethod
+    def _show_nonzero_entries(vec, label):
+        vec = as_vector(vec)
+        rows = np.flatnonzero(vec)
+        return _pd().DataFrame(vec[rows], index=[label(i) for i in rows])
 
     def show_Af(self):
-        return pd.DataFrame(self._af.todense(), index=[k for k in self._foreground])
+        return _pd().DataFrame(self._af.todense(), index=[k for k in self._foreground])
 
-    def show_Ad(self):
-        ad = pd.DataFrame(self.Ad.todense(), index=[k for k in self.bg_flows],
-                          columns=[l.process for l in self._foreground])
-        return self._show_nonzero_rows(ad)
+    def show_Ad(self, sparse=False):
+        return self._show_nonzero_rows(self.Ad, self.bg_flow, columns=[l.process for l in self._foreground],
+                                       sparse=sparse)
 
-    def show_Bf(self):
-        bf = pd.DataFrame(self.Bf.todense(), index=[k for k in self.emissions],
-                          columns=[l.process for l in self._foreground])
-        return self._show_nonzero_rows(bf)
+    def show_Bf(self, sparse=False):
+        return self._show_nonzero_rows(self.Bf, self.emission, columns=[l.process for l in self._foreground],
+                                       sparse=sparse)
 
     def show_ad_tilde(self, node=0):
-        adt = pd.DataFrame(self.ad_tilde(node), index=[k for k in self.bg_flows])
-        return self._show_nonzero_rows(adt)
+        return self._show_nonzero_entries(self.ad_tilde(node), self.bg_flow)
 
     def show_bf_tilde(self, node=0):
-        bft = pd.DataFrame(self.bf_tilde(node), index=self.emissions)
-        return self._show_nonzero_rows(bft)
+        return self._show_nonzero_entries(self.bf_tilde(node), self.emission)
 
-    def show_E(self):
-        e = pd.DataFrame(self.E.T.todense(), index=self.emissions, columns=self._qs)
-        return self._show_nonzero_rows(e)
+    def show_E(self, sparse=False):
+        if self.tdim == 0:
+            return _pd().DataFrame()
+        return self._show_nonzero_rows(self.E.T, self.emission, columns=self._qs, sparse=sparse)
@@ -1,16 +1,87 @@
-import xlwt
+import multiprocessing
+import numpy as np
 from math import ceil, log10
-from collections import defaultdict
 
 from lcamatrix.product_flow import ProductFlow
+from lcamatrix.publication_writers import create_writer
+from lcamatrix.batch import fork_map
+
+
+MATRIX_CHUNK = 65536  # nonzero entries written per block in sparse matrix sheets
+
+
+def _publish(shared, index):
+    publications, filenames, full, fmt = shared
+    publications[index].publish(filenames[index], full=full, fmt=fmt)
+    return filenames[index]
+
+
+class PublicationContext(object):
+    """
+    Background-wide state shared among the publications of fragments drawn from the same background: the ordered
+    background flows and emissions, the entity maps keyed on them, and the unit LCIA scores of every background flow.
+    """
+    def __init__(self, fragment):
+        self.bg_flows = list(fragment.bg_flows)
+        self.emissions = list(fragment.emissions)
+        self.ad_idx = dict((ad, n) for n, ad in enumerate(self.bg_flows))  # maps entity to Ad row
+        self.bf_idx = dict((bf, n) for n, bf in enumerate(self.emissions))  # maps entity to Bf row
+        self._key = None  # (background version, LCIA methods) of the cached unit scores
+        self._unit_scores = None
+
+    def unit_scores(self, fragment):
+        """
+        t x n unit scores of background flows; computed by one adjoint solve and reused for as long as fragments
+        share the same LCIA methods and the background version is unchanged (a rebuild or reordering renumbers the
+        columns).  Because the solve covers every background flow, the union of all fragments' background
+        dependencies is served by the same result.
+        :param fragment:
+        :return: np.matrix
+        """
+        key = (fragment.bg_version, tuple(fragment.lcia_methods))
+        if self._unit_scores is None or key != self._key:
+            self._unit_scores = np.matrix(fragment.bg_unit_scores())
+            self._key = key
+        return self._unit_scores
+
+
+def publish_fragments(fragments, filenames, full=False, fmt=None, workers=None, **kwargs):
+    """
+    Publish several fragments of the same background.  Entity maps and background unit scores are computed once and
+    shared; the workbooks are then written in parallel by forked worker processes.
+    :param fragments: list of ForegroundFragments sharing one background
+    :param filenames: list of output filenames, parallel to fragments
+    :param full: [False] passed to publish()
+    :param fmt: [None] passed to publish()
+    :param workers: [None] number of worker processes; defaults to the number of CPUs.  1 writes serially.
+    :param kwargs: passed to ForegroundPublication (detail, lcia, private, audit_cf)
+    :return: list of filenames written
+    """
+    fragments = list(fragments)
+    filenames = list(filenames)
+    if len(fragments) != len(filenames):
+        raise ValueError('Need one filename per fragment')
+    if len(fragments) == 0:
+        return []
+    context = PublicationContext(fragments[0])
+    publications = [ForegroundPublication(f, context=context, **kwargs) for f in fragments]
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(publications))
+    shared = (publications, filenames, full, fmt)
+    return list(fork_map(_publish, shared, range(len(publications)), workers))
 
 
 class ForegroundPublication(object):
     """
     Create an XLS document reporting the contents of the foreground fragment.  For Kuczenski (2017) JIE
+    The document can also be written as a constant-memory XLSX workbook or as a directory of CSV files; see
+    publication_writers.
 
     The main payload is a ForegroundFragment, which must support the following interface:
      fragment.uuid - uuid of ForegroundFragment- to represent its reference flow
+     fragment.bg_version - version of the background, for the shared unit scores in PublicationContext
 
      fragment.mdim - size of emissions
      fragment.pdim - size of foreground
@@ -33,18 +104,17 @@ class ForegroundPublication(object):
      fragment.fg_lcia() - returns E * bf_tilde
      fragment.bg_lcia() - returns E * bx
      fragment.pf_lcia(product_flow) - returns E * b for specified product flow
+     fragment.bg_unit_scores() - t x n array of E * b for every background flow
 
     """
-    def _create_xls(self):
-        self._x = xlwt.Workbook()
-        self._wid = defaultdict(int)
+    def _create_xls(self, filename, fmt=None):
+        self._x = create_writer(filename, fmt=fmt)
 
-    def _save_xls(self, filename):
-        for k, val in self._wid.items():
-            self._x.get_sheet(k[0]).col(k[1]).width = (val + 2) * 256
-        self._x.save(filename)
+    def _save_xls(self):
+        self._x.close()
+        self._x = None
 
-    def __init__(self, fragment, detail=True, lcia=True, private=None, audit_cf=False):
+    def __init__(self, fragment, detail=True, lcia=True, private=None, audit_cf=False, context=None):
         """
 
         :param fragment: ForegroundFragment
@@ -54,7 +124,11 @@ class ForegroundPublication(object):
           for dependencies; TODO: test; implement for foreground flows)
         :param audit_cf: [False] if True, include all nonzero characterization factors; if False, include only factors
           for flows that appear in the foreground.
+        :param context: [None] a PublicationContext shared with other fragments of the same background
         """
+        if context is None:
+            context = PublicationContext(fragment)
+        self._context = context
         self._detail = detail
         self._lcia = lcia and fragment.tdim > 0
         self._uuid = fragment.uuid
@@ -64,15 +138,14 @@ class ForegroundPublication(object):
         self._bf = fragment.Bf.tocoo()
         self._xtilde = fragment.x_tilde()
 
-        self._x = None  # storage spot for workbook in progress
-        self._wid = None
+        self._x = None  # storage spot for workbook writer in progress
 
         self._lm = fragment.lcia_methods
         self._ff = fragment.foreground
 
         self._ff_idx = dict((ff, n) for n, ff in enumerate(self._ff))  # maps entity to Af row/column
-        self._ad_idx = dict((ad, n) for n, ad in enumerate(fragment.bg_flows))  # maps entity to Ad row
-        self._bf_idx = dict((bf, n) for n, bf in enumerate(fragment.emissions))  # maps entity to Bf row
+        self._ad_idx = context.ad_idx  # maps entity to Ad row
+        self._bf_idx = context.bf_idx  # maps entity to Bf row
 
         self._ff_len = ceil(log10(len(self._ff_idx)))
         self._ad_len = ceil(log10(len(self._ad_idx)))
@@ -94,10 +167,11 @@ class ForegroundPublication(object):
 
         ad_tilde = self._ad * self._xtilde
         bf_tilde = self._bf * self._xtilde
+        bf_nz = np.flatnonzero(np.asarray(bf_tilde))
 
-        self._ad_seen = [k for i, k in enumerate(fragment.bg_flows) if ad_tilde[i] != 0 and i not in self._private]
-        self._bf_seen = [k for i, k in enumerate(fragment.emissions) if bf_tilde[i] != 0 and fragment.is_elem[i]]
-        self._co_seen = [k for i, k in enumerate(fragment.emissions) if bf_tilde[i] != 0 and not fragment.is_elem[i]]
+        self._ad_seen = [context.bg_flows[i] for i in np.flatnonzero(np.asarray(ad_tilde)) if i not in self._private]
+        self._bf_seen = [context.emissions[i] for i in bf_nz if fragment.is_elem[i]]
+        self._co_seen = [context.emissions[i] for i in bf_nz if not fragment.is_elem[i]]
 
         self._scores = dict()
         self._e = None
@@ -106,7 +180,7 @@ class ForegroundPublication(object):
         if self._lcia:
             if audit_cf:
                 self._e = fragment.E.tocoo()
-                self._bf_seen = [k for i, k in enumerate(fragment.emissions) if
+                self._bf_seen = [k for i, k in enumerate(context.emissions) if
                                  (bf_tilde[i] != 0 and fragment.is_elem[i]) or
                                  fragment.E[:, i].count_nonzero() > 0]
                 self._e_col_key = self._bf_key
@@ -152,27 +226,29 @@ class ForegroundPublication(object):
         s_tilde = sf_tilde + sx_tilde
         sx_tilde = sx_priv + [AD#####' * ad_tilde]  where * indicates dot product
 
+        sx_tilde is computed from the same unit scores (one direct adjoint solve) as the AD##### entries, so the
+        published components add up to the totals to within rounding.
         :param fragment: the ForegroundFragment, which has the LCIA engine
         :return:
         """
         if self._lcia is False:
             return
+        ad_tilde = self._ad * self._xtilde
+        unit_scores = self._context.unit_scores(fragment)
         self._scores['sf_tilde'] = fragment.fg_lcia()
-        self._scores['sx_tilde'] = fragment.bg_lcia().todense()
+        self._scores['sx_tilde'] = unit_scores * ad_tilde
 
         sx_priv = None
-        ad_tilde = self._ad * self._xtilde
-        for i, k in enumerate(fragment.bg_flows):
-            if i in self._private:
-                _priv = (fragment.pf_lcia(k) * ad_tilde[i]).todense()
-                if sx_priv is None:
-                    sx_priv = _priv
-                else:
-                    sx_priv += _priv
-                print('x')
-            elif k in self._ad_seen:
-                self._scores[self.key(k)] = fragment.pf_lcia(k).todense()
-                print(self.key(k))
+        for i in self._private:
+            _priv = unit_scores[:, i] * ad_tilde[i]
+            if sx_priv is None:
+                sx_priv = _priv
+            else:
+                sx_priv += _priv
+            print('x')
+        for k in self._ad_seen:
+            self._scores[self.key(k)] = unit_scores[:, self._ad_idx[k]]
+            print(self.key(k))
         self._scores['sx_priv'] = sx_priv
         self._scores['s_tilde'] = self._scores['sx_tilde'] + self._scores['sf_tilde']
 
@@ -213,12 +289,15 @@ class ForegroundPublication(object):
             return (self.key(bf), bf.flow.origin, bf.flow.external_ref, bf.flow.unit(), bf.flow['Name'],
                     bf.direction, '; '.join(filter(None, bf.compartment)))
 
-    def publish(self, filename, full=False):
+    def publish(self, filename, full=False, fmt=None):
         """
         Write the workbook
+        :param filename: output file; a directory for CSV output
+        :param full: [False] write matrices in full (dense row) format instead of sparse (row, col, data) triplets
+        :param fmt: [None] 'xls', 'xlsx' or 'csv'; inferred from the filename extension if omitted
         :return:
         """
-        self._create_xls()
+        self._create_xls(filename, fmt=fmt)
         self._write_entity_map()
         if self._lcia:
             self._write_lcia()
@@ -246,17 +325,21 @@ class ForegroundPublication(object):
             self._write_matrix('Bf', 'Emission', 'ForegroundNode', self._bf_key, self._ff_key, self._bf, full=full)
         self._write_vector('bf_tilde', 'Emission', self._bf_key, self._bf * self._xtilde)
 
-        self._save_xls(filename)
-
-    def _update_width(self, col, data):
-        self._wid[col] = max(self._wid[col], len(str(data)))
+        self._save_xls()
 
     def _write_row(self, sheet, row, data):
-        for i, d in enumerate(data):
-            sheet.write(row, i, d)
-            self._update_width((sheet.get_name(), i), d)
-        row += 1
-        return row
+        return self._x.write_row(sheet, row, data)
+
+    @staticmethod
+    def _keys(key, indices):
+        """
+        Vectorized key lookup: calls key() once per distinct index
+        :param key: function mapping an index to a key string
+        :param indices: integer array
+        :return: array of key strings, parallel to indices
+        """
+        uniq, inv = np.unique(indices, return_inverse=True)
+        return np.array([key(int(i)) for i in uniq], dtype=str)[inv]
 
     def _write_block(self, sheet, row, ite, printer):
         row = self._write_row(sheet, row, printer())
@@ -294,7 +377,8 @@ class ForegroundPublication(object):
         row = self._write_row(scores, 0, ('LciaMethod', ) + tuple(self.key(l) for l in self._lm) + ('comment', ))
 
         def _write_score_line(r, key, comment):
-            return self._write_row(scores, r, [key] + [float(k) for k in self._scores[key]] + [comment])
+            values = [float(k) for k in np.asarray(self._scores[key]).ravel()]
+            return self._write_row(scores, r, [key] + values + [comment])
 
         row = _write_score_line(row, 's_tilde', 'Total LCIA Score')
         row = _write_score_line(row, 'sf_tilde', 'Foreground LCIA')
@@ -307,9 +391,9 @@ class ForegroundPublication(object):
     def _write_vector(self, sheetname, name, key, array):
         sheet = self._x.add_sheet(sheetname)
         row = self._write_row(sheet, 0, (name, 'Data'))
-        for i, k in enumerate(array):
-            if k != 0:
-                row = self._write_row(sheet, row, (key(i), float(k)))
+        array = np.asarray(array, dtype=float).reshape(-1)
+        nz = np.flatnonzero(array)
+        self._x.write_columns(sheet, row, (self._keys(key, nz), array[nz]))
 
     def _write_matrix(self, sheetname, rowname, colname, rowkey, colkey, coo, full=False):
         """
@@ -325,24 +409,23 @@ class ForegroundPublication(object):
         """
         sheet = self._x.add_sheet(sheetname)
         if full:
-            dense = coo.todense()
-            row = self._write_row(sheet, 0, [''] + [colkey(i) for i in range(dense.shape[1])])
-            for i, data in enumerate(dense):
-                if data.any():
-                    rowdat = [rowkey(i)]
-                    for elem in data.T:
-                        if elem == 0.0:
-                            rowdat.append('')
-                        else:
-                            rowdat.append(float(elem))
-                    row = self._write_row(sheet, row, rowdat)
+            # walk CSR row pointers: empty rows are skipped and only nonzero cells are written
+            csr = coo.tocsr()
+            csr.sum_duplicates()
+            csr.eliminate_zeros()
+            row = self._write_row(sheet, 0, [''] + [colkey(i) for i in range(csr.shape[1])])
+            for i in np.flatnonzero(np.diff(csr.indptr)):
+                start, end = csr.indptr[i], csr.indptr[i + 1]
+                row = self._x.write_cells(sheet, row, [0] + (csr.indices[start:end] + 1).tolist(),
+                                          [rowkey(int(i))] + csr.data[start:end].astype(float).tolist(),
+                                          ncols=csr.shape[1] + 1)
         else:
             row = self._write_row(sheet, 0, (rowname, colname, 'Data'))
-            rows = coo.row
-            cols = coo.col
-            data = coo.data
-            for i, k in enumerate(data):
-                row = self._write_row(sheet, row, (rowkey(rows[i]), colkey(cols[i]), float(k)))
+            for start in range(0, coo.nnz, MATRIX_CHUNK):
+                end = start + MATRIX_CHUNK
+                row = self._x.write_columns(sheet, row, (self._keys(rowkey, coo.row[start:end]),
+                                                         self._keys(colkey, coo.col[start:end]),
+                                                         coo.data[start:end].astype(float)))
 
 
 '''
@@ -1,6 +1,15 @@
+import io
 import re
+import multiprocessing
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from lcamatrix.foreground import ForegroundFragment
+from lcamatrix.batch import fork_map
 
 TAB_LF = '\\\\ \n'
+REPORT_BUFFER = 1 << 20  # write buffer for report files
 
 
 def tex_sanitize(tex):
@@ -11,11 +20,26 @@ def tex_sanitize(tex):
 
 
 class ForegroundTeX(object):
+    """
+    Renders a ForegroundFragment as a LaTeX tabularx table.  The aggregated vectors x_tilde, ad_tilde and bf_tilde
+    are computed once per fragment; dependency matrices are read row by row from their CSR structure and never
+    densified.  Tables are assembled from lists of string parts rather than by repeated concatenation.
+    """
     def __init__(self, fragment, max_cols=8):
         self._f = fragment
         self._pf = fragment.product_flow
         self.max_cols = max_cols
 
+        self._xtilde = np.asarray(fragment.x_tilde(), dtype=float).reshape(-1)
+        self._ad = csr_matrix(fragment.Ad)
+        self._bf_elem = csr_matrix(fragment.Bf_elementary)
+        self._bf_cutoff = csr_matrix(fragment.Bf_cutoff)
+        self._ad_tilde = self._ad.dot(self._xtilde)
+        self._elem_tilde = self._bf_elem.dot(self._xtilde)
+        self._cutoff_tilde = self._bf_cutoff.dot(self._xtilde)
+        self._elem_idx = np.flatnonzero(fragment.is_elem)
+        self._cutoff_idx = np.flatnonzero(~fragment.is_elem)
+
     @property
     def pdim(self):
         return self._f.pdim
@@ -29,19 +53,19 @@ class ForegroundTeX(object):
         """
         # begin table
         if section:
-            table = '\\subsection{%s}\n%s\n\n' % (tex_sanitize(self._pf.flow['Name']),
-                                                  tex_sanitize('; '.join(self._pf.flow['Compartment'])))
-            table += '{\small from %s}\n' % tex_sanitize(str(self._pf.process))
+            table = ['\\subsection{%s}\n%s\n\n' % (tex_sanitize(self._pf.flow['Name']),
+                                                   tex_sanitize('; '.join(self._pf.flow['Compartment']))),
+                     '{\\small from %s}\n' % tex_sanitize(str(self._pf.process))]
         else:
-            table = '%s\n\n' % tex_sanitize(str(self._pf.process))
+            table = ['%s\n\n' % tex_sanitize(str(self._pf.process))]
 
         fg_cols = min(self.max_cols + 1, self.pdim)
-        table += '\n{\\scriptsize\\sffamily\n\\begin{tabularx}{\\textwidth}{|>{\hangindent=3ex}X|%s|' % (
-            'c@{~}' * fg_cols)
+        table.append('\n{\\scriptsize\\sffamily\n\\begin{tabularx}{\\textwidth}{|>{\\hangindent=3ex}X|%s|' % (
+            'c@{~}' * fg_cols))
         if aggregate:
-            table += 'c|'
-        table += '}\n\\hline\n'
-        return table
+            table.append('c|')
+        table.append('}\n\\hline\n')
+        return ''.join(table)
 
     @staticmethod
     def _table_end():
@@ -54,26 +78,26 @@ class ForegroundTeX(object):
         :param aggregate:
         :return:
         """
-        table = title + ' \\rule[-3pt]{0pt}{12pt}'
+        table = [title, ' \\rule[-3pt]{0pt}{12pt}']
         for i in range(self.pdim):
             if i >= self.max_cols:
-                table += ' & $\\ldots$'
+                table.append(' & $\\ldots$')
                 break
-            table += ' & %d' % i
+            table.append(' & %d' % i)
         if aggregate is not None:
-            table += ' & %s' % aggregate
-        table += TAB_LF
-        table += '\\hline\n'
-        return table
+            table.append(' & %s' % aggregate)
+        table.append(TAB_LF)
+        table.append('\\hline\n')
+        return ''.join(table)
 
     def _table_ellipsis(self, num):
-        table = '$\ldots$ (%d rows omitted)' % num
+        table = ['$\\ldots$ (%d rows omitted)' % num]
         for i in range(self.pdim):
-            table += ' & '
+            table.append(' & ')
             if i >= self.max_cols:
                 break
-        table += TAB_LF
-        return table
+        table.append(TAB_LF)
+        return ''.join(table)
 
     def _af_table(self, aggregate):
         # foreground heading
@@ -81,79 +105,79 @@ class ForegroundTeX(object):
             agg_string = ''
         else:
             agg_string = None
-        table = self._table_header('(node) Foreground flow', aggregate=agg_string)
-        xtilde = self._f.x_tilde()
-        af = self._f.Af.todense().tolist()
+        table = [self._table_header('(node) Foreground flow', aggregate=agg_string)]
+        xtilde = self._xtilde
+        af = self._f.Af.toarray().tolist()  # p x p, and p is bounded by max_rows
         for row, fg in enumerate(self._f.foreground):
-            table += tex_sanitize('(%d) %s' % (row, fg.table_label()))
+            table.append(tex_sanitize('(%d) %s' % (row, fg.table_label())))
             if row >= self.max_cols:
                 agg_add = ' & %4.3g' % xtilde[row]
             else:
                 agg_add = ' & '
             for i, val in enumerate(af[row]):
-                value = '%4.3g' % val
                 if i >= self.max_cols:
-                    table += ' & $\\ldots$'
+                    table.append(' & $\\ldots$')
                     break
                 elif i == row:
-                    table += ' & \\refbox '
+                    table.append(' & \\refbox ')
                 elif val != 0:
-                    table += ' & %s' % value
+                    table.append(' & %4.3g' % val)
                 else:
-                    table += ' & '
+                    table.append(' & ')
             if aggregate:
-                table += agg_add
-            table += TAB_LF
-        table += '\\hline\n'
+                table.append(agg_add)
+            table.append(TAB_LF)
+        table.append('\\hline\n')
 
-        return table
+        return ''.join(table)
 
     def _x_tilde_table(self):
-        xtilde = self._f.x_tilde()
-        table = 'Foreground Node Weights $\\tilde{x}$'
-        for i, rows in enumerate(xtilde):
+        table = ['Foreground Node Weights $\\tilde{x}$']
+        for i, rows in enumerate(self._xtilde):
             if i >= self.max_cols:
-                table += ' & $\\ldots$'
+                table.append(' & $\\ldots$')
                 break
-            table += ' & %4.3g' % rows
-        table += '& '
-        table += TAB_LF
-        table += '\\hline\n'
-        return table
+            table.append(' & %4.3g' % rows)
+        table.append('& ')
+        table.append(TAB_LF)
+        table.append('\\hline\n')
+        return ''.join(table)
 
-    def _do_dep_table(self, rows, data, do_agg, max_rows):
+    def _do_dep_table(self, entity, data, agg, do_agg, max_rows):
         """
-        :param rows: rows generator
-        :param data: sparse data table whose rows map to rows
+        :param entity: function mapping a row number of data to its entity
+        :param data: sparse (CSR) data table
+        :param agg: dense aggregation vector, data * x_tilde
         :param do_agg: whether to include the aggregation column
         :param max_rows: max number of rows to print
         :return: table text
         """
         num_rows = 0
-        table = ''
-        agg = data * self._f.x_tilde()
-        num_nonzero = len(agg.nonzero()[0])
-        for row, entity in enumerate(rows):
-            if agg[row] != 0.0:
-                num_rows += 1
-                if num_rows > max_rows:
-                    table += self._table_ellipsis(num_nonzero - max_rows)
+        table = []
+        nonzero = np.flatnonzero(agg)
+        ncols = data.shape[1]
+        for row in nonzero:
+            num_rows += 1
+            if num_rows > max_rows:
+                table.append(self._table_ellipsis(len(nonzero) - max_rows))
+                break
+            table.append('%s' % tex_sanitize(entity(row).table_label()))
+            start, end = data.indptr[row], data.indptr[row + 1]
+            deps = set(data.indices[start:end][data.data[start:end] != 0].tolist())
+            for i in range(ncols):
+                if i >= self.max_cols:
+                    table.append(' & $\\ldots$ ')
                     break
-                table += '%s' % tex_sanitize(entity.table_label())
-                for i, val in enumerate(data[row].todense().flat):
-                    if i >= self.max_cols:
-                        table += ' & $\\ldots$ '
-                        break
-                    if val == 0:
-                        table += ' & '
-                    else:
-                        table += ' & \\dependency'
-                if do_agg:
-                    table += ' & %5.3g' % agg[row]
-                table += TAB_LF
-
-        table += '\\hline\n'
-        return table
+                if i in deps:
+                    table.append(' & \\dependency')
+                else:
+                    table.append(' & ')
+            if do_agg:
+                table.append(' & %5.3g' % agg[row])
+            table.append(TAB_LF)
+
+        table.append('\\hline\n')
+        return ''.join(table)
 
     def _ad_table(self, aggregate=False, max_rows=20):
         if aggregate:
@@ -161,7 +185,7 @@ class ForegroundTeX(object):
         else:
             agg_string = None
         table = self._table_header('Background Dependencies', aggregate=agg_string)
-        table += self._do_dep_table(self._f.bg_flows, self._f.Ad, aggregate, max_rows)
+        table += self._do_dep_table(self._f.bg_flow, self._ad, self._ad_tilde, aggregate, max_rows)
 
         return table
 
@@ -171,7 +195,8 @@ class ForegroundTeX(object):
         else:
             agg_string = None
         table = self._table_header('Foreground Emissions', aggregate=agg_string)
-        table += self._do_dep_table(self._f.elementary, self._f.Bf_elementary, aggregate, max_rows)
+        table += self._do_dep_table(lambda j: self._f.emission(self._elem_idx[j]), self._bf_elem,
+                                    self._elem_tilde, aggregate, max_rows)
 
         return table
 
@@ -181,7 +206,8 @@ class ForegroundTeX(object):
         else:
             agg_string = None
         # table = self._table_header('Cutoffs', aggregate=agg_string)
-        table = self._do_dep_table(self._f.cutoffs, self._f.Bf_cutoff, aggregate, max_rows)
+        table = self._do_dep_table(lambda j: self._f.emission(self._cutoff_idx[j]), self._bf_cutoff,
+                                   self._cutoff_tilde, aggregate, max_rows)
 
         if len(table) > 12:
             table += '\\hline\n'  # add a double line to get a nice break between sections
@@ -189,28 +215,106 @@ class ForegroundTeX(object):
 
     def foreground_table(self, ad_rows=30, bf_rows=30, max_rows=42, aggregate=False, section=False):
         total_rows = len(self._f.foreground)
-        table = self._table_start(aggregate=aggregate, section=section)
+        table = [self._table_start(aggregate=aggregate, section=section)]
         if total_rows > max_rows:
-            table += self._table_end()
-            table += 'Very large foreground ($p=%d$) omitted.\n' % total_rows
-            return table
-        table += self._af_table(aggregate)
+            table.append(self._table_end())
+            table.append('Very large foreground ($p=%d$) omitted.\n' % total_rows)
+            return ''.join(table)
+        table.append(self._af_table(aggregate))
 
         if aggregate:
-            table += self._x_tilde_table()
+            table.append(self._x_tilde_table())
 
-        table += self._co_table(aggregate)
+        table.append(self._co_table(aggregate))
 
-        total_rows += min(ad_rows, len((self._f.Ad * self._f.x_tilde()).nonzero()[0]))
+        total_rows += min(ad_rows, np.count_nonzero(self._ad_tilde))
         if total_rows > max_rows:
             ad_rows -= (total_rows - max_rows)
             total_rows = max_rows
             bf_rows = 0
-        table += self._ad_table(aggregate, ad_rows)
+        table.append(self._ad_table(aggregate, ad_rows))
 
-        total_rows += min(bf_rows, len((self._f.Bf * self._f.x_tilde()).nonzero()[0]))
+        total_rows += min(bf_rows, np.count_nonzero(self._elem_tilde) + np.count_nonzero(self._cutoff_tilde))
         if total_rows > max_rows:
             bf_rows -= (total_rows - max_rows)
-        table += self._bf_table(aggregate, bf_rows)
-        table += self._table_end()
-        return table
+        table.append(self._bf_table(aggregate, bf_rows))
+        table.append(self._table_end())
+        return ''.join(table)
+
+
+def _report_table(shared, index):
+    bg, flowdb, max_cols, kwargs = shared
+    return fragment_table(bg, flowdb, bg.product_flow(index), max_cols=max_cols, **kwargs)
+
+
+def fragment_table(bg, flowdb, product_flow, max_cols=8, **kwargs):
+    """
+    Build the fragment for a product flow and render its table.
+    :param bg: BackgroundEngine
+    :param flowdb: flow database, for the ForegroundFragment
+    :param product_flow:
+    :param max_cols: [8]
+    :param kwargs: passed to ForegroundTeX.foreground_table
+    :return: table text
+    """
+    return ForegroundTeX(ForegroundFragment(bg, flowdb, product_flow), max_cols=max_cols).foreground_table(**kwargs)
+
+
+class ForegroundReport(object):
+    """
+    Writes the tables for all foreground outputs of a background to a LaTeX stream.  Fragments are built and
+    rendered by a pool of forked worker processes; tables are written in order as they complete, so only a bounded
+    number of them are held in memory.
+    """
+    def __init__(self, bg, flowdb, workers=None, max_pending=None, max_cols=8):
+        """
+
+        :param bg: BackgroundEngine
+        :param flowdb: flow database, for the ForegroundFragments
+        :param workers: [None] number of worker processes; defaults to the number of CPUs.  1 renders serially.
+        :param max_pending: [None] maximum number of tables in flight; defaults to 4 * workers
+        :param max_cols: [8] maximum number of foreground columns to show
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if max_pending is None:
+            max_pending = 4 * workers
+        self._bg = bg
+        self._db = flowdb
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_cols = max_cols
+
+    def tables(self, flows=None, section=True, **kwargs):
+        """
+        Generator. Yields one table per product flow, in order.
+        :param flows: [None] product flows to report; defaults to bg.foreground_flows(outputs=True)
+        :param section: [True] begin each table with a subsection heading
+        :param kwargs: passed to ForegroundTeX.foreground_table
+        :return:
+        """
+        if flows is None:
+            flows = self._bg.foreground_flows(outputs=True)
+        kwargs['section'] = section
+        self._bg.make_foreground()  # build the cached foreground matrices once, for the workers to share
+        shared = (self._bg, self._db, self.max_cols, kwargs)
+        for table in fork_map(_report_table, shared, (pf.index for pf in flows), self.workers, self.max_pending):
+            yield table
+
+    def write(self, stream, flows=None, **kwargs):
+        """
+        Write the report.
+        :param stream: a writable text stream, or a filename to be opened with a large write buffer
+        :param flows: [None] product flows to report; defaults to bg.foreground_flows(outputs=True)
+        :param kwargs: passed to tables()
+        :return: number of tables written
+        """
+        if isinstance(stream, str):
+            with io.open(stream, 'w', buffering=REPORT_BUFFER) as fp:
+                return self.write(fp, flows=flows, **kwargs)
+        count = 0
+        for table in self.tables(flows=flows, **kwargs):
+            stream.write(table)
+            stream.write('\n')
+            count += 1
+        return count
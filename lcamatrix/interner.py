@@ -0,0 +1,61 @@
+"""
+Interning of entity identifiers.
+
+Product flow keys (flow uuid, process uuid) and emission keys (flow uuid, direction) are looked up many times per
+exchange during a traversal.  Interning each uuid to a dense integer once lets the engine key its dictionaries by
+small ints, packed two to a key, instead of by tuples of strings.
+"""
+
+KEY_BITS = 32
+
+
+def pair_key(a, b):
+    """
+    Pack two interned ids into one int
+    :param a:
+    :param b: must be less than 2 ** KEY_BITS
+    :return:
+    """
+    return (a << KEY_BITS) | b
+
+
+class Interner(object):
+    """
+    Maps hashable identifiers (e.g. uuid strings) to dense integers, assigned in order of first appearance.
+    """
+    def __init__(self):
+        self._ids = dict()
+        self._values = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, i):
+        """
+        :param i: interned id
+        :return: the identifier
+        """
+        return self._values[i]
+
+    def __contains__(self, value):
+        return value in self._ids
+
+    def intern(self, value):
+        """
+        :param value: identifier
+        :return: its id, assigning a new one if the identifier has not been seen
+        """
+        try:
+            return self._ids[value]
+        except KeyError:
+            i = len(self._values)
+            self._ids[value] = i
+            self._values.append(value)
+            return i
+
+    def get(self, value):
+        """
+        :param value: identifier
+        :return: its id, or None if the identifier has not been seen
+        """
+        return self._ids.get(value)
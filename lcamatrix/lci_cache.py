@@ -0,0 +1,135 @@
+"""
+A memory-bounded LRU cache of LCI results.
+
+BackgroundEngine.compute_lci is called repeatedly for the same popular product flows (electricity, diesel, transport)
+by interactive sessions and by ForegroundFragment.pf_lcia.  LciCache holds the resulting sparse m x 1 columns, keyed
+by (product flow index, solver settings), evicting the least recently used results once their total size exceeds a
+byte budget.
+
+Every lookup and store carries the engine's version; when it differs from the version the cached results were
+computed against, the whole cache is discarded, so results never outlive a rebuild of A* or B*.  The cache is
+guarded by a lock, so it can be shared by the thread pool in lcamatrix.batch.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+CacheStats = namedtuple('CacheStats', ('hits', 'misses', 'evictions', 'invalidations', 'entries', 'nbytes'))
+
+
+def result_nbytes(result):
+    """
+    :param result: sparse matrix or ndarray
+    :return: bytes held by its arrays
+    """
+    if hasattr(result, 'indptr'):
+        return result.data.nbytes + result.indices.nbytes + result.indptr.nbytes
+    if hasattr(result, 'row'):
+        return result.data.nbytes + result.row.nbytes + result.col.nbytes
+    return result.nbytes
+
+
+class LciCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param max_bytes: [256 MiB] budget for the cached results; a single result larger than this is not cached
+        """
+        if max_bytes < 0:
+            raise ValueError('max_bytes must be non-negative')
+        self.max_bytes = max_bytes
+        self._results = OrderedDict()  # key -> (result, nbytes), least recently used first
+        self._version = None
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(index, **settings):
+        """
+        :param index: product flow index
+        :param settings: solver keyword arguments
+        :return: a hashable cache key
+        """
+        return index, tuple(sorted(settings.items()))
+
+    def __len__(self):
+        return len(self._results)
+
+    def __contains__(self, key):
+        return key in self._results
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def stats(self):
+        return CacheStats(self.hits, self.misses, self.evictions, self.invalidations, len(self._results),
+                          self._nbytes)
+
+    def _check_version(self, version):
+        if version != self._version:
+            if len(self._results) > 0:
+                self.invalidations += 1
+            self._results.clear()
+            self._nbytes = 0
+            self._version = version
+
+    def get(self, key, version):
+        """
+        :param key: from LciCache.key()
+        :param version: the engine's current version
+        :return: the cached result, or None.  The result is shared and must not be modified in place.
+        """
+        with self._lock:
+            self._check_version(version)
+            try:
+                result, _ = self._results[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result, version):
+        """
+        Store a result, evicting least recently used results as needed to stay within the byte budget.
+        :param key: from LciCache.key()
+        :param result: sparse LCI
+        :param version: the engine version the result was computed against
+        :return:
+        """
+        size = result_nbytes(result)
+        with self._lock:
+            self._check_version(version)
+            if key in self._results:
+                self._nbytes -= self._results.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            while self._nbytes + size > self.max_bytes:
+                _, (_, evicted) = self._results.popitem(last=False)
+                self._nbytes -= evicted
+                self.evictions += 1
+            self._results[key] = (result, size)
+            self._nbytes += size
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._nbytes = 0
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = self.invalidations = 0
@@ -0,0 +1,183 @@
+"""
+Chunked on-disk storage for whole-database LCI runs.
+
+LCI columns are buffered in memory until chunk_size of them have accumulated, then written out as a single sparse
+CSC block (m x chunk_size) to a numbered .npz file in the output directory.  Each chunk also records the keys of the
+ProductFlows whose LCIs it contains, each JSON-encoded so that None components survive the round trip.  Chunks are
+written to a temporary file and renamed into place, so an interrupted run leaves only complete chunks behind;
+re-opening the same directory skips the product flows already written.
+"""
+import json
+import os
+import re
+
+import numpy as np
+from scipy.sparse import csc_matrix, hstack
+
+
+CHUNK_PATTERN = re.compile(r'^chunk_(\d+)\.npz$')
+
+
+def _chunk_files(directory):
+    chunks = []
+    for fname in os.listdir(directory):
+        m = CHUNK_PATTERN.match(fname)
+        if m is not None:
+            chunks.append((int(m.group(1)), os.path.join(directory, fname)))
+    return sorted(chunks)
+
+
+def _encode_keys(keys):
+    """
+    :param keys: list of ProductFlow key tuples
+    :return: string array, one JSON list per key
+    """
+    return np.array([json.dumps(list(k)) for k in keys], dtype=str)
+
+
+def _decode_keys(flow_keys):
+    """
+    Inverse of _encode_keys.  Chunks written before keys were JSON-encoded hold a 2-D string array instead.
+    :param flow_keys: array loaded from a chunk
+    :return: list of key tuples
+    """
+    if flow_keys.ndim == 2:
+        return [tuple(k) for k in flow_keys.tolist()]
+    return [tuple(json.loads(k)) for k in flow_keys.tolist()]
+
+
+def read_chunks(directory):
+    """
+    Generator. Yields the contents of each chunk in order.
+    :param directory:
+    :return: yields (keys, pf_index, lci) where keys is a list of ProductFlow key tuples, pf_index an int array, and
+     lci an m x k csc_matrix whose columns correspond to keys
+    """
+    for _, fname in _chunk_files(directory):
+        with np.load(fname) as npz:
+            lci = csc_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+            keys = _decode_keys(npz['flow_keys'])
+            yield keys, npz['pf_index'], lci
+
+
+def read_lci(directory):
+    """
+    Generator. Yields stored LCIs one column at a time.
+    :param directory:
+    :return: yields (ProductFlow key, m x 1 csc_matrix)
+    """
+    for keys, _, lci in read_chunks(directory):
+        for n, k in enumerate(keys):
+            yield k, lci[:, n]
+
+
+class LciWriter(object):
+    """
+    Writes (ProductFlow, LCI) pairs incrementally to a directory of sparse chunks.
+    """
+    def __init__(self, directory, chunk_size=500):
+        """
+
+        :param directory: output directory; created if it does not exist.  If it already contains chunks, the
+         product flows they contain are recorded as done and will be skipped.
+        :param chunk_size: [500] number of LCI columns per chunk
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._dir = directory
+        self.chunk_size = chunk_size
+
+        self._done = set()
+        self._next = 0
+        for n, fname in _chunk_files(directory):
+            with np.load(fname) as npz:
+                self._done.update(_decode_keys(npz['flow_keys']))
+            self._next = n + 1
+
+        self._keys = []
+        self._index = []
+        self._cols = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def done(self):
+        """
+        Set of keys of ProductFlows already written to disk or waiting in the buffer.
+        :return:
+        """
+        return self._done
+
+    def is_done(self, product_flow):
+        return product_flow.key in self._done
+
+    def add(self, product_flow, lci):
+        """
+        Buffer a single LCI column, flushing a chunk to disk when the buffer is full.
+        :param product_flow:
+        :param lci: m x 1 sparse or dense LCI
+        :return:
+        """
+        if product_flow.key in self._done:
+            return
+        self._keys.append(product_flow.key)
+        self._index.append(product_flow.index)
+        self._cols.append(csc_matrix(lci))
+        self._done.add(product_flow.key)
+        if len(self._cols) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._cols) == 0:
+            return
+        block = hstack(self._cols, format='csc')
+        fname = os.path.join(self._dir, 'chunk_%06d.npz' % self._next)
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, data=block.data, indices=block.indices, indptr=block.indptr,
+                     shape=np.array(block.shape), flow_keys=_encode_keys(self._keys),
+                     pf_index=np.array(self._index, dtype=np.int64))
+        os.rename(tmp, fname)
+        self._next += 1
+        self._keys = []
+        self._index = []
+        self._cols = []
+
+    def close(self):
+        self.flush()
+
+    def write(self, results):
+        """
+        Consume an iterable of (ProductFlow, LCI) pairs, e.g. from BackgroundEngine.generate_lci or BatchLci.lci
+        :param results:
+        :return: number of LCIs added
+        """
+        count = 0
+        for pf, lci in results:
+            self.add(pf, lci)
+            count += 1
+        return count
+
+    def write_all(self, bg, flows=None, batch=None, **kwargs):
+        """
+        Compute and store the LCI of every product flow not already written.
+        :param bg: a BackgroundEngine
+        :param flows: [None] iterable of ProductFlows; defaults to all foreground then background flows
+        :param batch: [None] an optional BatchLci to compute the LCIs in parallel
+        :param kwargs: passed to compute_lci
+        :return: number of LCIs added
+        """
+        if batch is None:
+            results = bg.generate_lci(flows, skip=self._done, **kwargs)
+        else:
+            if flows is None:
+                flows = bg.all_flows()
+            results = batch.lci((pf for pf in flows if pf.key not in self._done), **kwargs)
+        try:
+            return self.write(results)
+        finally:
+            self.close()
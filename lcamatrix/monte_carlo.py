@@ -0,0 +1,273 @@
+"""
+Monte Carlo uncertainty propagation through the background.
+
+The sparsity patterns of A* and B* are held fixed; each iteration draws a complete new data array for each matrix
+from per-entry distributions in a single vectorized call.  The perturbed system (I - A*) x = ad is solved with GMRES,
+warm-started from the previous iterate and preconditioned with the cached factorization of the unperturbed background,
+so that no per-iteration factorization is required.  If the iterative solve fails to converge, the draw is refactored
+directly.
+
+Results are streamed into a RunningStats accumulator (mean and variance by Welford's method, quantiles from a
+fixed-size reservoir sample), so memory does not grow with the number of iterations.  Iterations can be spread
+across forked worker processes, whose accumulators are merged at the end.
+
+Only background uncertainty is sampled; the foreground demand and direct foreground emissions of the product flow
+are treated as fixed.
+"""
+import multiprocessing
+
+import numpy as np
+from scipy.sparse import csc_matrix, identity, issparse
+from scipy.sparse.linalg import LinearOperator, gmres, splu
+
+from lcamatrix.batch import fork_map
+
+
+DISTRIBUTIONS = ('lognormal', 'normal', 'uniform')
+
+
+def _run_chunk(mc, args):
+    return mc.run_chunk(*args)
+
+
+class RunningStats(object):
+    """
+    Streaming accumulator for a sequence of equal-length result vectors.
+    """
+    def __init__(self, dim, reservoir=1000, seed=None):
+        """
+
+        :param dim: length of each result vector
+        :param reservoir: [1000] number of samples retained for quantile estimation
+        :param seed: seed for reservoir replacement
+        """
+        self.dim = dim
+        self.count = 0
+        self._mean = np.zeros(dim)
+        self._m2 = np.zeros(dim)
+        self._capacity = reservoir
+        self._reservoir = np.zeros((reservoir, dim))
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, value):
+        value = np.asarray(value, dtype=float).reshape(self.dim)
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+        if self.count <= self._capacity:
+            self._reservoir[self.count - 1] = value
+        else:
+            j = self._rng.integers(self.count)
+            if j < self._capacity:
+                self._reservoir[j] = value
+
+    @property
+    def samples(self):
+        """
+        The retained reservoir: a uniform random sample of at most `reservoir` results
+        :return:
+        """
+        return self._reservoir[:min(self.count, self._capacity)]
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return np.zeros(self.dim)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def quantiles(self, q):
+        """
+        Estimated quantiles of each component, from the reservoir sample.
+        :param q: quantile or sequence of quantiles in [0, 1]
+        :return: array of shape (len(q), dim)
+        """
+        if self.count == 0:
+            raise ValueError('No samples')
+        return np.quantile(self.samples, q, axis=0)
+
+    def merge(self, other):
+        """
+        Combine another accumulator over the same quantity into this one (Chan et al. for the moments;
+        hypergeometric subsampling for the reservoirs).
+        :param other: RunningStats
+        :return:
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self._mean = other._mean.copy()
+            self._m2 = other._m2.copy()
+            self._reservoir[:len(other.samples)] = other.samples
+            return
+        n = self.count + other.count
+        delta = other._mean - self._mean
+        self._m2 += other._m2 + delta ** 2 * self.count * other.count / n
+        self._mean += delta * other.count / n
+
+        mine = self.samples
+        theirs = other.samples
+        if n <= self._capacity:
+            merged = np.vstack([mine, theirs])
+        else:
+            k = self._rng.hypergeometric(self.count, other.count, self._capacity)
+            merged = np.vstack([mine[self._rng.choice(len(mine), k, replace=False)],
+                                theirs[self._rng.choice(len(theirs), self._capacity - k, replace=False)]])
+        self.count = n
+        self._reservoir[:len(merged)] = merged
+
+
+class MonteCarlo(object):
+    """
+    Samples the background matrices and accumulates LCI or LCIA results for a single product flow.
+    """
+    def __init__(self, bg, a_spread=0.1, b_spread=0.1, distribution='lognormal', tol=1e-8):
+        """
+
+        :param bg: a BackgroundEngine with a constructed background
+        :param a_spread: [0.1] scalar or array (one entry per A* nonzero, in the order of a_entries()) giving the
+         spread of each entry: log-space standard deviation for 'lognormal', relative standard deviation for
+         'normal', relative half-width for 'uniform'
+        :param b_spread: [0.1] as a_spread, for B* (in the order of b_entries())
+        :param distribution: ['lognormal'] one of DISTRIBUTIONS; lognormal draws preserve sign and median
+        :param tol: [1e-8] relative tolerance for the iterative solve
+        """
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError('Unknown distribution %s' % distribution)
+        self._bg = bg
+        self._a = csc_matrix(bg._a_matrix)
+        self._a.sort_indices()
+        self._b = csc_matrix(bg._b_matrix)
+        self._b.sort_indices()
+        self.distribution = distribution
+        self.a_spread = np.broadcast_to(np.asarray(a_spread, dtype=float), self._a.data.shape)
+        self.b_spread = np.broadcast_to(np.asarray(b_spread, dtype=float), self._b.data.shape)
+        self.tol = tol
+
+        lu = bg.factorize()
+        n = self.ndim
+        self._precondition = LinearOperator((n, n), matvec=lu.solve, dtype=float)
+        self._identity = identity(n, format='csc')
+
+    @property
+    def ndim(self):
+        return self._a.shape[0]
+
+    @staticmethod
+    def _entries(mat):
+        cols = np.repeat(np.arange(mat.shape[1]), np.diff(mat.indptr))
+        return mat.indices.copy(), cols
+
+    def a_entries(self):
+        """
+        :return: row and column (A* indices) of each sampled A* entry, in the order expected for a_spread
+        """
+        return self._entries(self._a)
+
+    def b_entries(self):
+        """
+        :return: row (emission index) and column (A* index) of each sampled B* entry, in the order for b_spread
+        """
+        return self._entries(self._b)
+
+    def _draw(self, rng, values, spread):
+        if self.distribution == 'lognormal':
+            return values * np.exp(spread * rng.standard_normal(values.shape))
+        if self.distribution == 'normal':
+            return values * (1.0 + spread * rng.standard_normal(values.shape))
+        return values * (1.0 + spread * rng.uniform(-1.0, 1.0, values.shape))
+
+    def sample(self, rng):
+        """
+        Draw one realization of A* and B* with the fixed sparsity pattern.
+        :param rng: numpy Generator
+        :return: a, b as csc_matrix
+        """
+        a = csc_matrix((self._draw(rng, self._a.data, self.a_spread), self._a.indices, self._a.indptr),
+                       shape=self._a.shape)
+        b = csc_matrix((self._draw(rng, self._b.data, self.b_spread), self._b.indices, self._b.indptr),
+                       shape=self._b.shape)
+        return a, b
+
+    def _solve(self, a, ad, x0):
+        m = self._identity - a
+        x, info = gmres(m, ad, x0=x0, rtol=self.tol, M=self._precondition)
+        if info != 0:
+            x = splu(m).solve(ad)
+        return x
+
+    def _demand(self, product_flow):
+        ad, bf_tilde = self._bg.lci_demand(product_flow)
+        if issparse(ad):
+            ad = ad.toarray()
+        ad = np.asarray(ad, dtype=float).reshape(self.ndim)
+        if bf_tilde is None:
+            bf = np.zeros(self._b.shape[0])
+        else:
+            bf = np.asarray(bf_tilde.toarray(), dtype=float).reshape(self._b.shape[0])
+        return ad, bf
+
+    def run_chunk(self, pf_index, iterations, seed, e=None, reservoir=1000):
+        """
+        Run a number of iterations serially.
+        :param pf_index: index of the product flow
+        :param iterations:
+        :param seed: seed or SeedSequence for this chunk
+        :param e: [None] t x m characterization matrix; if given, accumulate scores instead of LCIs
+        :param reservoir: reservoir size for quantiles
+        :return: RunningStats
+        """
+        rng = np.random.default_rng(seed)
+        ad, bf = self._demand(self._bg.product_flow(pf_index))
+        if e is not None:
+            e = e.toarray() if issparse(e) else np.asarray(e, dtype=float)
+            stats = RunningStats(e.shape[0], reservoir=reservoir, seed=rng.integers(2 ** 32))
+        else:
+            stats = RunningStats(self._b.shape[0], reservoir=reservoir, seed=rng.integers(2 ** 32))
+
+        x = self._bg.factorize().solve(ad)  # warm start from the deterministic result
+        for _ in range(iterations):
+            a, b = self.sample(rng)
+            x = self._solve(a, ad, x)
+            bx = b.dot(x) + bf
+            if e is None:
+                stats.add(bx)
+            else:
+                stats.add(e.dot(bx))
+        return stats
+
+    def run(self, product_flow, iterations=1000, e=None, workers=1, seed=None, reservoir=1000):
+        """
+        Propagate background uncertainty to the LCI (or LCIA scores) of a product flow.
+        :param product_flow: foreground or background ProductFlow
+        :param iterations: [1000] number of draws
+        :param e: [None] t x m characterization matrix (e.g. ForegroundFragment.E); if omitted, the m-vector LCI
+         is accumulated
+        :param workers: [1] number of forked worker processes
+        :param seed: [None] seed for reproducible results
+        :param reservoir: [1000] number of samples retained for quantile estimation
+        :return: RunningStats
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, iterations))
+        seeds = np.random.SeedSequence(seed).spawn(workers)
+        chunks = [iterations // workers + (1 if k < iterations % workers else 0) for k in range(workers)]
+
+        args = [(product_flow.index, n, s, e, reservoir) for n, s in zip(chunks, seeds)]
+        stats = None
+        for part in fork_map(_run_chunk, self, args, workers):
+            if stats is None:
+                stats = part
+            else:
+                stats.merge(part)
+        return stats
@@ -0,0 +1,122 @@
+"""
+Structural path analysis over the background.
+
+The LCI computed by compute_bg_lci is the power series x = ad + A* ad + A*^2 ad + ...; each term of each product
+expands into supply-chain paths.  Instead of summing the series, the paths are enumerated best-first with a priority
+queue keyed by each path's total upstream score (path amount times the node's unit score, from one adjoint solve).  A
+branch is pruned as soon as its upstream score falls below cutoff times the total, and the search stops after a fixed
+number of expansions, so time and memory stay bounded even when the background is fully looped.
+"""
+import heapq
+from collections import namedtuple
+
+import numpy as np
+from scipy.sparse import csc_matrix
+
+from lcamatrix.contribution import as_vector
+
+
+SupplyPath = namedtuple('SupplyPath', ('flows', 'amount', 'direct', 'total'))
+"""
+flows: tuple of ProductFlows from the root to the node at the end of the path
+amount: activity of the final node along this path
+direct: LCIA score of the final node's own emissions along this path (amount * direct intensity)
+total: LCIA score of everything upstream of the final node along this path, including itself (amount * unit score)
+"""
+
+
+class StructuralPathAnalysis(object):
+    """
+    Enumerates the dominant supply-chain paths for one LCIA method.
+    """
+    def __init__(self, bg, e):
+        """
+
+        :param bg: a BackgroundEngine with a constructed background
+        :param e: 1 x m characterization vector (e.g. one row of ForegroundFragment.E)
+        """
+        self._bg = bg
+        e = csc_matrix(e)
+        if e.shape[0] != 1:
+            raise ValueError('Path analysis requires a single LCIA method')
+        self._a = bg._a_columns()
+        self._direct = as_vector(e * bg._b_matrix)  # direct score per unit activity of each background node
+        self._unit = as_vector(bg.bg_unit_scores(e))  # total score per unit output of each background node
+        self.covered = None  # after paths(): sum of direct scores of all expanded paths
+        self.residual = None  # after paths(): score of the branches pruned or left unexpanded
+
+    def _root(self, product_flow):
+        ad, _ = self._bg.lci_demand(product_flow)
+        ad = as_vector(ad)
+        if self._bg.is_background(product_flow):
+            return ad, ()
+        return ad, (product_flow, )
+
+    def paths(self, product_flow, cutoff=1e-3, max_paths=50, max_expansions=100000, max_depth=None):
+        """
+        :param product_flow: foreground or background ProductFlow
+        :param cutoff: [1e-3] prune paths whose upstream score is smaller than this fraction of the total score
+        :param max_paths: [50] number of paths to return
+        :param max_expansions: [100000] maximum number of paths popped from the queue
+        :param max_depth: [None] maximum path length within the background
+        :return: list of SupplyPaths sorted by decreasing magnitude of direct score.  Afterwards, covered + residual
+         equals the total score, where covered is the sum of the direct scores of every expanded path (of which the
+         returned paths are the largest) and residual the upstream score of the pruned and unexpanded branches.
+        """
+        ad, prefix = self._root(product_flow)
+        score = float(self._unit.dot(ad))
+        threshold = abs(score) * cutoff
+        self.covered = 0.0
+        self.residual = score
+        if threshold == 0:
+            return []
+
+        queue = []  # (-|total|, tiebreak, amount, node path)
+        counter = 0
+        pruned = 0.0
+        for j in np.flatnonzero(ad):
+            total = ad[j] * self._unit[j]
+            if abs(total) >= threshold:
+                heapq.heappush(queue, (-abs(total), counter, ad[j], (j, )))
+                counter += 1
+            else:
+                pruned += total
+
+        best = []  # min-heap of (|direct|, tiebreak, amount, node path), at most max_paths long
+        covered = 0.0
+        expansions = 0
+        while len(queue) > 0 and expansions < max_expansions:
+            _, _, amount, path = heapq.heappop(queue)
+            expansions += 1
+            j = path[-1]
+            direct = amount * self._direct[j]
+            covered += direct
+            if direct != 0:
+                entry = (abs(direct), expansions, amount, path)
+                if len(best) < max_paths:
+                    heapq.heappush(best, entry)
+                elif entry[0] > best[0][0]:
+                    heapq.heapreplace(best, entry)
+
+            if max_depth is not None and len(path) >= max_depth:
+                pruned += amount * self._unit[j] - direct
+                continue
+            start, end = self._a.indptr[j], self._a.indptr[j + 1]
+            for i, a_ij in zip(self._a.indices[start:end], self._a.data[start:end]):
+                child = amount * a_ij
+                total = child * self._unit[i]
+                if abs(total) >= threshold:
+                    heapq.heappush(queue, (-abs(total), counter, child, path + (i, )))
+                    counter += 1
+                else:
+                    pruned += total
+
+        self.covered = covered
+        self.residual = pruned + sum(amount * self._unit[path[-1]] for _, _, amount, path in queue)
+        print('%d expansions; %d paths in queue; direct scores of expanded paths cover %.1f%% of total' % (
+            expansions, len(queue), 100 * covered / score))
+        result = []
+        for _, _, amount, path in sorted(best, reverse=True):
+            flows = prefix + tuple(self._bg.tstack.bg_node(k) for k in path)
+            result.append(SupplyPath(flows, amount, amount * self._direct[path[-1]], amount * self._unit[path[-1]]))
+        return result
@@ -0,0 +1,218 @@
+"""
+Spreadsheet backends for ForegroundPublication.
+
+Each writer accepts rows in sequential order, sheet by sheet, and tracks column widths.  Bulk data is passed as
+columns (equal-length arrays) so that widths can be computed from vectorized string lengths instead of cell by cell.
+
+ * XlsWriter - xlwt; legacy .xls format, limited to 65,536 rows per sheet
+ * XlsxWriter - xlsxwriter in constant-memory mode; rows are flushed to disk as they are written
+ * CsvWriter - a directory containing one CSV file per sheet
+
+Writer dependencies are imported only when the writer is created.
+"""
+import os
+import csv
+from collections import defaultdict
+
+import numpy as np
+
+
+def column_width(column):
+    """
+    Vectorized maximum string length of a column of values
+    :param column: sequence or array
+    :return: int
+    """
+    column = np.asarray(column)
+    if column.size == 0:
+        return 0
+    return int(np.char.str_len(column.astype(str)).max())
+
+
+class PublicationWriter(object):
+    """
+    Base class.  Subclasses implement _add_sheet, _write and _close.
+    """
+    max_rows = None
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._sheets = dict()  # name -> backend sheet
+        self._wid = defaultdict(int)  # (sheet name, column) -> width in characters
+
+    def add_sheet(self, name):
+        sheet = self._add_sheet(name)
+        self._sheets[name] = sheet
+        return name
+
+    def _check_row(self, name, row):
+        if self.max_rows is not None and row >= self.max_rows:
+            raise ValueError('Sheet %s exceeds %d rows; publish to .xlsx or CSV instead' % (name, self.max_rows))
+
+    def write_row(self, name, row, data):
+        """
+        Write one row of cells.
+        :param name: sheet name, as returned by add_sheet
+        :param row: row number
+        :param data: sequence of cell values
+        :return: the next row number
+        """
+        self._check_row(name, row)
+        self._write(self._sheets[name], row, data)
+        for i, d in enumerate(data):
+            self._wid[(name, i)] = max(self._wid[(name, i)], len(str(d)))
+        return row + 1
+
+    def write_columns(self, name, row, columns):
+        """
+        Write a block of rows given as columns.
+        :param name: sheet name
+        :param row: first row number
+        :param columns: sequence of equal-length arrays, one per spreadsheet column
+        :return: the next row number
+        """
+        columns = [np.asarray(c) for c in columns]
+        if len(columns) == 0 or len(columns[0]) == 0:
+            return row
+        self._check_row(name, row + len(columns[0]) - 1)
+        for i, c in enumerate(columns):
+            self._wid[(name, i)] = max(self._wid[(name, i)], column_width(c))
+        sheet = self._sheets[name]
+        for data in zip(*[c.tolist() for c in columns]):
+            self._write(sheet, row, data)
+            row += 1
+        return row
+
+    def write_cells(self, name, row, cols, values, ncols=None):
+        """
+        Write selected cells of one row, leaving the others blank.
+        :param name: sheet name
+        :param row: row number
+        :param cols: sequence of column numbers, ascending
+        :param values: sequence of cell values, parallel to cols
+        :param ncols: [None] row length, for formats that store blank cells explicitly
+        :return: the next row number
+        """
+        self._check_row(name, row)
+        self._write_cells(self._sheets[name], row, cols, values, ncols)
+        for c, w in zip(cols, np.char.str_len(np.asarray(values).astype(str)).tolist()):
+            if w > self._wid[(name, c)]:
+                self._wid[(name, c)] = w
+        return row + 1
+
+    def _write_cells(self, sheet, row, cols, values, ncols):
+        data = [''] * max(ncols or 0, cols[-1] + 1)
+        for c, v in zip(cols, values):
+            data[c] = v
+        self._write(sheet, row, data)
+
+    def close(self):
+        self._close()
+
+    def _add_sheet(self, name):
+        raise NotImplementedError
+
+    def _write(self, sheet, row, data):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class XlsWriter(PublicationWriter):
+    max_rows = 65536
+
+    def __init__(self, filename):
+        super(XlsWriter, self).__init__(filename)
+        import xlwt
+        self._x = xlwt.Workbook()
+
+    def _add_sheet(self, name):
+        return self._x.add_sheet(name)
+
+    def _write(self, sheet, row, data):
+        for i, d in enumerate(data):
+            sheet.write(row, i, d)
+
+    def _write_cells(self, sheet, row, cols, values, ncols):
+        for c, v in zip(cols, values):
+            sheet.write(row, c, v)
+
+    def _close(self):
+        for (name, col), val in self._wid.items():
+            self._sheets[name].col(col).width = (val + 2) * 256
+        self._x.save(self._filename)
+
+
+class XlsxWriter(PublicationWriter):
+    max_rows = 1048576
+
+    def __init__(self, filename):
+        super(XlsxWriter, self).__init__(filename)
+        import xlsxwriter
+        self._x = xlsxwriter.Workbook(filename, {'constant_memory': True})
+
+    def _add_sheet(self, name):
+        return self._x.add_worksheet(name)
+
+    def _write(self, sheet, row, data):
+        sheet.write_row(row, 0, data)
+
+    def _write_cells(self, sheet, row, cols, values, ncols):
+        for c, v in zip(cols, values):
+            sheet.write(row, c, v)
+
+    def _close(self):
+        for (name, col), val in self._wid.items():
+            self._sheets[name].set_column(col, col, val + 2)
+        self._x.close()
+
+
+class CsvWriter(PublicationWriter):
+    """
+    filename is a directory; each sheet is written to <sheet name>.csv within it.
+    """
+
+    def __init__(self, filename):
+        super(CsvWriter, self).__init__(filename)
+        if not os.path.isdir(filename):
+            os.makedirs(filename)
+        self._files = []
+        self._next_row = dict()
+
+    def _add_sheet(self, name):
+        fp = open(os.path.join(self._filename, '%s.csv' % name), 'w', newline='')
+        self._files.append(fp)
+        return csv.writer(fp), name
+
+    def _write(self, sheet, row, data):
+        writer, name = sheet
+        nxt = self._next_row.get(name, 0)
+        if row < nxt:
+            raise ValueError('CSV rows must be written in order')
+        for _ in range(row - nxt):
+            writer.writerow(())
+        writer.writerow(data)
+        self._next_row[name] = row + 1
+
+    def _close(self):
+        for fp in self._files:
+            fp.close()
+
+
+WRITERS = {'xls': XlsWriter, 'xlsx': XlsxWriter, 'csv': CsvWriter}
+
+
+def create_writer(filename, fmt=None):
+    """
+    :param filename: output file (or directory, for CSV)
+    :param fmt: [None] 'xls', 'xlsx' or 'csv'; if omitted, inferred from the filename extension (no recognized
+     extension means a CSV directory)
+    :return: a PublicationWriter
+    """
+    if fmt is None:
+        ext = os.path.splitext(filename)[1].lower()
+        fmt = {'.xls': 'xls', '.xlsx': 'xlsx'}.get(ext, 'csv')
+    if fmt not in WRITERS:
+        raise ValueError('Unknown publication format %s' % fmt)
+    return WRITERS[fmt](filename)
@@ -0,0 +1,196 @@
+"""
+Perturbation and sensitivity analysis against a fixed background.
+
+A BackgroundPerturbation records changes to individual entries of A* and B* without touching the BackgroundEngine.
+Results are computed against the engine's cached factorization of M = (I - A*):  a set of k changes to A* is a rank-k
+update M' = M - U V', which is solved by the Sherman-Morrison-Woodbury identity
+
+  M'^-1 b = y + Z (I - V'Z)^-1 V'y,  where y = M^-1 b and Z = M^-1 U
+
+so each new perturbation costs one extra solve against the existing factorization instead of a rebuild.
+Perturbations are recorded by product flow index, not by matrix position, so that they survive a renumbering of the
+background; whenever the engine's version changes, the factorization is fetched again and positions are re-derived.
+
+Sensitivities of a score s = e' B x (x = M^-1 ad) to every entry of A* and B* come from a single adjoint solve:
+ lambda = M^-T B'e;  ds/dA*[i, j] = lambda[i] * x[j];  ds/dB*[k, j] = e[k] * x[j]
+"""
+import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix, issparse
+
+
+def _dense(v):
+    if issparse(v):
+        v = v.toarray()
+    return np.asarray(v, dtype=float)
+
+
+class BackgroundPerturbation(object):
+    """
+    Overlay of A* and B* changes, evaluated through low-rank updates to the unperturbed factorization.
+    """
+    def __init__(self, bg):
+        """
+        :param bg: a BackgroundEngine with a constructed background
+        """
+        self._bg = bg
+        self._lu = bg.factorize()
+        self._version = bg.version  # engine version self._lu and the cached solves belong to
+        self._a = dict()  # (term index, parent index) -> cumulative delta to A*
+        self._b = dict()  # (emission index, parent index) -> cumulative delta to B*
+
+        self._u = None  # scaled unit columns at the perturbed rows, n x k
+        self._v = None  # unit columns at the perturbed columns, n x k
+        self._z = None  # M^-1 U, n x k
+        self._zt = None  # M^-T V, n x k
+        self._cap = None  # capacitance (I - V'Z), k x k
+
+    @property
+    def ndim(self):
+        return self._bg.tstack.ndim
+
+    @property
+    def mdim(self):
+        return self._bg.mdim
+
+    def _bg_index(self, index):
+        """
+        :param index: ProductFlow index
+        :return: its current position in A* / B*
+        """
+        i = self._bg.tstack.bg_dict(index)
+        if i is None:
+            raise KeyError('Not a background product flow: %s' % self._bg.product_flow(index))
+        return i
+
+    def _check_version(self):
+        """
+        Refactor if A* or B* has been rebuilt or renumbered since the factorization was taken.
+        """
+        if self._bg.version != self._version:
+            self._lu = self._bg.factorize()
+            self._version = self._bg.version
+            self._z = self._zt = self._cap = None
+
+    def perturb_a(self, parent, term, delta):
+        """
+        Add delta to the entry of A* for the dependency of parent on term.
+        :param parent: background ProductFlow (A* column)
+        :param term: background ProductFlow (A* row)
+        :param delta: change in the normalized exchange value
+        :return:
+        """
+        self._bg_index(term.index)
+        self._bg_index(parent.index)
+        k = (term.index, parent.index)
+        self._a[k] = self._a.get(k, 0.0) + delta
+        if self._a[k] == 0:
+            self._a.pop(k)
+        self._z = self._zt = self._cap = None
+
+    def perturb_b(self, parent, emission, delta):
+        """
+        Add delta to the entry of B* for the emission of parent.
+        :param parent: background ProductFlow (B* column)
+        :param emission: Emission (B* row)
+        :param delta:
+        :return:
+        """
+        self._bg_index(parent.index)
+        k = (emission.index, parent.index)
+        self._b[k] = self._b.get(k, 0.0) + delta
+        if self._b[k] == 0:
+            self._b.pop(k)
+
+    def reset(self):
+        self._a = dict()
+        self._b = dict()
+        self._z = self._zt = self._cap = None
+
+    def __len__(self):
+        return len(self._a) + len(self._b)
+
+    def _update_terms(self):
+        """
+        Build U (scaled unit columns at the perturbed rows) and V (unit columns at the perturbed columns) and the
+        solves that depend on them.
+        """
+        if self._cap is not None:
+            return
+        k = len(self._a)
+        u = np.zeros((self.ndim, k))
+        v = np.zeros((self.ndim, k))
+        for n, ((i, j), delta) in enumerate(self._a.items()):
+            u[self._bg_index(i), n] = delta
+            v[self._bg_index(j), n] = 1.0
+        self._u = u
+        self._v = v
+        self._z = self._lu.solve(u)
+        self._zt = self._lu.solve(v, trans='T')
+        self._cap = np.eye(k) - v.T.dot(self._z)
+
+    def _solve(self, rhs, trans='N'):
+        self._check_version()
+        y = self._lu.solve(rhs, trans=trans)
+        if len(self._a) == 0:
+            return y
+        self._update_terms()
+        if trans == 'N':
+            # (M - U V')^-1 rhs
+            return y + self._z.dot(np.linalg.solve(self._cap, self._v.T.dot(y)))
+        # (M' - V U')^-1 rhs: capacitance is transposed
+        return y + self._zt.dot(np.linalg.solve(self._cap.T, self._u.T.dot(y)))
+
+    def b_delta(self):
+        """
+        :return: sparse m x n matrix of changes to B*
+        """
+        if len(self._b) == 0:
+            return csr_matrix((self.mdim, self.ndim))
+        rows = [k for k, _ in self._b.keys()]
+        cols = [self._bg_index(j) for _, j in self._b.keys()]
+        return csr_matrix((list(self._b.values()), (rows, cols)), shape=(self.mdim, self.ndim))
+
+    def b_matrix(self):
+        return self._bg._b_matrix + self.b_delta()
+
+    def solve_bg_lci(self, ad):
+        """
+        Background LCI of the perturbed system.
+        :param ad: n x k background demand
+        :return: x, bx as sparse matrices, as BackgroundEngine.compute_bg_lci
+        """
+        rhs = _dense(ad).reshape(self.ndim, -1)
+        x = csr_matrix(self._solve(rhs))
+        return x, self.b_matrix() * x
+
+    def compute_lci(self, product_flow):
+        """
+        LCI of a product flow (foreground or background) under the current perturbations.
+        :param product_flow:
+        :return: m x 1 sparse LCI
+        """
+        ad, bf_tilde = self._bg.lci_demand(product_flow)
+        x, bx = self.solve_bg_lci(ad)
+        if bf_tilde is None:
+            return bx
+        return bx + bf_tilde
+
+    def sensitivities(self, ad, e):
+        """
+        First-order sensitivity of the score e' B x to every nonzero entry of A* and B*, from one forward and one
+        adjoint solve.
+        :param ad: n x 1 background demand (e.g. ad_tilde of a fragment, or a unit vector)
+        :param e: 1 x m characterization vector (e.g. a row of ForegroundFragment.E)
+        :return: score, dA, dB: the (perturbed) score and sparse matrices with the sparsity patterns of A* and B*
+        """
+        x = self._solve(_dense(ad).reshape(self.ndim, -1))[:, 0]
+        e = _dense(e).reshape(-1)
+        b = self.b_matrix()
+        lam = self._solve(b.T.dot(e).reshape(self.ndim, 1), trans='T')[:, 0]
+        score = e.dot(b.dot(x))
+
+        a = coo_matrix(self._bg._a_matrix)
+        da = coo_matrix((lam[a.row] * x[a.col], (a.row, a.col)), shape=a.shape).tocsr()
+        bc = coo_matrix(b)
+        db = coo_matrix((e[bc.row] * x[bc.col], (bc.row, bc.col)), shape=bc.shape).tocsr()
+        return score, da, db
@@ -0,0 +1,324 @@
+"""
+Synthetic archives for tests and benchmarks.
+
+A SyntheticArchive implements the subset of the archive interface that BackgroundEngine uses (processes, terminate,
+__getitem__, mix; exchanges, references and allocation on processes) without requiring lcatools or a real database,
+and a SyntheticFlowDb stands in for the flow database used by ForegroundFragment (compartments and
+characterization).
+
+synthetic_archive() generates a reproducible random database of any size:
+ * a background whose largest strongly connected component holds a controllable fraction of background processes,
+   linked into a ring plus sparse random dependencies;
+ * the remaining background processes form an acyclic supply chain that the giant SCC draws on;
+ * a foreground of linear chains of controllable depth that draw on the background, some of which are multi-output
+   (alternately allocated and unallocated);
+ * optionally, background products with alternative producers, for exercising multi-termination strategies;
+ * a fixed number of elementary flows, characterized by one LCIA method.
+"""
+import random
+import sys
+import threading
+import uuid
+
+
+class SyntheticEntity(object):
+    origin = 'synthetic'
+
+    def __init__(self, entity_uuid, name, **kwargs):
+        self.uuid = entity_uuid
+        self.external_ref = entity_uuid
+        self._d = dict(Name=name, **kwargs)
+
+    def __getitem__(self, item):
+        return self._d[item]
+
+    def get_external_ref(self):
+        return self.external_ref
+
+    def unit(self):
+        return 'kg'
+
+    def __str__(self):
+        return self._d['Name']
+
+
+class SyntheticQuantity(SyntheticEntity):
+    def is_lcia_method(self):
+        return True
+
+
+class SyntheticCharacterization(object):
+    def __init__(self, flow, quantity, value):
+        self.flow = flow
+        self.quantity = quantity
+        self.value = value
+
+
+class SyntheticFlow(SyntheticEntity):
+    def __init__(self, entity_uuid, name, compartment):
+        super(SyntheticFlow, self).__init__(entity_uuid, name, Compartment=[compartment])
+        self._cfs = dict()
+
+    def has_characterization(self, quantity):
+        return quantity in self._cfs
+
+    def cf(self, quantity):
+        return self._cfs[quantity]
+
+    factor = cf
+
+    def add_characterization(self, cf):
+        self._cfs[cf.quantity] = cf.value
+
+
+class SyntheticExchange(object):
+    def __init__(self, process, flow, direction, value, termination=None):
+        self.process = process
+        self.flow = flow
+        self.direction = direction
+        self.value = value
+        self.termination = termination
+
+    def __getitem__(self, reference):
+        """
+        :param reference: a reference exchange of the same process
+        :return: the exchange value allocated to the reference
+        """
+        return self.process.allocated_value(self, reference)
+
+
+class SyntheticProcess(SyntheticEntity):
+    def __init__(self, entity_uuid, name):
+        super(SyntheticProcess, self).__init__(entity_uuid, name, SpatialScope='GLO')
+        self._exchanges = []
+        self.reference_entity = set()
+        self._allocation = None  # reference exchange -> allocation factor
+
+    def add_exchange(self, flow, direction, value, reference=False, termination=None):
+        x = SyntheticExchange(self, flow, direction, value, termination=termination)
+        self._exchanges.append(x)
+        if reference:
+            self.reference_entity.add(x)
+        return x
+
+    def exchanges(self):
+        return iter(self._exchanges)
+
+    def references(self):
+        return iter(self.reference_entity)
+
+    def reference(self, flow):
+        for x in self.reference_entity:
+            if x.flow is flow:
+                return x
+
+    find_reference = reference
+
+    def allocate(self, factors):
+        """
+        :param factors: dict mapping each reference exchange to its share of the non-reference exchanges
+        """
+        self._allocation = dict(factors)
+
+    def allocate_by_quantity(self, quantity):
+        """
+        Allocate in proportion to reference exchange values (all reference flows are measured in the same unit)
+        """
+        total = sum(x.value for x in self.reference_entity)
+        self.allocate(dict((x, x.value / total) for x in self.reference_entity))
+
+    def is_allocated(self, reference):
+        return len(self.reference_entity) == 1 or self._allocation is not None
+
+    def allocated_value(self, exchange, reference):
+        if exchange in self.reference_entity:
+            return exchange.value if exchange is reference else 0.0
+        if len(self.reference_entity) == 1:
+            return exchange.value
+        if self._allocation is None:
+            raise TypeError('Process %s is not allocated' % self)
+        return exchange.value * self._allocation[reference]
+
+
+class SyntheticArchive(object):
+    def __init__(self):
+        self._processes = []
+        self._entities = dict()
+        self._producers = dict()  # flow uuid -> list of processes with that reference flow
+        self._markets = dict()  # (flow uuid, direction) -> mixing process
+
+    def add_process(self, process):
+        self._processes.append(process)
+        self._entities[process.external_ref] = process
+        for x in process.references():
+            self._producers.setdefault(x.flow.uuid, []).append(process)
+
+    def processes(self):
+        return self._processes
+
+    def __getitem__(self, item):
+        return self._entities[item]
+
+    def terminate(self, flow, direction=None):
+        return list(self._producers.get(flow.uuid, []))
+
+    def mix(self, flow, direction):
+        """
+        A market process producing flow from an equal mix of all its producers.  Market inputs are explicitly
+        terminated, so they are not ambiguous themselves.
+        """
+        key = (flow.uuid, direction)
+        if key not in self._markets:
+            producers = self.terminate(flow, direction)
+            market = SyntheticProcess(str(uuid.uuid5(uuid.NAMESPACE_OID, '%s/%s' % key)), 'market for %s' % flow)
+            market.add_exchange(flow, 'Output', 1.0, reference=True)
+            for p in producers:
+                market.add_exchange(flow, 'Input', 1.0 / len(producers), termination=p.external_ref)
+            self._entities[market.external_ref] = market
+            self._markets[key] = market
+        return self._markets[key]
+
+
+class SyntheticCompartments(object):
+    elementary = ('air', 'water', 'soil', 'natural resource', 'resource')
+
+    def is_elementary(self, flow):
+        return flow['Compartment'][0] in self.elementary
+
+
+class SyntheticFlowDb(object):
+    """
+    Stands in for the flow database passed to ForegroundFragment.  Characterization factors are stored on the flows
+    themselves, so lookup_single_cf finds nothing further.
+    """
+    def __init__(self):
+        self.compartments = SyntheticCompartments()
+
+    def lookup_single_cf(self, flow, quantity):
+        return None
+
+
+def synthetic_archive(n_processes, fg_fraction=0.05, scc_fraction=0.8, chain=5, multi_output=0.2, ambiguous=0.0,
+                      n_emissions=1000, inputs=4, emissions=5, seed=0):
+    """
+    Generate a reproducible synthetic archive.
+    :param n_processes: number of single- or multi-output processes (markets created by mix() are extra)
+    :param fg_fraction: [0.05] fraction of processes in the foreground
+    :param scc_fraction: [0.8] fraction of background processes in the giant SCC; the rest form an acyclic supply
+     chain beneath it
+    :param chain: [5] foreground depth: length of each foreground chain
+    :param multi_output: [0.2] fraction of foreground processes with a coproduct; alternately allocated (by value)
+     and unallocated
+    :param ambiguous: [0.0] fraction of giant-SCC products that get a second, alternative producer (an extra process)
+    :param n_emissions: [1000] number of distinct elementary flows
+    :param inputs: [4] number of random background inputs per background process
+    :param emissions: [5] number of emissions per process
+    :param seed: [0]
+    :return: SyntheticArchive; its `lcia` attribute is a SyntheticQuantity characterizing every other emission
+    """
+    rng = random.Random(seed)
+
+    def _uuid():
+        return str(uuid.UUID(int=rng.getrandbits(128)))
+
+    compartments = ('air', 'water', 'soil')
+    elementary = [SyntheticFlow(_uuid(), 'emission %d' % k, compartments[k % 3]) for k in range(n_emissions)]
+    lcia = SyntheticQuantity(_uuid(), 'synthetic LCIA method')
+    for f in elementary[::2]:
+        f.add_characterization(SyntheticCharacterization(f, lcia, rng.random()))
+
+    def _process(name, flow=None):
+        p = SyntheticProcess(_uuid(), 'process %s' % name)
+        if flow is None:
+            flow = SyntheticFlow(_uuid(), 'product %s' % name, 'product')
+        p.add_exchange(flow, 'Output', 1.0 + rng.random(), reference=True)
+        for k in rng.sample(range(n_emissions), min(emissions, n_emissions)):
+            p.add_exchange(elementary[k], 'Output', rng.random())
+        return p, flow
+
+    n_fg = int(n_processes * fg_fraction)
+    n_bg = n_processes - n_fg
+    n_scc = max(int(n_bg * scc_fraction), min(n_bg, 2))
+    archive = SyntheticArchive()
+    archive.lcia = lcia
+
+    # acyclic supply chain: each process draws only on lower-numbered ones
+    supply = [_process('supply %d' % i) for i in range(n_bg - n_scc)]
+    for i, (p, _) in enumerate(supply):
+        for j in rng.sample(range(i), min(inputs, i)):
+            p.add_exchange(supply[j][1], 'Input', rng.random() * 0.2)
+
+    # giant SCC: a ring, plus random dependencies within the SCC and on the supply chain
+    scc = [_process('scc %d' % i) for i in range(n_scc)]
+    for i, (p, _) in enumerate(scc):
+        p.add_exchange(scc[(i + 1) % n_scc][1], 'Input', 0.05)
+        for j in rng.sample(range(n_scc), min(inputs, n_scc)):
+            if j != i:
+                p.add_exchange(scc[j][1], 'Input', rng.random() * 0.1)
+        if len(supply) > 0:
+            p.add_exchange(supply[rng.randrange(len(supply))][1], 'Input', rng.random() * 0.1)
+
+    for p, _ in supply + scc:
+        archive.add_process(p)
+
+    for i in rng.sample(range(n_scc), int(n_scc * ambiguous)):
+        p, _ = _process('alternative scc %d' % i, flow=scc[i][1])
+        p.add_exchange(scc[(i + 1) % n_scc][1], 'Input', 0.05)
+        archive.add_process(p)
+
+    upstream = None
+    for i in range(n_fg):
+        p, f = _process('fg %d' % i)
+        for j in rng.sample(range(n_scc), min(2, n_scc)):
+            p.add_exchange(scc[j][1], 'Input', rng.random())
+        if upstream is not None and i % chain != 0:
+            p.add_exchange(upstream, 'Input', 0.5)
+        if rng.random() < multi_output:
+            co = SyntheticFlow(_uuid(), 'coproduct fg %d' % i, 'product')
+            p.add_exchange(co, 'Output', 0.5, reference=True)
+            if i % 2 == 0:
+                p.allocate_by_quantity(None)
+        upstream = f
+        archive.add_process(p)
+
+    return archive
+
+
+def deep_call(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) in a thread with a large stack and a raised recursion limit, for traversals of
+    archives whose depth-first paths exceed the default limit.  The engine's recursion guard is calibrated for the
+    default stack, so it is lifted for the duration.
+    :param func:
+    :param stack_size: [1 GiB] thread stack size in bytes
+    :param recursion_limit: [200000]
+    :return: func's return value
+    """
+    from lcamatrix import background
+    stack_size = kwargs.pop('stack_size', 1 << 30)
+    recursion_limit = kwargs.pop('recursion_limit', 200000)
+    result = []
+    errors = []
+
+    def _run():
+        try:
+            result.append(func(*args, **kwargs))
+        except Exception as e:
+            errors.append(e)
+
+    old_stack = threading.stack_size(stack_size)
+    old_limit = sys.getrecursionlimit()
+    old_guard = background.MAX_SAFE_RECURSION_LIMIT
+    sys.setrecursionlimit(recursion_limit)
+    background.MAX_SAFE_RECURSION_LIMIT = recursion_limit
+    try:
+        t = threading.Thread(target=_run)
+        t.start()
+        t.join()
+    finally:
+        threading.stack_size(old_stack)
+        sys.setrecursionlimit(old_limit)
+        background.MAX_SAFE_RECURSION_LIMIT = old_guard
+    if errors:
+        raise errors[0]
+    return result[0]
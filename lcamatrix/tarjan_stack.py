@@ -9,9 +9,9 @@ class TarjanStack(object):
     """
     def __init__(self):
         self._stack = []
-        self._stack_hash = set()
+        self._on_stack = bytearray()  # flag for each product flow index: 1 if on the stack
         self._sccs = defaultdict(set)  # dict mapping lowest index (lowlink = SCC ID) to the set of scc peers
-        self._scc_of = dict()  # dict mapping product flow to SCC ID (reverse mapping of _sccs)
+        self._scc_of = dict()  # dict mapping product flow index to SCC ID (reverse mapping of _sccs)
 
         self._component_cols_by_row = defaultdict(set)  # nonzero columns in given row (upstream dependents)
         self._component_rows_by_col = defaultdict(set)  # nonzero rows in given column (downstream dependencies)
@@ -20,8 +20,9 @@ class TarjanStack(object):
         self._downstream = set()  # sccs on which background depends
 
         self._bg_processes = []  # ordered list of background nodes
+        self._bg_version = 0  # incremented whenever the background index changes
         self._fg_processes = []  # ordered list of foreground nodes
-        self._bg_index = dict()  # maps product_flow.index to a* / b* column -- STATIC
+        self._bg_index = dict()  # maps product_flow.index to a* / b* column -- renumbered by permute_bg_index
         self._fg_index = dict()  # maps product_flow.index to af / ad/ bf column -- VOLATILE
 
     def check_stack(self, product_flow):
@@ -29,29 +30,32 @@ class TarjanStack(object):
         :param product_flow:
         :return:
         """
-        return product_flow in self._stack_hash
+        index = product_flow.index
+        return index < len(self._on_stack) and self._on_stack[index] == 1
 
     def add_to_stack(self, product_flow):
         if not isinstance(product_flow, ProductFlow):
             raise TypeError('TarjanStack should consist only of ProductFlows')
         if self.check_stack(product_flow):
             raise ValueError('ProductFlow already in stack')
+        index = product_flow.index
+        if index >= len(self._on_stack):
+            self._on_stack.extend(bytearray(max(index + 1 - len(self._on_stack), len(self._on_stack))))
         self._stack.append(product_flow)
-        self._stack_hash.add(product_flow)
+        self._on_stack[index] = 1
 
-    def label_scc(self, index, key):
+    def label_scc(self, index):
         """
 
         :param index: the index of the lowest link in the SCC-- becomes scc ID
-        :param key: the identifier for the lowest link in the SCC (necessary to ID the link)
         :return:
         """
         while 1:
             node = self._stack.pop()
-            self._stack_hash.remove(node)
+            self._on_stack[node.index] = 0
             self._sccs[index].add(node)
-            self._scc_of[node] = index
-            if node.key == key:
+            self._scc_of[node.index] = index
+            if node.index == index:
                 break
 
     def _set_background(self):
@@ -62,13 +66,19 @@ class TarjanStack(object):
                 ml = len(t)
                 ind = i
         if ml > 1:
+            if ind != self._background:
+                # a different SCC has become the background: start over
+                self._downstream = set()
+                self._bg_processes = []
+                self._bg_index = dict()
             self._background = ind
             self._set_downstream()
             self._generate_bg_index()
 
     def _set_downstream(self, upstream=None):
         """
-        recursive function to tag all nodes downstream of the named node.
+        tag all nodes downstream of the named node.  Uses an explicit stack rather than recursion, so the depth of the
+        component graph is not limited by the recursion limit.
         :param upstream: [None] if none, use background
         :return:
         """
@@ -77,13 +87,22 @@ class TarjanStack(object):
                 return
             upstream = self._background
 
-        for dep in self._component_rows_by_col[upstream]:
-            if dep != upstream:  # skip self-dependencies
-                self._downstream.add(dep)
-                self._set_downstream(dep)
+        queue = [upstream]
+        while len(queue) > 0:
+            current = queue.pop()
+            for dep in self._component_rows_by_col[current]:
+                if dep != current and dep not in self._downstream:  # skip self-dependencies and tagged nodes
+                    self._downstream.add(dep)
+                    queue.append(dep)
 
     def _generate_bg_index(self):
+        """
+        The index is extended in place, so existing A* / B* columns keep their positions as the background grows.  If
+        a different (larger) SCC becomes the background, _set_background clears the index first.
+        """
         if self._background is None:
+            if len(self._bg_processes) > 0:
+                self._bg_version += 1
             self._bg_processes = []
             self._bg_index = dict()
         else:
@@ -94,8 +113,24 @@ class TarjanStack(object):
                 for j in self.scc(i):
                     bg.append(j)
 
-            self._bg_processes = bg
-            self._bg_index = dict((pf.index, n) for n, pf in enumerate(bg))  # mapping of *pf* index to a-matrix index
+            new = [pf for pf in bg if pf.index not in self._bg_index]
+            if len(new) > 0:
+                for pf in new:
+                    self._bg_index[pf.index] = len(self._bg_processes)  # mapping of *pf* index to a-matrix index
+                    self._bg_processes.append(pf)
+                self._bg_version += 1
+
+    def permute_bg_index(self, perm):
+        """
+        Reorders the background index: the node at background position perm[i] moves to position i.
+        :param perm: permutation of range(ndim)
+        :return:
+        """
+        if sorted(perm) != list(range(len(self._bg_processes))):
+            raise ValueError('Not a permutation of the background index')
+        self._bg_processes = [self._bg_processes[i] for i in perm]
+        self._bg_index = dict((pf.index, n) for n, pf in enumerate(self._bg_processes))
+        self._bg_version += 1
 
     def _generate_foreground_index(self):
         """
@@ -128,6 +163,25 @@ class TarjanStack(object):
 
         self._fg_index = dict((pf.index, n) for n, pf in enumerate(self._fg_processes))
 
+    def set_components(self, product_flows, scc_ids, rows, cols):
+        """
+        Populates the SCCs and the component graph directly from a precomputed strong-components labeling, in place of
+        the traversal (add_to_stack / label_scc / add_to_graph).
+        :param product_flows: sequence of ProductFlows
+        :param scc_ids: parallel sequence of SCC IDs (the index of the lowest ProductFlow in each SCC)
+        :param rows: SCC ID of the term of each interior exchange
+        :param cols: SCC ID of the parent of each interior exchange (parallel to rows)
+        :return:
+        """
+        for pf, k in zip(product_flows, scc_ids):
+            self._sccs[k].add(pf)
+            self._scc_of[pf.index] = k
+        for row, col in set(zip(rows, cols)):
+            self._component_cols_by_row[row].add(col)
+            self._component_rows_by_col[col].add(row)
+        self._set_background()
+        self._generate_foreground_index()
+
     def add_to_graph(self, interiors):
         """
         take a list of interior exchanges (parent, term, exch) and add them to the component graph
@@ -145,6 +199,10 @@ class TarjanStack(object):
     def background(self):
         return self._background
 
+    @property
+    def bg_version(self):
+        return self._bg_version
+
     @property
     def ndim(self):
         return len(self._bg_index)
@@ -195,7 +253,7 @@ class TarjanStack(object):
         """
         for pf in self._fg_processes:
             if outputs:
-                k = self._scc_of[pf]
+                k = self._scc_of[pf.index]
                 if len(self._component_cols_by_row[k]) > 0:
                     return  # cut out early since fg_processes is ordered
             yield pf
@@ -215,6 +273,7 @@ class TarjanStack(object):
         :param bg_index: row / column number of A* or column of B*
         :return: ProductFlow
         """
+        return self._bg_processes[bg_index]
 
     def bg_dict(self, pf_index):
         """
@@ -259,7 +318,7 @@ class TarjanStack(object):
         return pf in self._bg_index
 
     def scc_id(self, pf):
-        return self._scc_of[pf]
+        return self._scc_of[pf.index]
 
     def sccs(self):
         return self._sccs.keys()
@@ -273,5 +332,5 @@ class TarjanStack(object):
         :param pf:
         :return:
         """
-        for i in self._sccs[self._scc_of[pf]]:
+        for i in self._sccs[self._scc_of[pf.index]]:
             yield i
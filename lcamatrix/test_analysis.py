@@ -0,0 +1,179 @@
+"""
+Tests for the analyses built on the background factorization: perturbation and sensitivity, Monte Carlo and
+structural path analysis.  Run against synthetic archives (see lcamatrix.synthetic).
+"""
+import unittest
+
+import numpy as np
+from scipy.sparse import csc_matrix, identity, issparse
+from scipy.sparse.linalg import spsolve
+
+from lcamatrix.background import BackgroundEngine
+from lcamatrix.monte_carlo import RunningStats
+from lcamatrix.path_analysis import StructuralPathAnalysis
+from lcamatrix.synthetic import synthetic_archive
+
+
+def _engine(archive):
+    engine = BackgroundEngine(archive)
+    engine.add_all_ref_products()
+    return engine
+
+
+def _vector(v):
+    if issparse(v):
+        v = v.toarray()
+    return np.asarray(v, dtype=float).ravel()
+
+
+def _direct(a, b, ad):
+    """
+    LCI by a direct solve against explicitly built matrices
+    """
+    x = spsolve(csc_matrix(identity(a.shape[0], format='csc') - a), ad)
+    return x, b.dot(x)
+
+
+class PerturbationTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = _engine(synthetic_archive(300, n_emissions=50, seed=1))
+        cls.bg = list(cls.engine.background_flows())
+        cls.rng = np.random.RandomState(0)
+        cls.e = cls.rng.rand(cls.engine.mdim)
+
+    def _demand(self, pf):
+        ad = np.zeros(self.engine.tstack.ndim)
+        ad[self.engine.tstack.bg_dict(pf.index)] = 1.0
+        return ad
+
+    def test_woodbury_matches_rebuilt(self):
+        p = self.engine.perturbation()
+        a = self.engine._a_matrix.tolil()
+        b = self.engine._b_matrix.tolil()
+        rows, cols = self.engine._a_matrix.nonzero()
+        for k in self.rng.choice(len(rows), 4, replace=False):  # existing entries
+            delta = 0.1 * self.rng.rand()
+            p.perturb_a(self.bg[cols[k]], self.bg[rows[k]], delta)
+            a[rows[k], cols[k]] += delta
+        p.perturb_a(self.bg[3], self.bg[7], 0.05)  # a new entry
+        a[7, 3] += 0.05
+        em = self.engine.emissions[5]
+        p.perturb_b(self.bg[2], em, 0.5)
+        b[em.index, 2] += 0.5
+
+        for pf in self.bg[:5] + list(self.engine.foreground_flows())[:3]:
+            ad, bf = self.engine.lci_demand(pf)
+            _, bx = _direct(a.tocsr(), b.tocsr(), _vector(ad))
+            if bf is not None:
+                bx = bx + _vector(bf)
+            self.assertTrue(np.allclose(_vector(p.compute_lci(pf)), bx))
+
+    def test_survives_reordering(self):
+        engine = _engine(synthetic_archive(300, n_emissions=50, seed=1))
+        bg = list(engine.background_flows())
+        p = engine.perturbation()
+        p.perturb_a(bg[3], bg[7], 0.05)
+        p.perturb_b(bg[2], engine.emissions[5], 0.5)
+        flows = bg[:5] + list(engine.foreground_flows())[:3]
+        before = [_vector(p.compute_lci(pf)) for pf in flows]
+        version = engine.version
+        engine.reorder_background()
+        self.assertNotEqual(engine.version, version)
+        for pf, lci in zip(flows, before):
+            self.assertTrue(np.allclose(_vector(p.compute_lci(pf)), lci))
+        p.reset()
+        for pf in flows:
+            self.assertTrue(np.allclose(_vector(p.compute_lci(pf)), _vector(engine.compute_lci(pf))))
+
+    def test_adjoint_matches_finite_differences(self):
+        p = self.engine.perturbation()
+        ad = self._demand(self.bg[0])
+        score, da, db = p.sensitivities(ad, self.e)
+        a = self.engine._a_matrix
+        b = self.engine._b_matrix
+        self.assertAlmostEqual(score, self.e.dot(_direct(a, b, ad)[1]))
+
+        h = 1e-6
+        rows, cols = a.nonzero()
+        for k in self.rng.choice(len(rows), 5, replace=False):
+            i, j = rows[k], cols[k]
+            step = csc_matrix(([h], ([i], [j])), shape=a.shape)
+            up = self.e.dot(_direct(a + step, b, ad)[1])
+            down = self.e.dot(_direct(a - step, b, ad)[1])
+            self.assertTrue(np.isclose(da[i, j], (up - down) / (2 * h), rtol=1e-4, atol=1e-9))
+
+        rows, cols = b.nonzero()
+        for k in self.rng.choice(len(rows), 5, replace=False):
+            i, j = rows[k], cols[k]
+            step = csc_matrix(([h], ([i], [j])), shape=b.shape)
+            up = self.e.dot(_direct(a, b + step, ad)[1])
+            down = self.e.dot(_direct(a, b - step, ad)[1])
+            self.assertTrue(np.isclose(db[i, j], (up - down) / (2 * h), rtol=1e-4, atol=1e-9))
+
+
+class MonteCarloTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = _engine(synthetic_archive(200, n_emissions=50, seed=3))
+        cls.e = np.random.RandomState(1).rand(1, cls.engine.mdim)
+
+    def test_merge(self):
+        rng = np.random.RandomState(2)
+        samples = [rng.randn(n, 3) * [1.0, 10.0, 0.1] + [0.0, 5.0, -1.0] for n in (7, 1, 40, 0, 13)]
+        merged = RunningStats(3, reservoir=20, seed=0)
+        for part in samples:
+            stats = RunningStats(3, reservoir=20, seed=0)
+            for value in part:
+                stats.add(value)
+            merged.merge(stats)
+        everything = np.vstack(samples)
+        self.assertEqual(merged.count, len(everything))
+        self.assertTrue(np.allclose(merged.mean, np.mean(everything, axis=0)))
+        self.assertTrue(np.allclose(merged.variance, np.var(everything, axis=0, ddof=1)))
+        self.assertEqual(len(merged.samples), 20)
+
+    def test_mean_matches_deterministic(self):
+        pf = next(self.engine.foreground_flows())
+        score = self.e.dot(self.engine.compute_lci(pf, threshold=1e-14, count=5000).toarray()).ravel()
+        mc = self.engine.monte_carlo(a_spread=0.05, b_spread=0.05, distribution='normal')
+        stats = mc.run(pf, iterations=200, e=self.e, workers=2, seed=42)
+        self.assertEqual(stats.count, 200)
+        self.assertTrue(np.allclose(stats.mean, score, rtol=5e-3))
+        self.assertGreater(stats.std[0], 0)
+        again = mc.run(pf, iterations=200, e=self.e, workers=2, seed=42)
+        self.assertTrue(np.allclose(again.mean, stats.mean))
+
+
+class PathAnalysisTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = _engine(synthetic_archive(200, n_emissions=50, seed=4))
+        cls.e = np.random.RandomState(3).rand(1, cls.engine.mdim)
+
+    def _score(self, pf):
+        ad, _ = self.engine.lci_demand(pf)
+        _, bx = self.engine.solve_bg_lci(ad)
+        return self.e.dot(bx.toarray()).item()
+
+    def test_paths_plus_residual(self):
+        spa = StructuralPathAnalysis(self.engine, self.e)
+        for pf in list(self.engine.foreground_flows())[:3] + list(self.engine.background_flows())[:3]:
+            score = self._score(pf)
+            paths = spa.paths(pf, cutoff=1e-4, max_paths=10 ** 6)
+            self.assertGreater(len(paths), 0)
+            self.assertAlmostEqual(sum(p.direct for p in paths) + spa.residual, score)
+            self.assertAlmostEqual(spa.covered + spa.residual, score)
+            self.assertLess(abs(spa.residual), abs(score) * 0.5)
+
+    def test_bounded_search(self):
+        spa = StructuralPathAnalysis(self.engine, self.e)
+        pf = next(self.engine.foreground_flows())
+        paths = spa.paths(pf, cutoff=1e-3, max_paths=5, max_expansions=100, max_depth=3)
+        self.assertLessEqual(len(paths), 5)
+        self.assertTrue(all(len(p.flows) <= 4 for p in paths))
+        self.assertAlmostEqual(spa.covered + spa.residual, self._score(pf))
+
+
+if __name__ == '__main__':
+    unittest.main()
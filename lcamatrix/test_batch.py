@@ -0,0 +1,150 @@
+"""
+Tests for batch LCI computation and LCI file output, run against synthetic archives (see lcamatrix.synthetic).
+"""
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lcamatrix import batch
+from lcamatrix.background import BackgroundEngine
+from lcamatrix.batch import BatchLci, fork_context, fork_map, ordered_map
+from lcamatrix.lci_writer import LciWriter, read_lci
+from lcamatrix.synthetic import synthetic_archive
+
+
+def _engine(archive):
+    engine = BackgroundEngine(archive)
+    engine.add_all_ref_products()
+    return engine
+
+
+def _square(shared, item):
+    return shared * item * item
+
+
+class _Unpicklable(object):
+    def __init__(self, factor):
+        self.factor = factor
+        self.lock = threading.Lock()
+
+
+def _scale(shared, item):
+    return shared.factor * item
+
+
+class BatchLciTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = _engine(synthetic_archive(300, n_emissions=50, seed=1))
+        cls.flows = list(cls.engine.foreground_flows(outputs=False)) + list(cls.engine.background_flows())[:20]
+        cls.sequential = [cls.engine.compute_lci(pf).toarray() for pf in cls.flows]
+
+    def _check(self, batch):
+        results = list(batch.lci(self.flows))
+        self.assertEqual([pf for pf, _ in results], self.flows)
+        for (_, lci), expected in zip(results, self.sequential):
+            self.assertTrue(np.allclose(lci.toarray(), expected))
+
+    def test_threads(self):
+        self._check(BatchLci(self.engine, workers=3, max_pending=2))
+
+    def test_serial(self):
+        self._check(BatchLci(self.engine, workers=1))
+
+    @unittest.skipIf(fork_context() is None, 'fork start method unavailable')
+    def test_processes(self):
+        self._check(BatchLci(self.engine, workers=2, max_pending=3, processes=True))
+
+    def test_bounded(self):
+        submitted = []
+        in_flight = []
+
+        def _items():
+            for k in range(50):
+                submitted.append(k)
+                yield k
+
+        with ThreadPoolExecutor(max_workers=4) as ex:
+            for n, result in enumerate(ordered_map(lambda k: k * k, _items(), ex, 5)):
+                self.assertEqual(result, n * n)
+                in_flight.append(len(submitted) - n)
+        self.assertLessEqual(max(in_flight), 5)
+
+    def test_fork_map(self):
+        self.assertEqual(list(fork_map(_square, 2, range(10), workers=3)), [2 * k * k for k in range(10)])
+        self.assertEqual(list(fork_map(_square, 2, range(10), workers=1)), [2 * k * k for k in range(10)])
+
+    @unittest.skipIf(fork_context() is None, 'fork start method unavailable')
+    def test_fork_map_interleaved(self):
+        first = fork_map(_square, 2, range(20), workers=2, max_pending=2)
+        second = fork_map(_square, 3, range(20), workers=2, max_pending=2)
+        results = [(next(first), next(second)) for _ in range(20)]
+        self.assertIsNone(batch._SHARED)  # the payload never passes through the parent's module state
+        self.assertEqual(results, [(2 * k * k, 3 * k * k) for k in range(20)])
+
+    @unittest.skipIf(fork_context() is None, 'fork start method unavailable')
+    def test_fork_map_inherits_shared(self):
+        self.assertEqual(list(fork_map(_scale, _Unpicklable(5), range(6), workers=2)), [5 * k for k in range(6)])
+
+
+class LciWriterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = _engine(synthetic_archive(200, n_emissions=50, seed=2))
+        cls.flows = list(cls.engine.all_flows())
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _check_complete(self):
+        stored = list(read_lci(self.dir))
+        keys = [k for k, _ in stored]
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(set(keys), set(pf.key for pf in self.flows))
+        lcis = dict(stored)
+        for pf in self.flows[::10]:
+            self.assertTrue(np.allclose(lcis[pf.key].toarray(), self.engine.compute_lci(pf).toarray()))
+
+    def test_resume(self):
+        writer = LciWriter(self.dir, chunk_size=7)
+        writer.write(self.engine.generate_lci(self.flows[:20]))  # interrupted: 6 buffered columns are never flushed
+        self.assertEqual(len(list(read_lci(self.dir))), 14)
+
+        resumed = LciWriter(self.dir, chunk_size=7)
+        self.assertEqual(len(resumed.done), 14)
+        self.assertEqual(resumed.write_all(self.engine), len(self.flows) - 14)
+        self._check_complete()
+        self.assertEqual(LciWriter(self.dir).write_all(self.engine), 0)
+
+    def test_none_key_round_trip(self):
+        class _Flow(object):
+            def __init__(self, index, key):
+                self.index = index
+                self.key = key
+
+        flows = [_Flow(0, ('flow-a', None)), _Flow(1, ('flow-b', 'process-b')), _Flow(2, (None, 'None'))]
+        with LciWriter(self.dir, chunk_size=2) as writer:
+            writer.write((pf, np.ones((3, 1)) * pf.index) for pf in flows)
+        self.assertEqual([k for k, _ in read_lci(self.dir)], [pf.key for pf in flows])
+        resumed = LciWriter(self.dir)
+        self.assertEqual(resumed.done, set(pf.key for pf in flows))
+        self.assertEqual(resumed.write((pf, np.zeros((3, 1))) for pf in flows), 3)
+        resumed.close()
+        self.assertEqual(len(list(read_lci(self.dir))), 3)
+
+    def test_resume_batch(self):
+        with LciWriter(self.dir, chunk_size=9) as writer:
+            writer.write(self.engine.generate_lci(self.flows[:30]))
+        LciWriter(self.dir, chunk_size=9).write_all(self.engine, batch=BatchLci(self.engine, workers=2))
+        self._check_complete()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Import-time regression tests.  `import lcamatrix.background` should cost little beyond numpy and scipy.sparse, which
+the engine's data structures require; solvers, graph routines, analysis modules and optional dependencies (pandas,
+lcatools) are imported by the features that use them.
+"""
+import os
+import subprocess
+import sys
+import unittest
+
+
+IMPORT_BUDGET = float(os.environ.get('LCAMATRIX_IMPORT_BUDGET', 0.1))  # seconds, excluding CORE
+CORE = ('numpy', 'scipy', 'scipy.sparse')
+DEFERRED = ('pandas', 'lcatools', 'scipy.sparse.linalg', 'scipy.sparse.csgraph', 'lcamatrix.sensitivity',
+            'lcamatrix.monte_carlo', 'lcamatrix.path_analysis')
+
+
+def _run(module, code=''):
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s\n%s' % (module, code)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def import_times(module):
+    """
+    Import module in a fresh interpreter under -X importtime.
+    :param module:
+    :return: list of (self seconds, cumulative seconds, depth, name) in the order reported (children before parents)
+    """
+    times = []
+    for line in _run(module).stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # header
+        name = fields[2].rstrip()
+        depth = len(name) - len(name.lstrip())
+        times.append((int(fields[0]) * 1e-6, int(fields[1]) * 1e-6, depth, name.strip()))
+    return times
+
+
+def excluding_core(times):
+    """
+    :param times: output of import_times
+    :return: total seconds spent outside the subtrees of CORE packages (other scipy subpackages count)
+    """
+    total = 0.0
+    core_depth = None
+    for self_time, _, depth, name in reversed(times):  # parents before children
+        if core_depth is not None and depth > core_depth:
+            continue
+        core_depth = None
+        if name in CORE:
+            core_depth = depth
+            continue
+        total += self_time
+    return total
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_background_budget(self):
+        elapsed = min(excluding_core(import_times('lcamatrix.background')) for _ in range(3))
+        self.assertLess(elapsed, IMPORT_BUDGET)
+
+    def test_deferred_modules(self):
+        for module in ('lcamatrix.background', 'lcamatrix.foreground_display'):
+            try:
+                out = _run(module, 'import sys; print("\\n".join(sys.modules))').stdout.split()
+            except subprocess.CalledProcessError:
+                continue  # module's own dependencies are not installed
+            loaded = [k for k in out if k.startswith(DEFERRED)]
+            self.assertEqual(loaded, [], '%s loads %s' % (module, loaded))
+
+
+if __name__ == '__main__':
+    unittest.main()
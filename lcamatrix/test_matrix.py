@@ -1,7 +1,349 @@
 """
-What do we want these here tools to do?
+Tests for the matrix engine, run against synthetic archives (see lcamatrix.synthetic).
+"""
+import unittest
+
+import numpy as np
+from scipy.sparse import csr_matrix, identity
+from scipy.sparse.linalg import spsolve
+
+from lcamatrix.background import BackgroundEngine
+from lcamatrix.foreground import ForegroundFragment
+from lcamatrix.lci_cache import LciCache
+from lcamatrix.product_flow import ProductFlow
+from lcamatrix.synthetic import synthetic_archive, SyntheticFlowDb, SyntheticProcess
+
+
+def _engine(archive, **kwargs):
+    engine = BackgroundEngine(archive)
+    engine.add_all_ref_products(**kwargs)
+    return engine
+
+
+def _lci(engine, pf):
+    return engine.compute_lci(pf, threshold=1e-14, count=5000).toarray().ravel()
+
+
+def _raw_foreground(engine, pf):
+    """
+    Af, Ad, Bf for a foreground flow, built directly from the engine's foreground and cutoff entries
+    """
+    fg_dict = dict((p.index, n) for n, p in enumerate(engine.foreground(pf)))
+    af, ad = [], []
+    for x in engine._foreground:
+        if x.parent.index in fg_dict:
+            if engine.is_background(x.term.index):
+                ad.append([engine.tstack.bg_dict(x.term.index), fg_dict[x.parent.index], x.value])
+            else:
+                af.append([fg_dict[x.term.index], fg_dict[x.parent.index], x.value])
+    bf = [[x.emission.index, fg_dict[x.parent.index], x.value] for x in engine._cutoff if x.parent.index in fg_dict]
+    pdim = len(fg_dict)
+    return (BackgroundEngine.construct_sparse(np.array(af), pdim, pdim),
+            BackgroundEngine.construct_sparse(np.array(ad), engine.tstack.ndim, pdim),
+            BackgroundEngine.construct_sparse(np.array(bf), engine.mdim, pdim))
+
+
+def _same(a, b):
+    return a.shape == b.shape and (a != b).nnz == 0
+
+
+class LciCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = LciCache(max_bytes=3 * 8)
+        for k in range(3):
+            cache.put(k, np.zeros(1), 0)
+        cache.get(0, 0)
+        cache.put(3, np.zeros(1), 0)
+        self.assertEqual(sorted(cache._results), [0, 2, 3])
+        self.assertEqual(cache.stats().evictions, 1)
+        cache.put(4, np.zeros(4), 0)
+        self.assertNotIn(4, cache)
+        self.assertIsNone(cache.get(0, 1))
+        self.assertEqual(len(cache), 0)
+
+
+class TripletsTest(unittest.TestCase):
+    rows = np.array([0, 2, 1, 2, 0], dtype=np.int32)
+    cols = np.array([1, 0, 1, 0, 1], dtype=np.int32)
+    data = np.array([1.0, 2.0, 3.0, 4.0, 0.5])
+
+    def test_sum_duplicates(self):
+        for fmt in ('csr', 'csc'):
+            mat = BackgroundEngine.construct_typed(self.rows, self.cols, self.data, 3, 2, fmt=fmt)
+            self.assertEqual(mat.format, fmt)
+            self.assertEqual(mat.nnz, 3)
+            self.assertTrue(np.array_equal(mat.toarray(), [[0.0, 1.5], [0.0, 3.0], [6.0, 0.0]]))
+
+    def test_duplicates_error(self):
+        with self.assertRaises(ValueError):
+            BackgroundEngine.construct_typed(self.rows, self.cols, self.data, 3, 2, duplicates='error')
+        mat = BackgroundEngine.construct_typed(self.rows[1:3], self.cols[1:3], self.data[1:3], 3, 2,
+                                               duplicates='error')
+        self.assertEqual(mat.nnz, 2)
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            BackgroundEngine.construct_typed(self.rows, self.cols, self.data, 3, 2, duplicates='first')
+
+    def test_matches_construct_sparse(self):
+        engine = _engine(synthetic_archive(200, n_emissions=50, seed=1))
+        bg_dict = engine.tstack.bg_dict
+        ndim = engine.tstack.ndim
+        typed = BackgroundEngine.construct_typed(*engine.triplets(engine._interior, lambda i: bg_dict(i.term.index),
+                                                                  lambda i: bg_dict(i.parent.index),
+                                                                  lambda i: i.value), nrows=ndim, ncols=ndim)
+        nums = np.array([[bg_dict(i.term.index), bg_dict(i.parent.index), i.value] for i in engine._interior])
+        # as construct_sparse was written before typed coordinates
+        untyped = csr_matrix((nums[:, 2], (nums[:, 0], nums[:, 1])), shape=(ndim, ndim))
+        self.assertEqual(typed.dtype, np.float64)
+        self.assertEqual(typed.indices.dtype, np.int32)
+        self.assertEqual((typed != untyped).nnz, 0)
+        self.assertEqual((BackgroundEngine.construct_sparse(nums, ndim, ndim) != untyped).nnz, 0)
+        self.assertEqual((typed != engine._a_matrix).nnz, 0)
+        empty = BackgroundEngine.triplets([], None, None, None)
+        self.assertEqual(BackgroundEngine.construct_typed(*empty, nrows=2, ncols=3).shape, (2, 3))
+
+
+class BackgroundEngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.archive = synthetic_archive(300, n_emissions=50, seed=1)
+        cls.engine = _engine(cls.archive)
+
+    def test_partition(self):
+        bg = self.engine.tstack.ndim
+        fg = self.engine.tstack.pdim
+        self.assertGreater(bg, 200)
+        self.assertGreater(fg, 0)
+        self.assertEqual(bg + fg, len(self.engine._pf_index))
+        for pf in self.engine.foreground_flows(outputs=False):
+            self.assertFalse(self.engine.is_background(pf))
+        for i, pf in enumerate(self.engine.background_flows()):
+            self.assertEqual(self.engine.tstack.bg_dict(pf.index), i)
+
+    def test_lci_matches_direct_solve(self):
+        n = self.engine.tstack.ndim
+        a = self.engine._a_matrix
+        b = self.engine._b_matrix
+        for pf in list(self.engine.background_flows())[:10]:
+            demand = np.zeros(n)
+            demand[self.engine.tstack.bg_dict(pf.index)] = 1.0
+            x = spsolve((identity(n, format='csc') - a).tocsc(), demand)
+            self.assertTrue(np.allclose(_lci(self.engine, pf), b.dot(x)))
+            ad, _ = self.engine.lci_demand(pf)
+            _, bx = self.engine.solve_bg_lci(ad)
+            self.assertTrue(np.allclose(bx.toarray().ravel(), b.dot(x)))
+
+    def test_foreground_lci(self):
+        for pf in self.engine.foreground_flows(outputs=False):
+            ad, bf = self.engine.lci_demand(pf)
+            _, bx = self.engine.solve_bg_lci(ad)
+            self.assertTrue(np.allclose(_lci(self.engine, pf), (bx + bf).toarray().ravel()))
+
+    def test_screening_bound(self):
+        lu = self.engine.factorize()
+        for pf in list(self.engine.background_flows())[:5]:
+            ad, _ = self.engine.lci_demand(pf)
+            x = lu.solve(ad.toarray().ravel())
+            for drop in (1e-2, 1e-4):
+                result = self.engine.screen_bg_lci(ad, drop=drop)
+                self.assertLess(result.x.nnz, self.engine.tstack.ndim)
+                self.assertLessEqual(abs(result.x.toarray().ravel() - x).sum(), result.error_bound)
+                self.assertLessEqual(abs(result.bx.toarray().ravel() - self.engine._b_matrix.dot(x)).sum(),
+                                     result.error_bound)
+
+    def test_demand_driven(self):
+        lazy = BackgroundEngine(self.archive)
+        fg = [p for p in self.archive.processes() if str(p).startswith('process fg')]
+        refs = [(x.flow, p) for p in fg[:10] for x in p.references()]
+        pfs = lazy.add_ref_products(refs[:3])
+        pfs += lazy.add_ref_products(refs[3:])
+        self.assertLess(len(lazy._pf_index), len(self.engine._pf_index))
+        emissions = [e.key for e in self.engine.emissions]
+        order = [emissions.index(e.key) for e in lazy.emissions]
+        full = dict((pf.key, pf) for pf in self.engine.all_flows())
+        for pf in pfs:
+            self.assertTrue(np.allclose(_lci(lazy, pf), _lci(self.engine, full[pf.key])[order]))
+
+    def test_make_foreground(self):
+        for pf in self.engine.foreground_flows(outputs=False):
+            for sliced, raw in zip(self.engine.make_foreground(pf), _raw_foreground(self.engine, pf)):
+                self.assertTrue(_same(sliced, raw))
+
+    def test_foreground_cache_dropped(self):
+        lazy = BackgroundEngine(self.archive)
+        fg = [p for p in self.archive.processes() if str(p).startswith('process fg')]
+        refs = [(x.flow, p) for p in fg for x in p.references()]
+        lazy.add_ref_products(refs[:3])
+        first = lazy.make_foreground()
+        self.assertIs(lazy._foreground_matrices(), first)
+        pfs = lazy.add_ref_products(refs[3:])  # extends the component graph
+        self.assertIsNone(lazy._fg_matrices)
+        af, ad, bf = lazy.make_foreground()
+        self.assertEqual(af.shape, (lazy.tstack.pdim, lazy.tstack.pdim))
+        self.assertGreater(lazy.tstack.pdim, first[0].shape[1])
+        for pf in pfs:
+            if not lazy.is_background(pf):
+                for sliced, raw in zip(lazy.make_foreground(pf), _raw_foreground(lazy, pf)):
+                    self.assertTrue(_same(sliced, raw))
+
+    def test_interned_keys(self):
+        engine = self.engine
+        self.assertTrue(all(isinstance(k, int) for k in engine._product_flows))
+        self.assertTrue(all(isinstance(k, int) for k in engine._emissions))
+        self.assertEqual(len(engine._product_flows), len(engine._pf_index))
+        self.assertEqual(len(engine._emissions), engine.mdim)
+        self.assertLess(len(engine._ids), 2 * len(engine._pf_index) + engine.mdim)  # uuids are shared, not copied
+        for pf in list(engine.all_flows())[::25]:
+            self.assertEqual(engine.index(pf), pf.index)
+            self.assertIs(engine.check_product_flow(pf.flow, pf.process), pf)
+        for em in engine.emissions[::10]:
+            self.assertIs(engine._add_emission(em.flow, em.direction), em)
+        unknown = SyntheticProcess('not-a-process', 'unknown process')
+        ids = len(engine._ids)
+        self.assertIsNone(engine.check_product_flow(engine.product_flow(0).flow, unknown))
+        self.assertEqual(len(engine._ids), ids)  # failed lookups do not intern
+
+    def test_from_matrices(self):
+        flows = [ProductFlow(i, pf.flow, pf.process) for i, pf in enumerate(self.engine.background_flows())]
+        engine = BackgroundEngine.from_matrices(self.engine._a_matrix, self.engine._b_matrix, flows,
+                                                self.engine.emissions)
+        self.assertEqual(engine.tstack.ndim, self.engine.tstack.ndim)
+        self.assertEqual(engine.tstack.pdim, 0)
+        for pf, orig in list(zip(flows, self.engine.background_flows()))[:10]:
+            self.assertTrue(np.allclose(_lci(engine, pf), _lci(self.engine, orig)))
+
+    def test_extend_from_matrices(self):
+        # single-output processes only: how an unallocated coproduct is linked depends on traversal order
+        archive = synthetic_archive(300, n_emissions=50, multi_output=0.0, seed=5)
+        reference = _engine(archive)
+        full = dict((pf.key, pf) for pf in reference.all_flows())
+        refs = [(pf.flow, pf.process) for pf in list(reference.foreground_flows(outputs=True))[::3]]
+        reference_emissions = dict((em.key, em.index) for em in reference.emissions)
+        for ordering in (None, 'rcm'):
+            flows = [ProductFlow(i, pf.flow, pf.process) for i, pf in enumerate(reference.background_flows())]
+            engine = BackgroundEngine.from_matrices(reference._a_matrix, reference._b_matrix, flows,
+                                                    reference.emissions, foreground=archive, ordering=ordering)
+            self.assertEqual(len(engine._lowlinks), len(flows))
+            added = engine.add_ref_products(refs)
+            self.assertEqual(engine.tstack.ndim, reference.tstack.ndim)
+            self.assertGreater(engine.tstack.pdim, 0)
+            emissions = [reference_emissions[em.key] for em in engine.emissions]  # engine's order -> reference's
+            for pf in added:
+                self.assertGreaterEqual(pf.index, len(flows))
+                self.assertTrue(np.allclose(_lci(engine, pf), _lci(reference, full[pf.key])[emissions]), ordering)
+
+    def test_from_matrices_self_dependency(self):
+        flows = [ProductFlow(i, pf.flow, pf.process) for i, pf in enumerate(self.engine.background_flows())]
+        evs = [pf.inbound_ev for pf in flows]
+        a = self.engine._a_matrix.tolil()
+        for j in (0, 5, 17):
+            a[j, j] = 0.2
+        engines = [BackgroundEngine.from_matrices(a, self.engine._b_matrix, flows, self.engine.emissions)
+                   for _ in range(2)]
+        self.assertEqual([pf.inbound_ev for pf in flows], evs)
+        self.assertAlmostEqual(engines[0].product_flow(5).inbound_ev, evs[5] * 0.8)
+        for j in (0, 5, 17, 30):
+            unit = np.zeros(len(flows))
+            unit[j] = 1.0
+            expected = self.engine._b_matrix.dot(spsolve((identity(len(flows)) - a).tocsc(), unit))
+            for engine in engines:
+                self.assertTrue(np.allclose(_lci(engine, flows[j]), expected))
+
+    def test_lci_cache(self):
+        engine = _engine(synthetic_archive(300, n_emissions=50, seed=1))
+        cache = engine.enable_lci_cache()
+        pfs = list(engine.foreground_flows())[:3] + list(engine.background_flows())[:3]
+        first = [engine.compute_lci(pf) for pf in pfs]
+        again = [engine.compute_lci(pf) for pf in pfs]
+        self.assertTrue(all(a is b for a, b in zip(first, again)))
+        self.assertEqual((cache.hits, cache.misses), (len(pfs), len(pfs)))
+        self.assertIsNot(engine.compute_lci(pfs[0], threshold=1e-10), first[0])
+        version = engine.version
+        engine.reorder_background()  # rebuilds A* and B*, so earlier results must not be served
+        self.assertGreater(engine.version, version)
+        after = engine.compute_lci(pfs[0])
+        self.assertIsNot(after, first[0])
+        self.assertTrue(np.allclose(after.toarray(), first[0].toarray()))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats().invalidations, 1)
+
+    def test_rcm_ordering(self):
+        engine = _engine(self.archive)
+        reordered = BackgroundEngine(self.archive, ordering='rcm')
+        reordered.add_all_ref_products()
+        self.assertEqual(set(pf.key for pf in reordered.background_flows()),
+                         set(pf.key for pf in engine.background_flows()))
+        for i, pf in enumerate(reordered.background_flows()):
+            self.assertEqual(reordered.tstack.bg_dict(pf.index), i)
+        full = dict((pf.key, pf) for pf in engine.all_flows())
+        for pf in list(reordered.background_flows())[:5] + list(reordered.foreground_flows())[:5]:
+            self.assertTrue(np.allclose(_lci(reordered, pf), _lci(engine, full[pf.key])))
+        version = engine.version
+        engine.reorder_background()
+        self.assertGreater(engine.version, version)
+        pf = next(reordered.foreground_flows())
+        self.assertTrue(np.allclose(_lci(reordered, pf), _lci(engine, full[pf.key])))
+
+    def test_mix(self):
+        archive = synthetic_archive(200, ambiguous=0.2, n_emissions=50, seed=2)
+        first = _engine(archive, multi_term='first')
+        mixed = _engine(archive, multi_term='mix')
+        markets = [pf for pf in mixed.all_flows() if str(pf.process).startswith('market for')]
+        self.assertGreater(len(markets), 0)
+        self.assertEqual(len(mixed._pf_index), len(first._pf_index) + len(markets))
+
+
+class ForegroundFragmentTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.archive = synthetic_archive(300, n_emissions=50, seed=1)
+        cls.engine = _engine(cls.archive)
+        cls.db = SyntheticFlowDb()
+
+    def test_whole_foreground(self):
+        whole = ForegroundFragment(self.engine, self.db, None)
+        whole.characterize(self.archive.lcia)
+        scores = whole.lcia_all()
+        self.assertEqual(scores.shape, (1, whole.pdim))
+        for j, pf in enumerate(whole.foreground[:10]):
+            fragment = ForegroundFragment(self.engine, self.db, pf)
+            fragment.characterize(self.archive.lcia)
+            self.assertTrue(np.allclose(np.asarray(fragment.lcia()).ravel(), scores[:, j]))
+
+    def test_contributions(self):
+        pf = next(self.engine.foreground_flows())
+        fragment = ForegroundFragment(self.engine, self.db, pf)
+        fragment.characterize(self.archive.lcia)
+        fg, bg = fragment.contributions()
+        total = fg.scores + bg.scores
+        self.assertTrue(np.allclose(total, np.asarray(fragment.lcia()).ravel()))
+        self.assertTrue(np.allclose(np.asarray(bg.processes.sum(axis=1)).ravel(), bg.scores))
+
+    def test_bf_slices(self):
+        for pf in list(self.engine.foreground_flows())[:5]:
+            fragment = ForegroundFragment(self.engine, self.db, pf)
+            bf = fragment.Bf.toarray()
+            self.assertIs(fragment.Bf_elementary, fragment.Bf_elementary)
+            self.assertTrue(np.array_equal(fragment.Bf_elementary.toarray(), bf[fragment.is_elem]))
+            self.assertTrue(np.array_equal(fragment.Bf_cutoff.toarray(), bf[~fragment.is_elem]))
+            self.assertEqual(fragment.Bf_elementary.shape[0] + fragment.Bf_cutoff.shape[0], fragment.mdim)
+
+    def test_elementary_mask_extends(self):
+        lazy = BackgroundEngine(self.archive)
+        fg = [p for p in self.archive.processes() if str(p).startswith('process fg')]
+        refs = [(x.flow, p) for p in fg for x in p.references()]
+        lazy.add_ref_products(refs[:1])
+        compartments = self.db.compartments
+        first = lazy.elementary_mask(compartments)
+        self.assertEqual(len(first), lazy.mdim)
+        lazy.add_ref_products(refs[1:])
+        self.assertGreater(lazy.mdim, len(first))
+        mask = lazy.elementary_mask(compartments)
+        expected = [compartments.is_elementary(em.flow) for em in lazy.emissions]
+        self.assertEqual(list(mask), expected)
+        self.assertEqual(list(mask[:len(first)]), list(first))
 
- * load semantic LCA data from a catalog
- * identify interior flows
 
-"""
\ No newline at end of file
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,326 @@
+"""
+Tests for fragment publication, reporting and display, run against synthetic archives (see lcamatrix.synthetic).
+"""
+import csv
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from lcamatrix.background import BackgroundEngine
+from lcamatrix.foreground import ForegroundFragment
+from lcamatrix.batch import fork_context
+from lcamatrix.foreground_publication import ForegroundPublication, PublicationContext, publish_fragments
+from lcamatrix.foreground_table import ForegroundReport, ForegroundTeX
+from lcamatrix.publication_writers import create_writer
+from lcamatrix.synthetic import synthetic_archive, SyntheticFlowDb
+
+
+def _importable(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def _cell(value):
+    """
+    Normalize a cell read back from any format: numbers as floats, everything else as text
+    """
+    if value is None:
+        return ''
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _rows(rows):
+    rows = [[_cell(v) for v in row] for row in rows]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def read_sheets(filename, fmt):
+    """
+    Read a published workbook back as {sheet name: list of rows}
+    """
+    if fmt == 'csv':
+        sheets = dict()
+        for name in os.listdir(filename):
+            with open(os.path.join(filename, name), newline='') as fp:
+                sheets[os.path.splitext(name)[0]] = _rows(csv.reader(fp))
+        return sheets
+    if fmt == 'xls':
+        import xlrd
+        book = xlrd.open_workbook(filename)
+        return dict((s.name, _rows([c.value for c in r] for r in s.get_rows())) for s in book.sheets())
+    import openpyxl
+    book = openpyxl.load_workbook(filename, read_only=True)
+    return dict((s.title, _rows(s.iter_rows(values_only=True))) for s in book.worksheets)
+
+
+def _engine(archive):
+    engine = BackgroundEngine(archive)
+    engine.add_all_ref_products()
+    return engine
+
+
+class PublicationTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.archive = synthetic_archive(300, n_emissions=50, seed=1)
+        cls.engine = _engine(cls.archive)
+        cls.db = SyntheticFlowDb()
+        cls.flows = list(cls.engine.foreground_flows(outputs=True))[:4]
+
+    def fragment(self, pf):
+        fragment = ForegroundFragment(self.engine, self.db, pf)
+        fragment.characterize(self.archive.lcia)
+        return fragment
+
+
+class ScoresTest(PublicationTestCase):
+    def test_components_add_up(self):
+        for pf in self.flows:
+            fragment = self.fragment(pf)
+            pub = ForegroundPublication(fragment)
+            scores = dict((k, np.asarray(v).ravel()) for k, v in pub._scores.items() if v is not None)
+            ad_tilde = np.asarray(pub._ad * pub._xtilde).ravel()
+            components = sum(scores[pub.key(ad)] * ad_tilde[pub._ad_idx[ad]] for ad in pub._ad_seen)
+            self.assertTrue(np.allclose(components, scores['sx_tilde'], rtol=1e-12, atol=0))
+            self.assertTrue(np.allclose(scores['s_tilde'], scores['sf_tilde'] + scores['sx_tilde'], rtol=1e-12))
+            self.assertTrue(np.allclose(scores['s_tilde'], np.asarray(fragment.lcia()).ravel()))
+
+    def test_unit_scores_follow_background_version(self):
+        engine = _engine(self.archive)
+        fragment = ForegroundFragment(engine, self.db, next(engine.foreground_flows(outputs=True)))
+        fragment.characterize(self.archive.lcia)
+        context = PublicationContext(fragment)
+        before = context.unit_scores(fragment)
+        self.assertIs(context.unit_scores(fragment), before)
+        engine.reorder_background()
+        after = context.unit_scores(fragment)
+        self.assertIsNot(after, before)
+        self.assertTrue(np.allclose(after, fragment.bg_unit_scores()))
+        self.assertFalse(np.allclose(after, before))
+
+
+FORMATS = [fmt for fmt, modules in (('csv', ()), ('xls', ('xlwt', 'xlrd')), ('xlsx', ('xlsxwriter', 'openpyxl')))
+           if all(_importable(m) for m in modules)]  # writer and reader for each format
+
+
+class TempDirTestCase(PublicationTestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertSheetsEqual(self, sheets, expected, msg=None):
+        """
+        Numbers are compared to 15 significant digits: xlsxwriter does not store the last digit of a double
+        """
+        self.assertEqual(sorted(sheets), sorted(expected), msg)
+        for name in expected:
+            self.assertEqual(len(sheets[name]), len(expected[name]), (msg, name))
+            for row, other in zip(sheets[name], expected[name]):
+                self.assertEqual([type(v) for v in row], [type(v) for v in other], (msg, name, row))
+                for v, w in zip(row, other):
+                    if isinstance(v, float):
+                        self.assertTrue(np.isclose(v, w, rtol=1e-14, atol=0), (msg, name, row, other))
+                    else:
+                        self.assertEqual(v, w, (msg, name, row))
+
+    def path(self, name, fmt):
+        if fmt == 'csv':
+            return os.path.join(self.dir, name)
+        return os.path.join(self.dir, '%s.%s' % (name, fmt))
+
+
+class WritersTest(TempDirTestCase):
+    expected = [['Key', 'Data'],
+                ['a', 1.0],
+                ['b', 2.5],
+                ['c', -3.0],
+                [],
+                ['row', '', 4.0, '', 5.0]]
+
+    def _write(self, fmt):
+        filename = self.path('writer', fmt)
+        x = create_writer(filename, fmt=fmt)
+        sheet = x.add_sheet('Sheet')
+        row = x.write_row(sheet, 0, ('Key', 'Data'))
+        row = x.write_columns(sheet, row, (np.array(['a', 'b', 'c']), np.array([1.0, 2.5, -3.0])))
+        x.write_cells(sheet, row + 1, [0, 2, 4], ['row', 4.0, 5.0], ncols=5)
+        x.close()
+        return filename
+
+    def test_round_trip(self):
+        for fmt in FORMATS:
+            self.assertSheetsEqual(read_sheets(self._write(fmt), fmt), {'Sheet': self.expected}, fmt)
+
+    @unittest.skipUnless(_importable('xlwt'), 'xlwt unavailable')
+    def test_xls_row_limit(self):
+        x = create_writer(self.path('limit', 'xls'))
+        sheet = x.add_sheet('Sheet')
+        self.assertRaises(ValueError, x.write_row, sheet, 65536, ('too far', ))
+
+    def test_publications_agree(self):
+        pub = ForegroundPublication(self.fragment(self.flows[0]))
+        sheets = dict()
+        for fmt in FORMATS:
+            filename = self.path('pub', fmt)
+            pub.publish(filename, fmt=fmt)
+            sheets[fmt] = read_sheets(filename, fmt)
+        self.assertIn('LciaScores', sheets['csv'])
+        scores = dict((row[0], row[1:-1]) for row in sheets['csv']['LciaScores'][1:])
+        self.assertTrue(np.allclose(scores['s_tilde'], np.asarray(pub._scores['s_tilde']).ravel()))
+        for fmt in FORMATS:
+            self.assertSheetsEqual(sheets[fmt], sheets['csv'], fmt)
+
+
+def _triplets(rows):
+    """
+    sparse-mode matrix sheet -> {(row key, column key): value}
+    """
+    return dict(((r, c), v) for r, c, v in rows[1:])
+
+
+def _dense(rows):
+    """
+    full-mode matrix sheet -> {(row key, column key): value}, skipping blank cells
+    """
+    cols = rows[0]
+    return dict(((row[0], cols[j]), v) for row in rows[1:] for j, v in enumerate(row) if j > 0 and v != '')
+
+
+class FullModeTest(TempDirTestCase):
+    def test_full_matches_sparse(self):
+        pub = ForegroundPublication(self.fragment(self.flows[1]))
+        pub.publish(self.path('sparse', 'csv'), fmt='csv')
+        pub.publish(self.path('full', 'csv'), full=True, fmt='csv')
+        sparse = read_sheets(self.path('sparse', 'csv'), 'csv')
+        full = read_sheets(self.path('full', 'csv'), 'csv')
+
+        self.assertEqual(set(full) - set(sparse), {'E.T'})
+        self.assertEqual(set(sparse) - set(full), {'E'})
+        for name in sparse:
+            if name in ('Af', 'Ad', 'Bf'):
+                self.assertGreater(len(sparse[name]), 1, name)
+                self.assertEqual(_dense(full[name]), _triplets(sparse[name]), name)
+            elif name != 'E':
+                self.assertEqual(full[name], sparse[name], name)
+        e = dict(((c, r), v) for (r, c), v in _triplets(sparse['E']).items())
+        self.assertGreater(len(e), 0)
+        self.assertEqual(_dense(full['E.T']), e)
+
+
+
+def _contents(dirname):
+    contents = dict()
+    for root, _, files in os.walk(dirname):
+        for name in files:
+            with open(os.path.join(root, name), 'rb') as fp:
+                contents[os.path.relpath(os.path.join(root, name), dirname)] = fp.read()
+    return contents
+
+
+class PublishFragmentsTest(TempDirTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(PublishFragmentsTest, cls).setUpClass()
+        cls.fragments = [ForegroundFragment(cls.engine, cls.db, pf) for pf in cls.flows]
+        for fragment in cls.fragments:
+            fragment.characterize(cls.archive.lcia)
+
+    def _publish(self, subdir, workers):
+        filenames = [os.path.join(self.dir, subdir, 'frag%d' % k) for k in range(len(self.fragments))]
+        self.assertEqual(publish_fragments(self.fragments, filenames, fmt='csv', workers=workers), filenames)
+        return _contents(os.path.join(self.dir, subdir))
+
+    @unittest.skipIf(fork_context() is None, 'fork start method unavailable')
+    def test_parallel_matches_serial(self):
+        serial = self._publish('serial', 1)
+        parallel = self._publish('parallel', 3)
+        sheets = len(os.listdir(os.path.join(self.dir, 'serial', 'frag0')))
+        self.assertEqual(len(serial), len(self.fragments) * sheets)
+        self.assertEqual(parallel, serial)
+
+    def test_matches_single_publication(self):
+        ForegroundPublication(self.fragments[2]).publish(os.path.join(self.dir, 'alone'), fmt='csv')
+        alone = _contents(os.path.join(self.dir, 'alone'))
+        serial = self._publish('serial', 1)
+        self.assertEqual(alone, dict((os.path.relpath(k, 'frag2'), v) for k, v in serial.items()
+                                     if k.startswith('frag2' + os.sep)))
+
+
+class ReportTest(PublicationTestCase):
+    def _report(self, workers):
+        stream = io.StringIO()
+        report = ForegroundReport(self.engine, self.db, workers=workers, max_pending=2)
+        self.assertEqual(report.write(stream, flows=self.flows), len(self.flows))
+        return stream.getvalue()
+
+    def test_serial_matches_fragments(self):
+        expected = ''.join(ForegroundTeX(self.fragment(pf)).foreground_table(section=True) + '\n'
+                           for pf in self.flows)
+        self.assertEqual(self._report(1), expected)
+
+    def test_foreground_built_before_fork(self):
+        engine = _engine(self.archive)
+        self.assertIsNone(engine._fg_matrices)
+        report = ForegroundReport(engine, self.db, workers=2)
+        next(report.tables(flows=list(engine.foreground_flows(outputs=True))[:2]))
+        self.assertIsNotNone(engine._fg_matrices)
+
+    @unittest.skipIf(fork_context() is None, 'fork start method unavailable')
+    def test_parallel_matches_serial(self):
+        serial = self._report(1)
+        self.assertIn('tabular', serial)
+        self.assertEqual(self._report(3), serial)
+
+
+
+@unittest.skipUnless(_importable('pandas'), 'pandas unavailable')
+class DisplayFragmentTest(PublicationTestCase):
+    def setUp(self):
+        from lcamatrix.foreground_display import DisplayFragment
+        self.fragment = DisplayFragment(self.engine, self.db, self.flows[0])
+        self.fragment.characterize(self.archive.lcia)
+
+    def test_shapes(self):
+        f = self.fragment
+        self.assertEqual(f.show_Af().shape, (f.pdim, f.pdim))
+        for frame, mat in ((f.show_Ad(), f.Ad), (f.show_Bf(), f.Bf)):
+            self.assertEqual(frame.shape, (len(np.unique(mat.tocoo().row)), f.pdim))
+            self.assertTrue(np.allclose(frame.values.sum(axis=0), np.asarray(mat.sum(axis=0)).ravel()))
+        self.assertEqual(f.show_E().shape, (len(np.unique(f.E.tocoo().col)), f.tdim))
+        self.assertTrue(np.allclose(f.show_Bf(sparse=True).sparse.to_dense().values, f.show_Bf().values))
+
+    def test_values_match_lcia(self):
+        f = self.fragment
+        e = f.show_E()
+        bf_tilde = f.show_bf_tilde()[0]
+        fg = e.reindex(bf_tilde.index, fill_value=0.0).T.dot(bf_tilde)
+
+        ad_tilde = f.show_ad_tilde()[0]
+        unit_scores = np.asarray(f.bg_unit_scores())
+        index = dict((pf, i) for i, pf in enumerate(f.bg_flows))
+        bg = sum(unit_scores[:, index[pf]] * v for pf, v in ad_tilde.items())
+
+        self.assertEqual(len(fg), f.tdim)
+        self.assertTrue(np.allclose(fg.values, np.asarray(f.fg_lcia()).ravel()))
+        self.assertTrue(np.allclose(fg.values + bg, np.asarray(f.lcia()).ravel()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+Tests for loading JSON archives with lcamatrix.tools.from_json
+"""
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from lcamatrix import tools
+except ImportError:
+    tools = None
+
+
+CATALOG = {'dataSource': 'test', 'processes': [{'entityId': 'p%d' % k, 'exchanges': list(range(k))}
+                                               for k in range(50)]}
+
+
+@unittest.skipIf(tools is None, 'lcamatrix.tools dependencies unavailable')
+class FromJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, name, j, mtime=None):
+        fname = os.path.join(self.dir, name)
+        data = json.dumps(j).encode('utf-8')
+        if name.endswith('.gz'):
+            with gzip.open(fname, 'wb') as fp:
+                fp.write(data)
+        else:
+            with open(fname, 'wb') as fp:
+                fp.write(data)
+        if mtime is not None:
+            os.utime(fname, (mtime, mtime))
+        return fname
+
+    def test_read_bytes(self):
+        for name in ('archive.json', 'archive.json.gz'):
+            fname = self._write(name, CATALOG)
+            self.assertEqual(bytes(tools._read_bytes(fname)), json.dumps(CATALOG).encode('utf-8'))
+            self.assertEqual(tools.from_json(fname), CATALOG)
+
+    def test_read_into_size_hint(self):
+        fname = self._write('archive.json', CATALOG)
+        data = json.dumps(CATALOG).encode('utf-8')
+        for size in (0, 10, len(data), len(data) + 100):
+            with open(fname, 'rb') as fp:
+                self.assertEqual(bytes(tools._read_into(fp, size)), data)
+
+    def test_short_gzip(self):
+        for data in (b'', b'\x1f\x8b'):
+            fname = os.path.join(self.dir, 'short.json.gz')
+            with open(fname, 'wb') as fp:
+                fp.write(data)
+            self.assertEqual(tools._gzip_size(fname), 0)
+        empty = os.path.join(self.dir, 'empty.json.gz')
+        with gzip.open(empty, 'wb'):
+            pass
+        self.assertEqual(bytes(tools._read_bytes(empty)), b'')
+
+    def test_no_cache_by_default(self):
+        fname = self._write('archive.json.gz', CATALOG)
+        tools.from_json(fname)
+        self.assertFalse(os.path.exists(fname + tools.CACHE_SUFFIX))
+
+    def test_cache(self):
+        fname = self._write('archive.json.gz', CATALOG, mtime=1000000000)
+        cache_file = fname + tools.CACHE_SUFFIX
+        self.assertEqual(tools.from_json(fname, cache=True), CATALOG)
+        self.assertTrue(os.path.exists(cache_file))
+        self.assertEqual(tools._load_cache(fname, cache_file), CATALOG)
+        self.assertEqual(tools.from_json(fname, cache=True), CATALOG)
+
+    def _cache_format(self, cache_file):
+        with open(cache_file, 'rb') as fp:
+            return json.loads(fp.readline().decode('utf-8'))['format']
+
+    @unittest.skipIf(tools is None or tools.msgpack is None, 'msgpack unavailable')
+    def test_msgpack_cache(self):
+        fname = self._write('archive.json.gz', CATALOG)
+        cache_file = fname + tools.CACHE_SUFFIX
+        tools.from_json(fname, cache=True)
+        self.assertEqual(self._cache_format(cache_file), 'msgpack')
+        self.assertEqual(tools._load_cache(fname, cache_file), CATALOG)
+        msgpack = tools.msgpack
+        tools.msgpack = None  # a msgpack cache is ignored, not misread, once msgpack is gone
+        try:
+            self.assertIsNone(tools._load_cache(fname, cache_file))
+        finally:
+            tools.msgpack = msgpack
+
+    def test_json_cache(self):
+        fname = self._write('archive.json.gz', CATALOG)
+        cache_file = fname + tools.CACHE_SUFFIX
+        msgpack = tools.msgpack
+        tools.msgpack = None
+        try:
+            tools.from_json(fname, cache=True)
+            self.assertEqual(self._cache_format(cache_file), 'json')
+            self.assertEqual(tools._load_cache(fname, cache_file), CATALOG)
+        finally:
+            tools.msgpack = msgpack
+        self.assertEqual(tools._load_cache(fname, cache_file), CATALOG)
+
+    def test_cache_invalidated(self):
+        fname = self._write('archive.json.gz', CATALOG, mtime=1000000000)
+        tools.from_json(fname, cache=True)
+        changed = dict(CATALOG, dataSource='changed')
+        self._write('archive.json.gz', changed, mtime=1000000100)
+        self.assertIsNone(tools._load_cache(fname, fname + tools.CACHE_SUFFIX))
+        self.assertEqual(tools.from_json(fname, cache=True), changed)
+        self.assertEqual(tools._load_cache(fname, fname + tools.CACHE_SUFFIX), changed)
+
+    def test_unreadable_cache(self):
+        fname = self._write('archive.json', CATALOG)
+        cache_file = fname + tools.CACHE_SUFFIX
+        for junk in (b'', b'\x80\x04garbage', json.dumps(tools._cache_key(fname)).encode('utf-8') + b'\n{"trunc'):
+            with open(cache_file, 'wb') as fp:
+                fp.write(junk)
+            self.assertIsNone(tools._load_cache(fname, cache_file))
+            self.assertEqual(tools.from_json(fname, cache=True), CATALOG)
+
+
+if __name__ == '__main__':
+    unittest.main()
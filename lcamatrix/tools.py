@@ -1,29 +1,189 @@
 import json
 import gzip
+import os
 import re
+import struct
 
 from eight import USING_PYTHON2
 
 from itertools import groupby
 
+try:
+    import orjson as fast_json
+except ImportError:
+    try:
+        import ujson as fast_json
+    except ImportError:
+        fast_json = None
 
-def from_json(fname):
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+READ_CHUNK = 1 << 24  # bytes read at a time once a file runs past its expected size
+CACHE_SUFFIX = '.cache'
+
+
+def _gzip_size(fname):
+    """
+    Uncompressed size recorded in the gzip trailer (ISIZE).  This is the size modulo 2**32 of the last member only,
+    so it is a hint for preallocation, not a guarantee.
+    :param fname:
+    :return: int, or 0 if the file is too short to have a trailer
+    """
+    with open(fname, 'rb') as fp:
+        try:
+            fp.seek(-4, os.SEEK_END)
+        except (IOError, OSError):
+            return 0  # _read_into then grows the buffer as it reads
+        return struct.unpack('<I', fp.read(4))[0]
+
+
+def _read_into(fp, size):
+    """
+    Read the rest of an open binary file into a buffer preallocated to the expected size; if the file turns out to
+    be longer, the remainder is appended, and if shorter, the buffer is truncated.
+    :param fp: binary file object
+    :param size: expected number of bytes
+    :return: bytearray
+    """
+    buf = bytearray(size)
+    view = memoryview(buf)
+    pos = 0
+    while pos < size:
+        n = fp.readinto(view[pos:])
+        if not n:
+            break
+        pos += n
+    del view  # buf cannot be resized while a view of it exists
+    if pos < size:
+        del buf[pos:]
+        return buf
+    while True:
+        chunk = fp.read(READ_CHUNK)
+        if not chunk:
+            break
+        buf.extend(chunk)
+    return buf
+
+
+def _read_bytes(fname):
+    """
+    Read a whole file, decompressing it if gzipped, into a single preallocated buffer.  This avoids the text-mode
+    decoding and line-buffered reads of json.load on a gzip file.  The file is not parsed incrementally: the full
+    decompressed contents are held in memory until parsing is done.
+    :param fname:
+    :return: bytearray
+    """
+    if bool(re.search(r'\.gz$', fname)):
+        size = _gzip_size(fname)
+        with gzip.open(fname, 'rb') as fp:
+            return _read_into(fp, size)
+    with open(fname, 'rb') as fp:
+        return _read_into(fp, os.fstat(fp.fileno()).st_size)
+
+
+def _parse(buf):
+    """
+    Parse a JSON buffer with orjson or ujson if either is installed, else with the standard library.  The standard
+    library needs a decoded copy, so without orjson or ujson the bytes, the text and the parsed object are all in
+    memory at once.
+    :param buf: bytes or bytearray
+    :return:
+    """
+    if fast_json is not None:
+        return fast_json.loads(buf)
+    if USING_PYTHON2:
+        return json.loads(str(buf))
+    return json.loads(buf.decode('utf-8'))
+
+
+def _cache_key(fname):
+    st = os.stat(fname)
+    return {'source': os.path.abspath(fname), 'mtime': st.st_mtime, 'size': st.st_size}
+
+
+def _load_cache(fname, cache_file):
+    """
+    :return: the cached catalog, or None if there is no cache, it does not match the source file, or it was
+     written with msgpack and msgpack is not installed
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as fp:
+            header = json.loads(fp.readline().decode('utf-8'))
+            fmt = header.pop('format', 'json')
+            if header != _cache_key(fname):
+                print('Cache %s is stale' % cache_file)
+                return None
+            if fmt == 'msgpack' and msgpack is None:
+                print('Cache %s requires msgpack' % cache_file)
+                return None
+            body = _read_into(fp, os.fstat(fp.fileno()).st_size - fp.tell())
+        if fmt == 'msgpack':
+            return msgpack.unpackb(body, raw=False)
+        return _parse(body)
+    except (ValueError, TypeError, AttributeError, ImportError, EOFError, IOError, OSError) as e:
+        print('Ignoring unreadable cache %s: %s' % (cache_file, e))
+        return None
+
+
+def _write_cache(fname, cache_file, j):
+    """
+    Writes the catalog as msgpack if it is installed, else as uncompressed JSON, after a one-line JSON header
+    identifying the source file and the format, so a stale cache can be detected without loading it.  Written to a
+    temporary file and renamed, so an interrupted write never leaves a corrupt cache.
+    """
+    tmp = cache_file + '.tmp'
+    try:
+        if msgpack is not None:
+            fmt = 'msgpack'
+            body = msgpack.packb(j, use_bin_type=True)
+        else:
+            fmt = 'json'
+            if fast_json is not None:
+                body = fast_json.dumps(j)
+            else:
+                body = json.dumps(j)
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+        with open(tmp, 'wb') as fp:
+            fp.write(json.dumps(dict(_cache_key(fname), format=fmt)).encode('utf-8') + b'\n')
+            fp.write(body)
+        os.rename(tmp, cache_file)
+    except (TypeError, ValueError, OverflowError, IOError, OSError) as e:
+        print('Unable to write cache %s: %s' % (cache_file, e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def from_json(fname, cache=False, cache_file=None):
     """
     Routine to reconstruct a catalog from a json archive.
+
+    With cache=True, the first load writes an uncompressed cache next to the archive; subsequent loads read the
+    cache instead, as long as the archive's path, modification time and size are unchanged.  The cache is msgpack
+    if that package is installed and plain JSON otherwise; neither format can execute code when read.  It is only
+    worth enabling for gzipped archives that are loaded repeatedly.
     :param fname: json file, optionally gzipped
+    :param cache: [False] whether to read and write the cache
+    :param cache_file: [fname + '.cache'] location of the cache
     :return: a subclass of ArchiveInterface
     """
+    if cache_file is None:
+        cache_file = fname + CACHE_SUFFIX
+    if cache:
+        j = _load_cache(fname, cache_file)
+        if j is not None:
+            print('Loading cached JSON data from %s:' % cache_file)
+            return j
     print('Loading JSON data from %s:' % fname)
-    if bool(re.search('\.gz$', fname)):
-        if USING_PYTHON2:
-            with gzip.open(fname, 'r') as fp:
-                j = json.load(fp)
-        else:
-            with gzip.open(fname, 'rt') as fp:
-                j = json.load(fp)
-    else:
-        with open(fname, 'r') as fp:
-            j = json.load(fp)
+    j = _parse(_read_bytes(fname))
+    if cache:
+        _write_cache(fname, cache_file, j)
     return j
 
 
@@ -36,4 +196,3 @@ def group_by(iterable, keyfunc):
         uniquekeys.append(k)
 
     return groups, uniquekeys
-